@@ -53,7 +53,9 @@ def concat_weights(models, device=None):
   return {name: convert(name) for name in {name: None for model in models for name in model}}
 
 def load(fn:str):
-  if fn.endswith('.index.json'):
+  if fn.endswith('.safetensors.index.json'):
+    return safe_load(fn)
+  elif fn.endswith('.index.json'):
     with open(fn) as fp: weight_map = json.load(fp)['weight_map']
     parts = {n: load(str(Path(fn).parent / Path(n).name)) for n in set(weight_map.values())}
     return {k: parts[n][k] for k, n in weight_map.items()}
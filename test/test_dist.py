@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+import unittest, sys, os, time, itertools
+import numpy as np
+from tinygrad import Tensor
+from tinygrad.ops import ReduceOps
+from tinygrad.dist import spawn
+from tinygrad.nn.optim import SGD
+
+def _collectives(pg, n):
+  x = Tensor.arange(n, dtype="float32") * (pg.rank + 1)
+  return pg.all_reduce(x).numpy(), pg.all_reduce(x, ReduceOps.MAX).numpy(), pg.broadcast(Tensor.full((3, 5), pg.rank+1.0), src=1).numpy()
+
+def _all_reduce_broadcast(pg):
+  if pg.rank == 1:
+    # rank 1 is slow to read the result of the all_reduce
+    barrier, calls = pg.barrier, itertools.count(1)
+    def slow_barrier():
+      barrier()
+      if next(calls) == 2: time.sleep(0.5)
+    pg.barrier = slow_barrier
+  return pg.all_reduce(Tensor.ones(3)).numpy(), pg.broadcast(Tensor.full((3,), 100.0 if pg.rank == 0 else 0.0)).numpy()
+
+def _idle_wait(pg):
+  # rank 0 waits for rank 1 in the barrier without using the cpu
+  if pg.rank == 1: time.sleep(1)
+  st = time.process_time()
+  pg.barrier()
+  return time.process_time() - st
+
+def _crash(pg):
+  if pg.rank == 1: os._exit(3)
+  pg.barrier()
+
+def _train(pg, X, Y, W, steps):
+  # every rank trains on its part of the batch and averages the grads
+  x, y = Tensor(X[pg.rank::pg.world_size]), Tensor(Y[pg.rank::pg.world_size])
+  w = Tensor(W, requires_grad=True)
+  opt = SGD([w], lr=0.1)
+  with Tensor.train():
+    for _ in range(steps):
+      opt.zero_grad()
+      ((x @ w - y) ** 2).mean().backward()
+      w.grad = pg.all_reduce(w.grad) / pg.world_size
+      opt.step()
+  return w.numpy()
+
+@unittest.skipUnless(sys.platform == "linux", "needs POSIX shared memory")
+class TestProcessGroup(unittest.TestCase):
+  def test_collectives(self):
+    # 1000 floats don't fit a 1024 byte slot, so this runs in pieces
+    for n in (7, 1000):
+      for s, m, b in spawn(_collectives, 3, n, slot_size=1024):
+        np.testing.assert_allclose(s, np.arange(n) * 6)
+        np.testing.assert_allclose(m, np.arange(n) * 3)
+        np.testing.assert_allclose(b, np.full((3, 5), 2.0))
+
+  def test_all_reduce_then_broadcast(self):
+    for s, b in spawn(_all_reduce_broadcast, 2):
+      np.testing.assert_equal(s, [2, 2, 2])
+      np.testing.assert_equal(b, [100, 100, 100])
+
+  def test_barrier_sleeps(self): self.assertLess(spawn(_idle_wait, 2)[0], 0.05)
+
+  def test_data_parallel(self):
+    rng = np.random.default_rng(0)
+    X, Y, W = [rng.standard_normal(s, dtype=np.float32) for s in ((8, 4), (8, 2), (4, 2))]
+    ref = _train(type("pg", (), {"rank": 0, "world_size": 1, "all_reduce": lambda self, t: t})(), X, Y, W, 3)
+    for w in spawn(_train, 2, X, Y, W, 3): np.testing.assert_allclose(w, ref, atol=1e-5, rtol=1e-5)
+
+  def test_rank_error(self):
+    with self.assertRaisesRegex(RuntimeError, "rank"): spawn(_collectives, 2, "not a size")
+    with self.assertRaisesRegex(RuntimeError, "rank 1 failed: exited with code 3"): spawn(_crash, 2)
+
+if __name__ == '__main__':
+  unittest.main()
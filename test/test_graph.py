@@ -230,5 +230,33 @@ class TestGraph(unittest.TestCase):
 
     helper_test_graphs(Device[d0].graph, graphs)
 
+@unittest.skipUnless(Device.DEFAULT == "CLANG", "clang graph")
+class TestClangGraph(unittest.TestCase):
+  def test_rebind_same_lib(self):
+    from tinygrad.runtime.graph.clang import ClangGraph
+    libs = []
+    for _ in range(2):
+      b0 = [helper_alloc_rawbuffer("CLANG", fill=True) for _ in range(5)]
+      graph = [helper_exec_op("CLANG", b0[0], [b0[1], b0[2]]), helper_exec_op("CLANG", b0[3], [b0[0], b0[4]])]
+      helper_test_graphs(ClangGraph, [graph], runs=2)
+      libs.append(ClangGraph(graph, [b0[1]], {}).clprgs[0][0].lib)
+    # the buffers are in a pointer table, not in the code
+    self.assertEqual(libs[0], libs[1])
+
+  def test_threaded(self):
+    from tinygrad.runtime.graph.clang import ClangGraph
+    from tinygrad.codegen.kernel import Kernel, Opt, OptOps
+    with Context(DEBUG=0):
+      fst = [Tensor.randn(BUF_SIZE, dtype=dtypes.int).realize() for _ in range(2)]
+      k = Kernel(create_schedule([fst[0].xor(fst[1]).lazydata])[-1].ast, opts=Device["CLANG"].renderer)
+    k.apply_opt(Opt(OptOps.THREAD, 0, 4))
+    prg = CompiledRunner(k.to_program())
+    self.assertEqual(prg.p.global_size, [4,1,1])
+    b0 = [helper_alloc_rawbuffer("CLANG", fill=True) for _ in range(5)]
+    graph = [ExecItem(prg, [b0[0], b0[1], b0[2]]), helper_exec_op("CLANG", b0[3], [b0[0], b0[4]]), helper_exec_op("CLANG", b0[2], [b0[3], b0[1]]),
+             ExecItem(prg, [b0[1], b0[2], b0[0]])]
+    helper_test_graphs(ClangGraph, [graph], runs=2)
+    self.assertEqual(len(ClangGraph(graph, [], {}).clprgs), 3)
+
 if __name__ == '__main__':
   unittest.main()
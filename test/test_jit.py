@@ -5,9 +5,10 @@ import numpy as np
 from hypothesis import given, settings, strategies as strat
 from test.helpers import assert_jit_cache_len
 from tinygrad.tensor import Tensor
+from tinygrad import nn
 from tinygrad.engine.jit import TinyJit
 from tinygrad.device import Device
-from tinygrad.helpers import CI, Context
+from tinygrad.helpers import CI, Context, diskcache_put
 from tinygrad.dtype import dtypes
 from extra.models.unet import ResBlock
 
@@ -461,5 +462,199 @@ class TestJitInsideJit(unittest.TestCase):
     with self.assertRaisesRegex(RuntimeError, "having TinyJit inside another TinyJit is not supported"):
       g(Tensor([1])).realize()
 
+class TestMultiCapture(unittest.TestCase):
+  def test_multiple_signatures(self):
+    @TinyJit
+    def f(a:Tensor) -> Tensor: return (a * 2).realize()
+    f.max_captured = 2
+    for _ in range(3):
+      for n in (4, 6):
+        a = Tensor.rand(n).realize()
+        np.testing.assert_allclose(f(a).numpy(), a.numpy() * 2)
+    self.assertEqual(len(f.captures), 2)
+
+  def test_lru(self):
+    jf = TinyJit(lambda a: (a + 1).realize(), max_captured=2)
+    for n in (2, 3, 4):
+      for _ in range(3): jf(Tensor.rand(n).realize())
+    self.assertEqual([k[1][0][0].shape for k in jf.captures], [(3,), (4,)])
+    # the evicted signature warms up again
+    jf(Tensor.rand(2).realize())
+    self.assertIsNone(jf.captured)
+
+  def test_buckets(self):
+    jf = TinyJit(lambda a, b: (a @ b).relu().realize(), max_captured=4, buckets={0: {0: (4, 8)}})
+    b = Tensor.rand(16, 8).realize()
+    for n in (3, 5, 4, 7, 1, 8):
+      for _ in range(3):
+        a = Tensor.rand(n, 16).realize()
+        out = jf(a, b)
+        # the output comes back padded
+        self.assertEqual(out.shape, (4 if n <= 4 else 8, 8))
+        np.testing.assert_allclose(out[:n].numpy(), np.maximum(a.numpy() @ b.numpy(), 0), atol=1e-5)
+    self.assertEqual(len(jf.captures), 2)
+
+  def test_buckets_named_args_only(self):
+    # w has the same size on the bucketed axis, but it isn't padded
+    jf = TinyJit(lambda x, w: (x @ w).realize(), max_captured=2, buckets={"x": {0: (4,)}})
+    w = Tensor.rand(3, 3).realize()
+    for _ in range(3):
+      x = Tensor.rand(3, 3).realize()
+      np.testing.assert_allclose(jf(x=x, w=w)[:3].numpy(), x.numpy() @ w.numpy(), atol=1e-5)
+
+  def test_buckets_masked_reduce(self):
+    # a mean over the padded axis masks the padding with the length
+    def mean(x:Tensor, n:Tensor) -> Tensor: return ((Tensor.arange(x.shape[0]) < n).where(x, 0).sum() / n).realize()
+    jf = TinyJit(mean, max_captured=2, buckets={0: {0: (8,)}})
+    for n in (3, 5, 7):
+      x = Tensor.rand(n).realize()
+      np.testing.assert_allclose(jf(x, Tensor([n]).realize()).numpy(), [x.numpy().mean()], atol=1e-6)
+
+  def test_uncaptured_signatures_dropped(self):
+    jf = TinyJit(lambda a: (a + 1).realize(), max_captured=2)
+    for n in range(2, 10): jf(Tensor.rand(n).realize())
+    self.assertEqual(len(jf._cnts), 2)
+
+  def test_single_capture_asserts(self):
+    jf = TinyJit(lambda a: (a + 1).realize())
+    for _ in range(3): jf(Tensor.rand(2).realize())
+    with self.assertRaises(AssertionError): jf(Tensor.rand(3).realize())
+
+class TestCaptureFirst(unittest.TestCase):
+  def test_lazy_weights(self):
+    Tensor.manual_seed(0)
+    l1, l2 = nn.Linear(16, 32), nn.Linear(32, 4)
+    jf = TinyJit(lambda x: l2(l1(x).relu()).realize(), capture_first=True)
+    for i in range(4):
+      x = Tensor.rand(2, 16).realize()
+      out = jf(x).numpy()
+      # captured on the first call
+      assert_jit_cache_len(jf, 2)
+      self.assertEqual(jf.cnt, i+2)
+      np.testing.assert_allclose(out, l2(l1(x).relu()).numpy(), atol=1e-5)
+
+  def test_state_assign(self):
+    c = Tensor.zeros(1).contiguous()
+    jf = TinyJit(lambda x: c.assign(c + x).realize(), capture_first=True)
+    for _ in range(3): jf(Tensor([1.0]).realize())
+    np.testing.assert_equal(c.numpy(), [3.0])
+
+  def test_state_created_in_call(self):
+    class Counter:
+      def __call__(self, x:Tensor) -> Tensor:
+        if not hasattr(self, "c"): self.c = Tensor.zeros(1).contiguous().realize()
+        self.c.assign(self.c + x).realize()
+        return (self.c * 2).realize()
+    cnt = Counter()
+    jf = TinyJit(cnt, capture_first=True)
+    for i in range(3): np.testing.assert_equal(jf(Tensor([1.0]).realize()).numpy(), [2.0*(i+1)])
+    np.testing.assert_equal(cnt.c.numpy(), [3.0])
+
+  def test_state_from_replayed_state(self):
+    class Model:
+      def __call__(self, x:Tensor) -> Tensor:
+        if not hasattr(self, "c"): self.c = Tensor.zeros(1).contiguous().realize()
+        self.c.assign(self.c + 1).realize()
+        # d is new on every call, but it's computed from c which changes
+        self.d = (self.c * 2).realize()
+        return (x + self.d).realize()
+    outs = {}
+    for capture_first in (False, True):
+      jf = TinyJit(Model(), capture_first=capture_first)
+      outs[capture_first] = [jf(Tensor([0.0]).realize()).item() for _ in range(5)]
+    self.assertEqual(outs[True], outs[False])
+    self.assertEqual(outs[True], [2, 4, 6, 8, 10])
+
+class TestJitCache(unittest.TestCase):
+  def setUp(self):
+    self.w = Tensor.rand(16, 8).realize()
+    def fxn(x:Tensor) -> Tensor: return (x @ self.w).relu().realize()
+    self.fxn = fxn
+
+  def test_warm_start(self):
+    x = Tensor.rand(4, 16).realize()
+    with Context(JITCACHE=1):
+      jf = TinyJit(self.fxn)
+      for _ in range(3): jf(x)
+      # a new jit, as in a new process, replays on the first call with the weights it can reach now
+      self.w = Tensor.rand(16, 8).realize()
+      jf2 = TinyJit(self.fxn)
+      np.testing.assert_allclose(jf2(x).numpy(), np.maximum(x.numpy() @ self.w.numpy(), 0), atol=1e-5)
+      self.assertEqual(jf2.cnt, 3)
+      assert_jit_cache_len(jf2, 1)
+
+  def test_different_shape_captures(self):
+    with Context(JITCACHE=1):
+      jf = TinyJit(self.fxn)
+      for _ in range(3): jf(Tensor.rand(4, 16).realize())
+      jf2 = TinyJit(self.fxn)
+      jf2(Tensor.rand(5, 16).realize())
+      self.assertEqual(jf2.cnt, 1)
+
+  def test_different_state_captures(self):
+    x = Tensor.rand(4, 16).realize()
+    with Context(JITCACHE=1):
+      jf = TinyJit(self.fxn)
+      for _ in range(3): jf(x)
+      # same code, other weights
+      self.w = Tensor.rand(16, 32).realize()
+      jf2 = TinyJit(self.fxn)
+      np.testing.assert_allclose(jf2(x).numpy(), np.maximum(x.numpy() @ self.w.numpy(), 0), atol=1e-5)
+      self.assertEqual(jf2.cnt, 1)
+
+  def test_different_arg_captures(self):
+    def fxn(x:Tensor, scale:float) -> Tensor: return (x * scale).realize()
+    x = Tensor.rand(4).realize()
+    with Context(JITCACHE=1):
+      jf = TinyJit(fxn)
+      for _ in range(3): jf(x, 2.0)
+      jf2 = TinyJit(fxn)
+      np.testing.assert_allclose(jf2(x, 3.0).numpy(), x.numpy() * 3, atol=1e-6)
+      self.assertEqual(jf2.cnt, 1)
+
+  def test_bound_buffer_mismatch(self):
+    from tinygrad.engine.jit import _jit_state, _prepare_jit_inputs, _jit_key
+    x = Tensor.rand(4, 16).realize()
+    with Context(JITCACHE=1):
+      jf = TinyJit(self.fxn)
+      for _ in range(3): jf(x)
+      key = _jit_key(self.fxn, *_prepare_jit_inputs((x,), {})[2:], state:=_jit_state(self.fxn, (x,), {}), (x,), {})
+      self.assertIsNotNone(TinyJit(self.fxn)._load(key, state))
+      # a cache entry bound to a state of another size isn't used
+      self.w = Tensor.rand(16, 9).realize()
+      self.assertIsNone(TinyJit(self.fxn)._load(key, _jit_state(self.fxn, (x,), {})))
+
+  def test_callee_change_captures(self):
+    layer = lambda x: x * 2  # noqa: E731
+    def fxn(x:Tensor) -> Tensor: return layer(x).realize()
+    x = Tensor.rand(4).realize()
+    with Context(JITCACHE=1):
+      jf = TinyJit(fxn)
+      for _ in range(3): jf(x)
+      # same function, the code it calls changed
+      layer = lambda x: x * 3  # noqa: E731
+      jf2 = TinyJit(fxn)
+      np.testing.assert_allclose(jf2(x).numpy(), x.numpy() * 3, atol=1e-6)
+      self.assertEqual(jf2.cnt, 1)
+
+  def test_unloadable_captures(self):
+    from tinygrad.engine.jit import _jit_state, _prepare_jit_inputs, _jit_key
+    x = Tensor.rand(4, 16).realize()
+    with Context(JITCACHE=1):
+      key = _jit_key(self.fxn, *_prepare_jit_inputs((x,), {})[2:], _jit_state(self.fxn, (x,), {}), (x,), {})
+      # a graph pickled by other code that refers to something which is gone now
+      diskcache_put("jit", key, b"cos\nnot_in_os\n.")
+      jf = TinyJit(self.fxn)
+      np.testing.assert_allclose(jf(x).numpy(), np.maximum(x.numpy() @ self.w.numpy(), 0), atol=1e-5)
+      self.assertEqual(jf.cnt, 1)
+
+  def test_disabled(self):
+    with Context(JITCACHE=0):
+      jf = TinyJit(self.fxn)
+      for _ in range(3): jf(Tensor.rand(4, 16).realize())
+      jf2 = TinyJit(self.fxn)
+      jf2(Tensor.rand(4, 16).realize())
+      self.assertEqual(jf2.cnt, 1)
+
 if __name__ == '__main__':
   unittest.main()
@@ -1678,6 +1678,19 @@ class TestFloat4(unittest.TestCase):
       assert count == expected, f"{count=}, {expected=}"
 
 class TestHandCodedOpts(unittest.TestCase):
+  @unittest.skipUnless(Device[Device.DEFAULT].renderer.has_threads, "test requires threads")
+  def test_threads(self):
+    s = create_schedule([(Tensor.rand(256, 256)@Tensor.rand(256, 256)).lazydata])[-1]
+    with Context(THREADS=6):
+      k = Kernel(s.ast)
+      k.hand_coded_optimizations()
+    assert k.threaded and k.applied_opts[-1] == Opt(OptOps.THREAD, 0, 4) and k.full_shape[0] == 4
+    # small kernels aren't worth the dispatch
+    with Context(THREADS=6):
+      k = Kernel(create_schedule([(Tensor.rand(16, 16)+1).lazydata])[-1].ast)
+      k.hand_coded_optimizations()
+    assert not k.threaded
+
   def test_masked_upcast(self):
     layer_1 = Tensor.cat(*[Tensor.rand(5) for _ in range(4)])
     layer_2 = Tensor.cat(layer_1.unsqueeze(0), Tensor.rand(6, 20))
@@ -2148,6 +2161,23 @@ class TestKernelOpts(unittest.TestCase):
       [Opt(OptOps.PADTO, 0, 32), Opt(OptOps.UPCAST, 0, 8), Opt(OptOps.GROUP, 0, 4)]
     ])
 
+  @unittest.skipUnless(Device[Device.DEFAULT].renderer.has_threads, "test requires threads")
+  def test_thread(self):
+    N = 64
+    Tensor.manual_seed(1552)
+    a = Tensor.rand(N, N)
+    b = Tensor.rand(N, N)
+    helper_linearizer_opt(a@b, [
+      [Opt(OptOps.THREAD, 0, 4)],
+      [Opt(OptOps.THREAD, 1, 8), Opt(OptOps.UPCAST, 1, 4)],
+      [Opt(OptOps.UPCAST, 0, 4), Opt(OptOps.UNROLL, 0, 4), Opt(OptOps.THREAD, 0, 16)],
+    ])
+    # the thread dim can't be moved once it's there
+    with self.assertRaises(KernelOptError):
+      helper_linearizer_opt(a@b, [[Opt(OptOps.THREAD, 0, 4), Opt(OptOps.UPCAST, 0, 4)]])
+    with self.assertRaises(KernelOptError):
+      helper_linearizer_opt(a@b, [[Opt(OptOps.THREAD, 0, 4), Opt(OptOps.THREAD, 1, 4)]])
+
   @unittest.skipUnless(Device[Device.DEFAULT].renderer.has_local, "test requires locals")
   @unittest.skipUnless(Device[Device.DEFAULT].renderer.has_shared, "test requires shared")
   def test_color_shapes_with_local(self):
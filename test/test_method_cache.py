@@ -1,5 +1,8 @@
-import unittest
+import unittest, threading
+import numpy as np
 from tinygrad import Tensor, Device, Variable
+from tinygrad.helpers import Context
+from tinygrad.engine.realize import lower_schedule_pipelined, CompiledRunner
 from examples.gpt2 import Transformer
 from tinygrad.nn.state import get_state_dict
 
@@ -41,6 +44,36 @@ class TestMethodCache(unittest.TestCase):
     Device[Device.DEFAULT].compiler = None
     for i in range(3): model(Tensor([[1,2,3,4]]), Variable("start_pos", 0, 10).bind(i)).realize()
 
+class TestCompileAhead(unittest.TestCase):
+  def test_lower_in_order(self):
+    a = Tensor.rand(16).realize()
+    outs = [(a*1.2345+i).contiguous() for i in range(6)]
+    sched = Tensor.schedule(*outs)
+    outputs = [si.outputs[0] for si in sched]
+    eis = list(lower_schedule_pipelined(sched, 3))
+    self.assertEqual(len(sched), 0)
+    self.assertTrue(all(isinstance(ei.prg, CompiledRunner) for ei in eis))
+    self.assertEqual([ei.bufs[0] for ei in eis], outputs)
+
+  def test_compile_ahead_matches(self):
+    a = Tensor.rand(8, 8).realize()
+    x = a
+    for i in range(5): x = (x @ a.T).relu().contiguous() * 0.0421 + i
+    with Context(COMPILE_AHEAD=4): out = x.numpy()
+    ref = a.numpy()
+    for i in range(5): ref = np.maximum(ref @ a.numpy().T, 0) * 0.0421 + i
+    np.testing.assert_allclose(out, ref, rtol=1e-4)
+
+  def test_pool_reused(self):
+    a = Tensor.rand(16).realize()
+    workers = []
+    for i in range(3):
+      with Context(COMPILE_AHEAD=2): (a*1.5+i*0.25).contiguous().realize()
+      workers.append({t.ident for t in threading.enumerate() if t.name.startswith("compile")})
+    # one pool for the process, not one per run_schedule
+    self.assertTrue(workers[0])
+    self.assertEqual(workers[0], workers[-1])
+
 if __name__ == '__main__':
   unittest.main()
 
@@ -1,8 +1,8 @@
 import unittest, functools, random
-from typing import List
+from typing import List, Optional, Tuple
 from tinygrad import Tensor, Device, nn, GlobalCounters, TinyJit, dtypes
 from tinygrad.ops import MetaOps, ReduceOps, BinaryOps, UOps
-from tinygrad.helpers import CI, getenv, prod, Context
+from tinygrad.helpers import CI, getenv, prod, Context, ALLREDUCE_BUCKET
 from tinygrad.nn.state import get_parameters, get_state_dict
 from tinygrad.engine.schedule import create_schedule
 from tinygrad.engine.realize import lower_schedule, BufferCopy, CompiledRunner
@@ -165,6 +165,19 @@ class TestMultiTensor(unittest.TestCase):
       a,b = _test_allreduce(Tensor.rand(256, 256))
       np.testing.assert_almost_equal(a.numpy(), b.numpy(), decimal=5)
 
+  def test_reduce_scatter_all_gather(self):
+    for ring in [0, 2]:
+      # uneven axes leave the last shards empty
+      for shape, axis, splits in [((8, 3), 0, [2, 2, 2, 2]), ((5, 8), 1, [2, 2, 2, 2]), ((3, 2), 0, [1, 1, 1, 0])]:
+        xs = [np.random.randn(*shape).astype(np.float32) for _ in devices_4]
+        t = MultiLazyBuffer([Tensor(x, device=d).lazydata for x,d in zip(xs, devices_4)], None)
+        with Context(RING=ring):
+          scattered = t.reduce_scatter(ReduceOps.SUM, axis)
+          gathered = scattered.all_gather()
+        self.assertEqual([lb.shape[axis] for lb in scattered.lbs], splits)
+        np.testing.assert_allclose(Tensor(scattered, device=devices_4).numpy(), sum(xs), atol=1e-6, rtol=1e-6)
+        for lb in gathered.lbs: np.testing.assert_allclose(Tensor(lb, device=lb.device).numpy(), sum(xs), atol=1e-6, rtol=1e-6)
+
   def test_copy_jit(self):
     @TinyJit
     def copy_tensor(x:Tensor): return (x.to(f"{x.device.split(':')[0]}:1") + 1)
@@ -360,6 +373,69 @@ class TestMultiTensor(unittest.TestCase):
     # sometimes there is zeros in these grads... why?
     np.testing.assert_allclose(grad, shard_grad, atol=1e-5, rtol=1e-5)
 
+  def test_data_parallel_bucketed_allreduce(self):
+    class Model:
+      def __init__(self): self.l1, self.bn, self.l2 = nn.Linear(16, 32), nn.BatchNorm(32), nn.Linear(32, 4)
+      def __call__(self, x:Tensor) -> Tensor: return self.l2(self.bn(self.l1(x)).relu())
+    def train(bucket:int, devices:Optional[Tuple[str, ...]]=None):
+      Tensor.manual_seed(0)
+      m = Model()
+      opt = nn.optim.SGD(get_parameters(m), lr=0.1, momentum=0.9)
+      X, Y = Tensor.randn(8, 16).realize(), Tensor.randint(8, high=4).realize()
+      if devices is not None:
+        for p in get_parameters(m)+opt.b+[opt.lr]: p.to_(devices)
+        X, Y = X.shard(devices, axis=0), Y.shard(devices, axis=0)
+      @TinyJit
+      def train_step():
+        with Tensor.train():
+          opt.zero_grad()
+          loss = m(X).sparse_categorical_crossentropy(Y).backward()
+          Tensor.realize(loss, *opt.schedule_step())
+      with Context(ALLREDUCE_BUCKET=bucket):
+        for _ in range(3): train_step()
+      return [p.numpy() for p in get_parameters(m)], len([ei for ei in train_step.jit_cache if isinstance(ei.prg, BufferCopy)])
+
+    ref, _ = train(0)
+    copies = {}
+    for bucket in [0, 256, 1 << 20]:
+      params, copies[bucket] = train(bucket, devices_2)
+      for p, r in zip(params, ref): np.testing.assert_allclose(p, r, atol=1e-5, rtol=1e-5)
+    # each bucket of gradients is a single all-reduce
+    self.assertLess(copies[1 << 20], copies[256])
+    self.assertLess(copies[256], copies[0])
+    # bucketing is opt in
+    self.assertEqual(train(ALLREDUCE_BUCKET.value, devices_2)[1], copies[0])
+
+  def test_zero_sharded_optimizer(self):
+    def train(zero:int, opt_fn):
+      Tensor.manual_seed(0)
+      l1, l2 = nn.Linear(16, 32), nn.Linear(32, 4)
+      X, Y = Tensor.randn(8, 16).shard(devices_4, axis=0), Tensor.randint(8, high=4).shard(devices_4, axis=0)
+      with Context(ZERO=zero):
+        for p in get_parameters([l1, l2]): p.to_(devices_4)
+        opt = opt_fn(get_parameters([l1, l2]))
+        @TinyJit
+        def train_step():
+          with Tensor.train():
+            opt.zero_grad()
+            l2(l1(X).relu()).sparse_categorical_crossentropy(Y).backward()
+            Tensor.realize(*opt.schedule_step())
+        for _ in range(3): train_step()
+      return [p.numpy() for p in get_parameters([l1, l2])], opt
+
+    for opt_fn in [lambda p: nn.optim.Adam(p, 0.01), lambda p: nn.optim.SGD(p, 0.1, momentum=0.9),
+                   lambda p: nn.optim.LAMB(p, 0.01, weight_decay=0.1)]:
+      ref, _ = train(0, opt_fn)
+      for zero in [1, 2]:
+        params, opt = train(zero, opt_fn)
+        for p, r in zip(params, ref): np.testing.assert_allclose(p, r, atol=1e-5, rtol=1e-5)
+        # every device only holds a quarter of the optimizer state
+        for st in (opt.m if isinstance(opt, nn.optim.LAMB) else opt.b):
+          self.assertEqual(st.lazydata.axis, 0)
+          self.assertEqual(st.lazydata.lbs[0].shape[0] * 4, st.shape[0])
+        # with ZERO=2 the gradients are reduce-scattered as well
+        self.assertEqual(opt.params[0].grad.lazydata.axis, 0 if zero == 2 else None)
+
   def test_multi_tensor_jit_param(self):
     @TinyJit
     def jf(a, b) -> Tensor:
@@ -5,7 +5,7 @@ import torch
 from tinygrad import Tensor, Device, TinyJit
 from tinygrad.ops import UOps
 from tinygrad.helpers import CI, Context
-from tinygrad.nn import Conv1d, ConvTranspose1d, Conv2d, ConvTranspose2d, Linear, Embedding
+from tinygrad.nn import Conv1d, ConvTranspose1d, Conv2d, ConvTranspose2d, Linear, GGMLLinear, Embedding
 from tinygrad.nn import BatchNorm, LayerNorm, LayerNorm2d, GroupNorm, InstanceNorm, RMSNorm, LSTMCell
 from tinygrad.nn.state import load_state_dict
 from tinygrad.engine.schedule import create_schedule
@@ -132,6 +132,20 @@ class TestNN(unittest.TestCase):
     _test_linear(Tensor.randn(BS, in_dim), in_dim, out_dim)
     _test_linear(Tensor.randn(BS, T, in_dim), in_dim, out_dim) # test with more dims
 
+  def test_ggml_linear(self):
+    in_dim, out_dim = 64, 8
+    # Q8_0 blocks: a float16 scale followed by 32 int8 quants
+    d = np.random.uniform(0.01, 0.1, (out_dim, in_dim//32, 1)).astype(np.float16)
+    q = np.random.randint(-127, 128, (out_dim, in_dim//32, 32)).astype(np.int8)
+    model = GGMLLinear(in_dim, out_dim, ggml_type=8)
+    model.weight = Tensor(np.concatenate([d.view(np.uint8), q.view(np.uint8)], axis=-1)).realize()
+    x = Tensor.randn(1, in_dim).realize()
+    model.bias.realize()
+    # the weight is dequantized inside the matmul kernel
+    self.assertEqual(len([si for si in create_schedule([model(x).lazydata]) if si.ast.op is UOps.SINK]), 1)
+    w = (d.astype(np.float32) * q).reshape(out_dim, in_dim)
+    np.testing.assert_allclose(model(x).numpy(), x.numpy() @ w.T + model.bias.numpy(), atol=1e-4, rtol=1e-4)
+
   def test_conv1d(self):
     BS, C1, W = 4, 16, 224//4
     C2, K, S, P = 64, 7, 2, 1
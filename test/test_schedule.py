@@ -15,7 +15,7 @@ from tinygrad.shape.view import View
 from tinygrad.ops import BinaryOps, MetaOps, UOp, UnaryOps, UOps, graph_rewrite, track_rewrites
 from tinygrad.helpers import CI, DEBUG, FUSE_ARANGE, GlobalCounters, flatten, getenv, SPLIT_REDUCEOP, unwrap, prod, Context
 from tinygrad.codegen.kernel import Kernel, verify_ast
-from tinygrad.engine.schedule import BUF_LIMIT, create_schedule, view_right, st_fixup, view_left
+from tinygrad.engine.schedule import BUF_LIMIT, ScheduleItem, create_schedule, view_right, st_fixup, view_left, schedule_cache
 from tinygrad.engine.realize import CompiledRunner, run_schedule
 from tinygrad.engine.lazy import LazyBuffer, view_supported_devices
 from test.helpers import ast_const, is_dtype_supported, timeit
@@ -1288,7 +1288,7 @@ class TestSchedule(unittest.TestCase):
     a = x.alu(UnaryOps.EXP2).cast(dtypes.int32, True, allow_buffer_view=True)
     b = x.cast(dtypes.int32, True, allow_buffer_view=True)
     b = a.alu(BinaryOps.ADD, b)
-    check_schedule(b, 2) # this should fuse when it makes sense
+    check_schedule(b, 1) # the bitcast of exp2 stays in the kernel computing it
 
   def test_bitcast_disable_subbufer(self):
     x = cast(LazyBuffer, Tensor.empty(1, dtype=dtypes.float32).realize().lazydata)
@@ -1351,6 +1351,77 @@ class TestSchedule(unittest.TestCase):
     constv = Tensor.empty(2, 2).lazydata.const_like(10).contiguous()
     self.assertEqual(len(create_schedule([constv])), 1)
 
+class TestScheduleCache(unittest.TestCase):
+  def test_cache_hit_rebinds_buffers(self):
+    a, b = Tensor.rand(4, 4).realize(), Tensor.rand(4, 4).realize()
+    s1 = create_schedule([(out1:=(a@b).relu().sum(1)).lazydata])
+    c, d = Tensor.rand(4, 4).realize(), Tensor.rand(4, 4).realize()
+    s2 = create_schedule([(out2:=(c@d).relu().sum(1)).lazydata])
+    self.assertEqual([si.ast for si in s1], [si.ast for si in s2])
+    self.assertEqual(s2[-1].outputs[0], out2.lazydata.base.buffer)
+    self.assertIn(c.lazydata.base.buffer, s2[0].inputs)
+    self.assertTrue(out2.lazydata.base.is_realized())
+    run_schedule(s1)
+    run_schedule(s2)
+    np.testing.assert_allclose(out1.numpy(), np.maximum(a.numpy()@b.numpy(), 0).sum(1), atol=1e-5)
+    np.testing.assert_allclose(out2.numpy(), np.maximum(c.numpy()@d.numpy(), 0).sum(1), atol=1e-5)
+
+  def test_cache_miss_on_different_inputs(self):
+    a = Tensor.empty(10).realize()
+    create_schedule([(a+a).lazydata])
+    # same shape, but two different realized inputs is a different graph
+    sched = create_schedule([(a+Tensor.empty(10).realize()).lazydata])
+    self.assertEqual(len(sched[0].bufs), 3)
+
+  def test_cache_miss_on_after(self):
+    def order(after:bool):
+      x, y = Tensor.empty(16).realize(), Tensor.empty(16).realize()
+      r, g = (y+1).contiguous(), (x*2).contiguous()
+      # like an activation recomputed by Tensor.checkpoint, r waits for g
+      if after: r.lazydata.base.after = g.lazydata.base
+      sched = create_schedule([(r+g).lazydata])
+      return [si.outputs[0] for si in sched].index(r.lazydata.base.buffer) > [si.outputs[0] for si in sched].index(g.lazydata.base.buffer)
+    order(False)
+    self.assertTrue(order(True))
+
+  def test_cache_disabled(self):
+    a = Tensor.empty(10).realize()
+    with Context(SCHEDULE_CACHE=0):
+      cache_size = len(schedule_cache)
+      check_schedule(a*2, 1)
+    self.assertEqual(len(schedule_cache), cache_size)
+
+def _peak_live(sched:List[ScheduleItem], keep) -> int:
+  last_use = {b:i for i,si in enumerate(sched) for b in si.bufs}
+  live, peak = 0, 0
+  for i,si in enumerate(sched):
+    live += sum(b.nbytes for b in si.outputs)
+    peak = max(peak, live)
+    live -= sum(b.nbytes for b in si.inputs if last_use[b] == i and b not in keep and any(b in x.outputs for x in sched))
+  return peak
+
+class TestMemoryOrder(unittest.TestCase):
+  def _wide(self, x:Tensor) -> Tensor: return functools.reduce(Tensor.__add__, [(x+i).contiguous().sum(1).contiguous() for i in range(1, 5)])
+
+  def test_lower_peak(self):
+    x = Tensor.rand(256, 256).realize()
+    peaks = []
+    for order in [0, 1]:
+      with Context(MEMORY_ORDER=order): sched = create_schedule([(out:=self._wide(x)).lazydata])
+      self.assertEqual(len(sched), 9)
+      peaks.append(_peak_live(sched, {out.lazydata.base.buffer}))
+      run_schedule(sched)
+      np.testing.assert_allclose(out.numpy(), sum((x.numpy()+i).sum(1) for i in range(1, 5)), rtol=1e-5)
+    # BFS keeps all four branches alive at once, finishing one branch at a time keeps one
+    self.assertLess(peaks[1], peaks[0])
+
+  def test_same_kernels(self):
+    x = Tensor.rand(32, 32).realize()
+    with Context(MEMORY_ORDER=0): s0 = create_schedule([self._wide(x).lazydata])
+    with Context(MEMORY_ORDER=1): s1 = create_schedule([self._wide(x).lazydata])
+    self.assertNotEqual([si.ast for si in s0], [si.ast for si in s1])
+    self.assertEqual(sorted(si.ast.key for si in s0), sorted(si.ast.key for si in s1))
+
 class TestIndexing(unittest.TestCase):
   def check_schedule(self, xt:Union[Tensor,List[Tensor]], cnt:int):
     with Context(FUSE_ARANGE=getenv("FUSE_ARANGE", 1)):
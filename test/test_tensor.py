@@ -2,7 +2,8 @@ import subprocess
 import numpy as np
 import torch
 import unittest, copy, mmap, random, math, array
-from tinygrad import Tensor, Device, dtypes
+from tinygrad import Tensor, Device, dtypes, TinyJit, nn
+from tinygrad.nn.optim import SGD
 from tinygrad.engine.schedule import create_schedule
 from tinygrad.helpers import getenv, temp, CI, _METADATA, mv_address
 from extra.gradcheck import numerical_jacobian, jacobian, gradcheck
@@ -341,6 +342,69 @@ class TestTinygrad(unittest.TestCase):
     z = (t+1)
     np.testing.assert_equal(z.numpy(), [1, 2, 3, 4])
 
+  @unittest.skipUnless(hasattr(Device[Device.DEFAULT].allocator, "can_wrap"), "needs a host device")
+  def test_tensor_numpy_zero_copy(self):
+    arr = np.zeros(64, dtype=np.float32)
+    t = Tensor.from_dlpack(arr)
+    self.assertEqual(t.lazydata.base.realized.options.external_ptr, arr.ctypes.data)
+    arr[:] = 3
+    out = (t+1).numpy()
+    np.testing.assert_equal(out, 4)
+    # the output outlives its tensor and isn't reused by the allocator
+    del t
+    np.testing.assert_equal((Tensor.ones(64).contiguous()*5).numpy(), 5)
+    np.testing.assert_equal(out, 4)
+    # a realized buffer can be written again, so it's copied
+    a = Tensor.zeros(4).contiguous().realize()
+    a_np = a.numpy()
+    a.assign(a+1).realize()
+    np.testing.assert_equal(a_np, 0)
+    # so is the buffer of the tensor numpy() realized, and of another tensor with the same lazybuffer
+    a = Tensor([1., 2, 3])*2
+    a_np = a.numpy()
+    a.assign(a+1).realize()
+    np.testing.assert_equal(a_np, [2, 4, 6])
+    b = Tensor([1., 2, 3]).realize()
+    c = ((b*2)[1:]).contiguous()
+    c_np = (b*2)[1:].numpy()
+    c.realize().assign(c+1).realize()
+    np.testing.assert_equal(c_np, [4, 6])
+
+  def test_tensor_numpy_constructor_copies(self):
+    arr = np.zeros(4, dtype=np.float32)
+    w = Tensor(arr, requires_grad=True)
+    with Tensor.train():
+      w.grad = Tensor.ones(4)
+      SGD([w], lr=1).step()
+      np.testing.assert_equal(arr, 0)
+      np.testing.assert_equal(w.numpy(), -1)
+      before = w.numpy()
+      w.grad = Tensor.ones(4)
+      SGD([w], lr=1).step()
+    np.testing.assert_equal(before, -1)
+
+  @unittest.skipUnless(hasattr(Device[Device.DEFAULT].allocator, "can_wrap"), "needs a host device")
+  def test_dlpack(self):
+    t = Tensor.arange(12).reshape(3, 4).realize()
+    for x in (np.from_dlpack(t), torch.from_dlpack(t)):
+      np.testing.assert_equal(np.asarray(x), t.numpy())
+    # the memory is shared
+    torch.from_dlpack(t)[0, 0] = 100
+    self.assertEqual(t[0, 0].item(), 100)
+    src = torch.arange(24, dtype=torch.float32).reshape(2, 3, 4)
+    for x in (src, src.permute(2, 0, 1), src[:, 1], src.numpy()[::-1, :, ::2], src.numpy() > 5):
+      np.testing.assert_equal(Tensor.from_dlpack(x).numpy(), np.asarray(x))
+    # the producer is kept alive by the tensor
+    t = Tensor.from_dlpack(torch.arange(1 << 16, dtype=torch.float32))
+    self.assertEqual((t*2)[1:4].tolist(), [2, 4, 6])
+    # an export doesn't change the buffer, it holds on to it until it's gone
+    t = Tensor.arange(64).realize()
+    x = np.from_dlpack(t)
+    self.assertIsNone(t.lazydata.base.realized.options)
+    del t
+    np.testing.assert_equal((Tensor.ones(64, dtype=dtypes.int).contiguous()*5).numpy(), 5)
+    np.testing.assert_equal(x, np.arange(64))
+
   def test_tensor_list_dtype(self):
     for arr in ([1], [[[1]]], [[1,1],[1,1]], [[[1,1],[1,1]],[[1,1],[1,1]]]):
       assert Tensor(arr).dtype == dtypes.default_int
@@ -708,6 +772,98 @@ class TestInferenceMode(unittest.TestCase):
       assert W.grad is None
     f(x, m, W)
 
+class TestCheckpoint(unittest.TestCase):
+  def _grads(self, ckpt:bool):
+    Tensor.manual_seed(0)
+    x = Tensor.rand(4, 8, requires_grad=True)
+    w1, w2 = Tensor.rand(8, 8, requires_grad=True), Tensor.rand(8, 8, requires_grad=True)
+    def block(h:Tensor) -> Tensor: return (h @ w1).relu().softmax() @ w2
+    h = x * 2
+    out = (Tensor.checkpoint(block, h) if ckpt else block(h)).sum()
+    out.backward()
+    return out, [t.grad for t in (x, w1, w2)]
+
+  def test_matches_backward(self):
+    out, grads = self._grads(ckpt=False)
+    ckpt_out, ckpt_grads = self._grads(ckpt=True)
+    np.testing.assert_allclose(ckpt_out.numpy(), out.numpy(), rtol=1e-6)
+    for g,cg in zip(grads, ckpt_grads): np.testing.assert_allclose(cg.numpy(), g.numpy(), rtol=1e-5, atol=1e-6)
+
+  def test_recomputes_forward(self):
+    out, grads = self._grads(ckpt=False)
+    ckpt_out, ckpt_grads = self._grads(ckpt=True)
+    sched = create_schedule([t.lazydata for t in (out, *grads)])
+    ckpt_sched = create_schedule([t.lazydata for t in (ckpt_out, *ckpt_grads)])
+    # the forward of block runs again in the backward pass instead of sharing its buffers with it
+    self.assertGreater(len(ckpt_sched), len(sched))
+
+  def test_jit(self):
+    w = Tensor.rand(8, 8, requires_grad=True).realize()
+    @TinyJit
+    def step(x:Tensor) -> Tensor:
+      w.grad = None
+      Tensor.checkpoint(lambda t: (t @ w).relu().exp(), x).sum().backward()
+      return w.grad.realize()
+    for _ in range(3):
+      x = Tensor.rand(4, 8).realize()
+      np.testing.assert_allclose(step(x).numpy(), x.numpy().T @ (np.exp(np.maximum(x.numpy() @ w.numpy(), 0)) * (x.numpy() @ w.numpy() > 0)),
+                                 rtol=1e-5, atol=1e-6)
+
+  def test_no_grad_passthrough(self):
+    x = Tensor([1.0, 2.0])
+    out = Tensor.checkpoint(lambda t: t * 2, x)
+    self.assertIsNone(out._ctx)
+    np.testing.assert_equal(out.numpy(), [2.0, 4.0])
+
+  def test_accumulates_param_grad(self):
+    w = Tensor([1.0, 2.0], requires_grad=True)
+    (Tensor.checkpoint(lambda t: t * w, Tensor([3.0, 4.0])).sum() + (w * 2).sum()).backward()
+    np.testing.assert_allclose(w.grad.numpy(), [5.0, 6.0])
+
+  def _shared_unrealized_closure(self, ckpt:bool):
+    Tensor.manual_seed(0)
+    w = Tensor.rand(8, 8, requires_grad=True)
+    m = Tensor.rand(4, 8) * 3
+    def fn(t:Tensor) -> Tensor: return (t @ w) * m
+    x = Tensor.rand(4, 8)
+    # m is used inside fn and by the gradient flowing into it, it isn't scheduled after that gradient
+    ((Tensor.checkpoint(fn, x) if ckpt else fn(x)) * m).sum().backward()
+    return w.grad.numpy()
+  def test_shared_unrealized_closure(self):
+    np.testing.assert_allclose(self._shared_unrealized_closure(True), self._shared_unrealized_closure(False), rtol=1e-5, atol=1e-6)
+
+  def _closure_with_ctx(self, ckpt:bool):
+    w = Tensor([1.0, 2.0], requires_grad=True)
+    # w2 has its own graph, it's used inside fn and after it
+    w2 = w * 2
+    def fn(t:Tensor) -> Tensor: return t * w2
+    ((Tensor.checkpoint(fn, Tensor([3.0, 4.0])) if ckpt else fn(Tensor([3.0, 4.0]))) * w2).sum().backward()
+    return w.grad.numpy()
+  def test_closure_with_ctx(self): np.testing.assert_allclose(self._closure_with_ctx(True), self._closure_with_ctx(False))
+
+  def test_non_tensor_args(self):
+    w = Tensor([1.0, 2.0], requires_grad=True)
+    x = Tensor([3.0, 4.0], requires_grad=True)
+    Tensor.checkpoint(lambda t, start_pos: (t * w)[start_pos:], x, 1).sum().backward()
+    np.testing.assert_allclose(w.grad.numpy(), [0.0, 4.0])
+    np.testing.assert_allclose(x.grad.numpy(), [0.0, 2.0])
+
+  def _dropout(self, ckpt:bool):
+    Tensor.manual_seed(0)
+    # a realized rng counter is written in place by the next rand
+    Tensor.rand(4).realize()
+    w = Tensor.rand(16, requires_grad=True)
+    def fn(t:Tensor) -> Tensor: return (t * w).dropout(0.5)
+    with Tensor.train():
+      out = nn.checkpoint(fn, Tensor.ones(16)) if ckpt else fn(Tensor.ones(16))
+      out.realize()
+      # draws between the forward and the backward don't change the recomputed mask
+      after = Tensor.rand(4).realize()
+      out.sum().backward()
+      return w.grad.numpy(), after.numpy(), Tensor.rand(4).numpy()
+  def test_dropout(self):
+    for a,b in zip(self._dropout(True), self._dropout(False)): np.testing.assert_allclose(a, b)
+
 class TestTensorMetadata(unittest.TestCase):
   def setUp(self) -> None: _METADATA.set(None)
   def test_matmul(self):
@@ -450,5 +450,37 @@ class TestUPatHelpers(unittest.TestCase):
       test_upat = UPat(UOps.CONST, dtypes.bool)
       self.assertEqual(test_upat.location[0].split("/")[-1], __file__.replace("\\", "/").split("/")[-1])
 
+class TestPythonNumpy(unittest.TestCase):
+  def _compare(self, out:Tensor, exact=False):
+    from tinygrad.runtime.ops_python import PythonProgram, PythonNumpyProgram
+    si = create_schedule([out.lazydata])[-1]
+    for b in si.bufs: b.ensure_allocated()
+    for b in si.inputs: b.copyin(memoryview(np.random.default_rng(0).integers(-8, 8, b.size).astype(_to_np_dtype(b.dtype)).data).cast("B"))
+    p = get_kernel(Device["PYTHON"].renderer, si.ast).to_program()
+    lib = Device["PYTHON"].compiler.compile(p.src)
+    outs = []
+    for prg in (PythonProgram, PythonNumpyProgram):
+      prg(p.function_name, lib)(*[b._buf for b in si.bufs], global_size=tuple(p.global_size or (1,1,1)), local_size=tuple(p.local_size or (1,1,1)))
+      outs.append(np.frombuffer(si.bufs[0].as_buffer(), _to_np_dtype(si.bufs[0].dtype)).copy())
+    if exact: np.testing.assert_equal(outs[0], outs[1])
+    else: np.testing.assert_allclose(outs[0], outs[1], rtol=1e-5, atol=1e-5)
+
+  def test_elementwise(self):
+    a, b = Tensor.empty(4, 9, device="PYTHON"), Tensor.empty(4, 9, device="PYTHON")
+    self._compare(((a*b).exp2() + (a < b).where(a, b.reciprocal())).sqrt())
+  def test_int_div_mod(self):
+    a, b = Tensor.empty(33, dtype=dtypes.int32, device="PYTHON"), Tensor.empty(33, dtype=dtypes.int32, device="PYTHON")
+    b = (b == 0).where(3, b)
+    self._compare(a // b * 100 + (a ^ b) // 3 + a.maximum(b), exact=True)
+  def test_reduce(self):
+    a = Tensor.empty(12, 17, device="PYTHON")
+    self._compare(a.max(1) + a.sum(1))
+  def test_matmul(self):
+    a, b = Tensor.empty(16, 24, device="PYTHON"), Tensor.empty(24, 8, device="PYTHON")
+    self._compare((a @ b).relu())
+  def test_pad_gated(self):
+    a = Tensor.empty(5, 7, device="PYTHON")
+    self._compare(a.pad(((1,2),(3,0)), value=-1.0).cumsum(1))
+
 if __name__ == '__main__':
   unittest.main(verbosity=2)
@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 import unittest
 from unittest.mock import patch
-import os
+import os, ctypes
 from tinygrad import Tensor
-from tinygrad.device import Device, Compiler
-from tinygrad.helpers import diskcache_get, diskcache_put, getenv
+from tinygrad.device import BufferOptions, Device, Compiler, MallocAllocator, _MallocAllocator, _size_class, host_allocator
+from tinygrad.helpers import diskcache_get, diskcache_put, getenv, GlobalCounters
 
 class TestDevice(unittest.TestCase):
   def test_canonicalize(self):
@@ -44,11 +44,139 @@ class TestCompiler(unittest.TestCase):
       assert MockCompiler("disabled_key").compile_cached("123") == str.encode("123")
       assert diskcache_get("disabled_key", "123") is None
 
+  def test_compile_batch(self):
+    diskcache_put("key", "123", None) # clear cache
+    assert MockCompiler("key").compile_batch(["123", "456", "123"]) == [b"123", b"456", b"123"]
+
   def test_device_compile(self):
     getenv.cache_clear()
     with patch.dict(os.environ, {"DISABLE_COMPILER_CACHE": "1"}):
       a = Tensor([0.,1.], device=Device.DEFAULT).realize()
       (a + 1).realize()
 
+@unittest.skipUnless(Device.DEFAULT == "CLANG", "clang only")
+class TestClangBatch(unittest.TestCase):
+  def setUp(self): getenv.cache_clear()
+  def _run(self, prg, val):
+    buf = (ctypes.c_int * 1)()
+    prg(buf)
+    assert buf[0] == val
+
+  def test_batch_one_lib(self):
+    from tinygrad.runtime.ops_clang import ClangCompiler, ClangProgram
+    srcs = [f"void k{i}(int* restrict data0) {{ *data0 = {i}; }}" for i in range(3)]
+    with patch.dict(os.environ, {"DISABLE_COMPILER_CACHE": "1"}):
+      libs = ClangCompiler().compile_batch(srcs)
+    assert libs[0] is libs[1] is libs[2]
+    for i in range(3): self._run(ClangProgram(f"k{i}", libs[i]), i)
+
+  def test_batch_name_clash(self):
+    from tinygrad.runtime.ops_clang import ClangCompiler, ClangProgram
+    srcs = [f"void {n}(int* restrict data0) {{ *data0 = {i}; }}" for i,n in enumerate("kkj", 1)]
+    with patch.dict(os.environ, {"DISABLE_COMPILER_CACHE": "1"}):
+      libs = ClangCompiler().compile_batch(srcs)
+    assert libs[0] is libs[2] and libs[0] != libs[1]
+    for name,lib,val in zip("kkj", libs, [1,2,3]): self._run(ClangProgram(name, lib), val)
+
+  def test_precompile_only_batching(self):
+    from tinygrad.engine.schedule import create_schedule
+    from tinygrad.engine.realize import precompile_schedule
+    from tinygrad.runtime.ops_clang import ClangCompiler
+    from tinygrad.helpers import Context
+    a = Tensor.empty(16).realize()
+    sched = create_schedule([(a*314159).lazydata, (a+271828).lazydata])
+    self.assertEqual(len(precompile_schedule(sched)), 2)
+    # compilers without their own compile_batch and BEAM compile each kernel when it's lowered
+    with patch.object(ClangCompiler, "compile_batch", Compiler.compile_batch): self.assertEqual(precompile_schedule(sched), {})
+    with Context(BEAM=1): self.assertEqual(precompile_schedule(sched), {})
+
+  def test_load_many(self):
+    # the loaded libs don't get mixed up when fd numbers are reused
+    from tinygrad.runtime.ops_clang import ClangCompiler, ClangProgram
+    for i in range(4): self._run(ClangProgram("k", ClangCompiler().compile(f"void k(int* restrict data0) {{ *data0 = {i}; }}")), i)
+
+class TestLRUAllocator(unittest.TestCase):
+  def setUp(self):
+    self.alloc = _MallocAllocator()
+    self.alloc.bucket, self.alloc.split, self.alloc.limit = 8, 1, 0
+    GlobalCounters.reset()
+
+  def test_size_class(self):
+    for sz in [1, 255, 256, 1000, 4097, 100000, 12345678]:
+      self.assertGreaterEqual(c:=_size_class(sz, 8), sz)
+      self.assertEqual(c % 256, 0)
+      if sz > 4096: self.assertLessEqual(c, sz*1.125)
+    self.assertEqual(_size_class(5000, 1), 8192)
+
+  def test_reuse_near_size(self):
+    a = self.alloc.alloc(100000)
+    self.alloc.free(a, 100000)
+    b = self.alloc.alloc(99000)
+    self.assertEqual((GlobalCounters.alloc_hits, GlobalCounters.alloc_misses), (1, 1))
+    self.assertEqual(len(self.alloc.as_buffer(b)), 99000)
+    self.alloc.free(b, 99000)
+
+  def test_split_merge(self):
+    big = self.alloc.alloc(1<<20)
+    self.alloc.free(big, 1<<20)
+    a, b = self.alloc.alloc(1000), self.alloc.alloc(3000)
+    self.assertEqual(GlobalCounters.alloc_misses, 1)
+    self.assertEqual(ctypes.addressof(b) - ctypes.addressof(a), _size_class(1000, 8))
+    self.alloc.copyin(a, memoryview(bytearray([1]*1000)))
+    self.alloc.copyin(b, memoryview(bytearray([2]*3000)))
+    self.assertEqual(bytes(self.alloc.as_buffer(a)), bytes([1]*1000))
+    self.assertGreater(GlobalCounters.fragmentation(), 0.9)
+    self.alloc.free(a, 1000)
+    self.alloc.free(b, 3000)
+    # everything merged back into one idle segment
+    self.assertEqual([x[0] for x in self.alloc.cache[None]], [1<<20])
+    self.assertEqual(len(self.alloc.idle), 1)
+
+  def test_free_cache_split(self):
+    big = self.alloc.alloc(1<<20)
+    self.alloc.free(big, 1<<20)
+    bufs = [(self.alloc.alloc(sz), sz) for sz in [1000, 3000, 5000]]
+    # the segment is in use, nothing can be released
+    self.alloc.free_cache()
+    self.assertEqual(sum(x[0] for x in self.alloc.cache[None]), self.alloc.cached)
+    self.assertGreater(self.alloc.cached, 0)
+    for buf,sz in bufs: self.alloc.free(buf, sz)
+    self.alloc.free_cache()
+    self.assertEqual((self.alloc.cache[None], self.alloc.cached), ([], 0))
+
+  def test_default_limit(self): self.assertEqual(_MallocAllocator().limit, 4<<30)
+
+  def test_limit(self):
+    self.alloc.limit = 7000
+    bufs = [(self.alloc.alloc(sz), sz) for sz in [1024, 2048, 4096]]
+    for buf,sz in bufs: self.alloc.free(buf, sz)
+    self.assertLessEqual(self.alloc.cached, 7000)
+    self.assertEqual([x[0] for x in self.alloc.cache[None]], [2048, 4096])
+    self.alloc.free_cache()
+    self.assertEqual(self.alloc.cached, 0)
+
+class TestHostAllocator(unittest.TestCase):
+  def _roundtrip(self, alloc, sz):
+    buf = alloc._alloc(sz, BufferOptions())
+    self.assertEqual(ctypes.addressof(buf) % alloc.alignment, 0)
+    alloc.copyin(buf, memoryview(data:=bytearray(os.urandom(sz))))
+    self.assertEqual(bytes(alloc.as_buffer(buf)), data)
+
+  def test_aligned(self):
+    for sz in [1, 3, 63, 100, 4097]: self._roundtrip(_MallocAllocator(), sz)
+
+  def test_mmap(self):
+    (alloc:=_MallocAllocator(alignment=4096)).mmap_min = 4096
+    for sz in [4096, 10000, 3<<20]: self._roundtrip(alloc, sz)
+
+  @unittest.skipUnless(os.path.isdir("/sys/devices/system/node/node0"), "needs NUMA sysfs")
+  def test_numa(self):
+    self.assertIs(host_allocator("CLANG"), MallocAllocator)
+    self.assertIsNot(alloc:=host_allocator("CLANG:0"), MallocAllocator)
+    self.assertEqual(alloc.numa_node, 0)
+    alloc.mmap_min = 4096
+    self._roundtrip(alloc, 1<<16)
+    self.assertIs(host_allocator("CLANG:4096"), MallocAllocator)
+
 if __name__ == "__main__":
   unittest.main()
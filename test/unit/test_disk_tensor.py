@@ -1,8 +1,9 @@
-import os, pathlib, tempfile, unittest, tarfile
+import os, json, pathlib, tempfile, unittest, tarfile
 import numpy as np
 from tinygrad import Tensor, Device, dtypes
 from tinygrad.dtype import DType
-from tinygrad.nn.state import safe_load, safe_save, get_state_dict, torch_load, tar_extract
+from tinygrad.nn.state import safe_load, safe_save, get_state_dict, load_state_dict, torch_load, tar_extract, SafeShards
+from tinygrad.runtime.ops_disk import DiskDevice, copyout_batch
 from tinygrad.helpers import Timing, fetch, temp, CI
 from test.helpers import is_dtype_supported
 
@@ -33,6 +34,22 @@ class TestTorchLoad(unittest.TestCase):
   # pytorch tar format
   def test_load_resnet(self): compare_weights_both('https://download.pytorch.org/models/resnet50-19c8e357.pth')
 
+  def test_load_permuted(self):
+    import torch
+    torch_weights = {"t": torch.randn(16, 12).t(), "nhwc": torch.randn(2, 3, 4, 5).permute(0, 2, 3, 1), "one": torch.randn(3, 1, 4).transpose(0, 2),
+                     "bf16": torch.randn(8, 6).to(torch.bfloat16).t()}
+    torch.save(torch_weights, fn:=temp("permuted.pth"))
+    tg_weights = torch_load(fn)
+    for k,v in torch_weights.items():
+      self.assertEqual(tg_weights[k].shape, v.shape)
+      self.assertTrue(tg_weights[k].device.startswith("DISK"))
+      np.testing.assert_equal(tg_weights[k].to(None).float().numpy(), v.float().numpy(), err_msg=k)
+
+    class Model:
+      def __init__(self): self.t, self.nhwc = Tensor.empty(12, 16), Tensor.empty(2, 4, 5, 3)
+    load_state_dict(model:=Model(), tg_weights, strict=False, verbose=False)
+    for k in ["t", "nhwc"]: np.testing.assert_equal(getattr(model, k).numpy(), torch_weights[k].numpy())
+
 test_fn = pathlib.Path(__file__).parents[2] / "weights/LLaMA/7B/consolidated.00.pth"
 #test_size = test_fn.stat().st_size
 test_size = 1024*1024*1024*2
@@ -134,6 +151,64 @@ class TestSafetensors(unittest.TestCase):
       for k in f.keys():
         np.testing.assert_array_equal(f.get_tensor(k).numpy(), state_dict[k].numpy())
 
+  def test_save_load_sharded(self):
+    fn = temp("sharded/model.safetensors")
+    pathlib.Path(fn).parent.mkdir(exist_ok=True)
+    state_dict = {**{f"layer{i}.weight": Tensor.rand(64, 32).realize() for i in range(5)}, "norm": Tensor.rand(32).realize()}
+    self.assertEqual(safe_save(state_dict, fn, max_shard_size=64*32*4*2), index:=fn+".index.json")
+    with open(index) as f: weight_map = json.load(f)["weight_map"]
+    self.assertEqual(sorted(set(weight_map.values())), [f"model-0000{i}-of-00003.safetensors" for i in range(1, 4)])
+    self.assertEqual(weight_map["norm"], "model-00003-of-00003.safetensors")
+    self.assertIsInstance(loaded:=safe_load(index), SafeShards)
+    self.assertEqual(len(loaded), 6)
+    self.assertEqual(list(loaded.keys()), list(state_dict.keys()))
+    # only the shard of the accessed tensor is opened
+    np.testing.assert_equal((lazy:=SafeShards(index))["norm"].numpy(), state_dict["norm"].numpy())
+    self.assertEqual(list(lazy.shards), ["model-00003-of-00003.safetensors"])
+    for k,v in state_dict.items(): np.testing.assert_equal(loaded[k].numpy(), v.numpy())
+    del loaded["norm"]
+    self.assertNotIn("norm", loaded)
+    self.assertEqual(safe_save(state_dict, temp("unsharded.safetensors"), max_shard_size=1<<30), temp("unsharded.safetensors"))
+
+  def test_load_state_dict_from_disk(self):
+    class Model:
+      def __init__(self, dtype):
+        self.a, self.b = Tensor.zeros(3, 5, dtype=dtype).contiguous(), Tensor.zeros(700, 9).contiguous()
+        self.c = Tensor.zeros(1, dtype=dtype).contiguous()
+    state_dict = {"a": Tensor.rand(3, 5).cast(dtypes.half), "b": Tensor.rand(700, 9), "c": Tensor([7], dtype=dtypes.half)}
+    safe_save(state_dict, temp("batched.safetensors"))
+    load_state_dict(model:=Model(dtypes.half), safe_load(temp("batched.safetensors")), verbose=False)
+    for k,v in state_dict.items(): np.testing.assert_equal(getattr(model, k).numpy(), v.numpy())
+
+  def test_load_state_dict_sharded_from_disk(self):
+    devices = tuple(f"{Device.DEFAULT}:{i}" for i in range(4))
+    state_dict = {"a": Tensor.rand(64, 48), "b": Tensor.rand(10, 30), "c": Tensor.rand(6), "d": Tensor.rand(4, 6, 8)}
+    safe_save(state_dict, temp("sharded_load.safetensors"))
+    model = {"a": Tensor.empty(64, 48).shard(devices, 0), "b": Tensor.empty(10, 30).shard(devices, 1), "c": Tensor.empty(6).shard(devices),
+             "d": Tensor.empty(6, 8, 4).shard(devices, 1)}
+    disk = safe_load(temp("sharded_load.safetensors"))
+    disk["d"] = disk["d"].permute(1, 2, 0)
+    load_state_dict(model, disk, verbose=False)
+    for k,v in model.items():
+      # each device only got its slice of the file
+      self.assertTrue(all(lb.base.realized is not None and lb.base.buffer.size == lb.size for lb in v.lazydata.lbs if lb.size))
+      np.testing.assert_equal(v.numpy(), disk[k].numpy())
+
+  def test_copyout_batch_segments(self):
+    data = np.random.randint(0, 255, 50000, dtype=np.uint8)
+    with open(temp("segments.bin"), "wb") as f: f.write(data.tobytes())
+    t = Tensor.empty(50000, dtype=dtypes.uint8, device=f"disk:{temp('segments.bin')}")
+    ranges = [(0, 10), (5, 30000), (4095, 4097), (30000, 50000), (49999, 50000)]
+    base = t.lazydata.base.buffer.ensure_allocated()
+    bufs = [base.view(en-st, dtypes.uint8, st).ensure_allocated() for st,en in ranges]
+    if not hasattr(DiskDevice, "io_uring"): self.skipTest("needs io_uring")
+    outs = [np.zeros(en-st, dtype=np.uint8) for st,en in ranges]
+    def sink(out):
+      def fxn(off, mv): out[off:off+len(mv)] = np.frombuffer(mv, dtype=np.uint8)
+      return fxn
+    copyout_batch([(b._buf, sink(o)) for b,o in zip(bufs, outs)], seg_len=8192, depth=2)
+    for (st,en),o in zip(ranges, outs): np.testing.assert_equal(o, data[st:en])
+
   def test_huggingface_enet_safetensors(self):
     # test a real file
     fn = fetch("https://huggingface.co/timm/mobilenetv3_small_075.lamb_in1k/resolve/main/model.safetensors")
@@ -262,6 +337,39 @@ class TestDiskTensor(unittest.TestCase):
     helper_test_disk_tensor("dt_assign_slice_1", [0,1,2,3], lambda x: assign(x, slice(0,2), [13, 12]))
     helper_test_disk_tensor("dt_assign_slice_2", [[0,1,2,3],[4,5,6,7]], lambda x: assign(x, slice(0,1), [[13, 12, 11, 10]]))
 
+  def test_assign_async(self):
+    (fn:=pathlib.Path(temp("dt_assign_async"))).unlink(missing_ok=True)
+    t = Tensor.empty(3, 100000, device=f"disk:{fn}")
+    srcs = [Tensor.rand(100000, device="CLANG").realize() for _ in range(3)]
+    expected = np.stack([x.numpy() for x in srcs])
+    for i,x in enumerate(srcs): t[i].assign(x)
+    # the writes can still be in flight, the freed sources must not be reused
+    del srcs, x
+    Tensor.zeros(3, 100000, device="CLANG").contiguous().realize()
+    Device[t.device].synchronize()
+    np.testing.assert_equal(np.fromfile(fn, dtype=np.float32).reshape(3, 100000), expected)
+    np.testing.assert_equal(t.numpy(), expected)
+
+  def test_assign_source_changes(self):
+    (fn:=pathlib.Path(temp("dt_assign_source_changes"))).unlink(missing_ok=True)
+    t = Tensor.empty(1000000, device=f"disk:{fn}")
+    w = Tensor.ones(1000000, device="CLANG").contiguous().realize()
+    t.assign(w)
+    # the source changes before the file is synchronized, like a weight stepped by the optimizer after a checkpoint
+    w.assign(w * 3).realize()
+    self.assertIsNone(w.lazydata.base.realized.options)
+    Device[t.device].synchronize()
+    np.testing.assert_equal(np.fromfile(fn, dtype=np.float32), 1)
+
+  def test_write_segments(self):
+    (fn:=pathlib.Path(temp("dt_write_segments"))).unlink(missing_ok=True)
+    t = Tensor.empty(50000, dtype=dtypes.uint8, device=f"disk:{fn}")
+    t.lazydata.base.buffer.ensure_allocated()
+    data = np.random.randint(0, 255, 40000, dtype=np.uint8)
+    Device[t.device]._write(7, memoryview(bytearray(data.tobytes())), seg_len=4096, depth=2)
+    Device[t.device].synchronize()
+    np.testing.assert_equal(np.fromfile(fn, dtype=np.uint8)[7:40007], data)
+
   def test_reshape(self):
     helper_test_disk_tensor("dt_reshape_1", [1,2,3,4,5], lambda x: x.reshape((1,5)))
     helper_test_disk_tensor("dt_reshape_2", [1,2,3,4], lambda x: x.reshape((2,2)))
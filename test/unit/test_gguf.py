@@ -1,7 +1,10 @@
 import os, unittest, ctypes
 from tinygrad import dtypes, Tensor, fetch, Device
 import numpy as np
+from tinygrad.nn import GGMLLinear
 from tinygrad.nn.state import ggml_data_to_tensor, gguf_load
+from tinygrad.engine.schedule import create_schedule
+from tinygrad.ops import UOps
 from test.helpers import is_dtype_supported
 try:
   import ggml
@@ -59,6 +62,11 @@ class TestGGUF(unittest.TestCase):
   def test_dequantization_q8_0(self): self._test_dequantization(ggml.GGML_TYPE_Q8_0)
   def test_dequantization_q6_k(self): self._test_dequantization(ggml.GGML_TYPE_Q6_K)
 
+  def test_ggml_linear_q4_0(self): self._test_ggml_linear(ggml.GGML_TYPE_Q4_0)
+  def test_ggml_linear_q4_1(self): self._test_ggml_linear(ggml.GGML_TYPE_Q4_1)
+  def test_ggml_linear_q8_0(self): self._test_ggml_linear(ggml.GGML_TYPE_Q8_0)
+  def test_ggml_linear_q6_k(self): self._test_ggml_linear(ggml.GGML_TYPE_Q6_K)
+
   def test_expected_failure_unknown_type(self):
     with self.assertRaises(ValueError):
       ggml_data_to_tensor(Tensor.empty(512, dtype=dtypes.uint8), 256, 1337)
@@ -78,6 +86,24 @@ class TestGGUF(unittest.TestCase):
 
     np.testing.assert_equal(dq_tensor.numpy(), np.frombuffer(c_dq_data, dtype=np.float32))
 
+  def _test_ggml_linear(self, ttype: int):
+    type_traits = ggml.ggml_internal_get_type_traits(ttype)
+    out_features, in_features = 8, 2 * type_traits.blck_size
+    n_el, n_bytes = out_features * in_features, out_features * in_features // type_traits.blck_size * type_traits.type_size
+
+    data_in = (np.random.random((n_el,)).astype(np.float32) * 100 - 50).ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+    c_q_data, c_dq_data = (ctypes.c_char * n_bytes)(0), (ctypes.c_float * n_el)(0)
+    type_traits.from_float(data_in, c_q_data, n_el)
+    type_traits.to_float(c_q_data, c_dq_data, n_el)
+
+    lin = GGMLLinear(in_features, out_features, bias=False, ggml_type=ttype)
+    lin.weight = Tensor(np.frombuffer(c_q_data, dtype=np.uint8, count=n_bytes)).reshape(lin.weight.shape).realize()
+    x = Tensor.randn(1, in_features).realize()
+    # the dequantization is fused into the matmul
+    self.assertEqual(len([si for si in create_schedule([lin(x).lazydata]) if si.ast.op is UOps.SINK]), 1)
+    np.testing.assert_allclose(lin(x).numpy(), x.numpy() @ np.frombuffer(c_dq_data, dtype=np.float32).reshape(out_features, in_features).T,
+                               atol=1e-3, rtol=1e-4)
+
   def _test_gguf_load(self, url: str):
     fp = fetch(url)
     model_size = os.stat(fp).st_size
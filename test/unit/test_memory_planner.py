@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+import unittest
+import json, tempfile, atexit
+from unittest.mock import patch
+from tinygrad import Device, dtypes, Tensor
+from tinygrad.device import Buffer, MemProfiler, mem_profiler
+from tinygrad.helpers import Context
+from tinygrad.engine.memory import _plan_arena, _internal_memory_planner, ARENA_ALIGN
+
+def _overlaps(a, b): return a[0] < b[1] and b[0] < a[1]
+
+class TestArenaPlanner(unittest.TestCase):
+  def test_no_overlap(self):
+    # (first use, last use, size)
+    lifetimes = [(0, 2, 1000), (1, 3, 4000), (2, 5, 300), (4, 6, 5000), (5, 7, 100), (0, 7, 64), (3, 4, 2500)]
+    reqs = [(st, en, Buffer(Device.DEFAULT, sz, dtypes.uint8)) for st,en,sz in lifetimes]
+    offsets, peak = _plan_arena(reqs)
+    for i,(st,en,buf) in enumerate(reqs):
+      self.assertEqual(offsets[buf] % ARENA_ALIGN, 0)
+      self.assertLessEqual(offsets[buf]+buf.nbytes, peak)
+      for st2,en2,buf2 in reqs[i+1:]:
+        if st <= en2 and st2 <= en:
+          self.assertFalse(_overlaps((offsets[buf], offsets[buf]+buf.nbytes), (offsets[buf2], offsets[buf2]+buf2.nbytes)), f"{buf} {buf2}")
+    self.assertLess(peak, sum(ARENA_ALIGN*((sz+ARENA_ALIGN-1)//ARENA_ALIGN) for _,_,sz in lifetimes))
+
+  def test_disjoint_lifetimes_share(self):
+    reqs = [(i, i, Buffer(Device.DEFAULT, 1024, dtypes.float32)) for i in range(4)]
+    offsets, peak = _plan_arena(reqs)
+    self.assertEqual(set(offsets.values()), {0})
+    self.assertEqual(peak, 4096)
+
+  @unittest.skipUnless(hasattr(Device[Device.DEFAULT].allocator, "offset"), "arena needs offset")
+  def test_planner_uses_arena(self):
+    bufs = [Buffer(Device.DEFAULT, 256, dt) for dt in (dtypes.float32, dtypes.int32, dtypes.float16, dtypes.float32)]
+    assigned = _internal_memory_planner([[bufs[0], bufs[1]], [bufs[1], bufs[2]], [bufs[2], bufs[3]]])
+    self.assertEqual(len(set(assigned[b].base for b in bufs)), 1)
+    for b in bufs: self.assertEqual((assigned[b].size, assigned[b].dtype), (b.size, b.dtype))
+    # bufs[0] and bufs[3] are never alive together
+    self.assertEqual(assigned[bufs[0]].offset, assigned[bufs[3]].offset)
+
+class TestMemProfiler(unittest.TestCase):
+  def test_record(self):
+    st = len(mem_profiler.events)
+    with Context(MEMPROFILE=1):
+      a = Tensor.ones(256, 256).contiguous().realize()
+      b = ((a + 1) * 2).sum(0).realize()
+      del a
+    evs = mem_profiler.events[st:]
+    allocs = [e for e in evs if e.alloc and e.device == Device.DEFAULT]
+    self.assertTrue(any(e.nbytes == 256*256*4 and any(m.name == "contiguous" for m in e.metadata) for e in allocs))
+    self.assertTrue(any(not e.alloc and e.nbytes == 256*256*4 for e in evs))
+    peak, _, live = mem_profiler.peak()[Device.DEFAULT]
+    self.assertGreaterEqual(peak, 256*256*4 + 256*4)
+    self.assertEqual(peak, sum(e.nbytes for e in live if e.base is None))
+    with tempfile.NamedTemporaryFile(suffix=".json") as f:
+      mem_profiler.save(f.name)
+      trace = json.load(open(f.name))["traceEvents"]
+    self.assertTrue(any(e["ph"] == "C" for e in trace))
+    self.assertEqual(len([e for e in trace if e["ph"] == "b"]), len([e for e in mem_profiler.events if e.alloc]))
+    del b
+
+  def test_max_events(self):
+    def run(prof:MemProfiler):
+      bufs = [Buffer("CLANG", 100*(i+1), dtypes.uint8) for i in range(5)]
+      with patch.object(atexit, "register"):
+        for i,alloc in [(0,1), (1,1), (2,1), (0,0), (1,0), (3,1), (2,0), (3,0), (4,1)]: prof.record(bufs[i], bool(alloc))
+      return prof.peak()["CLANG"], prof.used["CLANG"]
+    (peak, _, _), used = run(capped:=MemProfiler(max_events=4))
+    self.assertLessEqual(len(capped.events), 4)
+    # the peak of 3 and 2 alive is still counted after its events are dropped
+    self.assertEqual((peak, used), (700, 500))
+    self.assertEqual(run(MemProfiler())[0][0], 700)
+    self.assertEqual([e.nbytes for e in run(MemProfiler(max_events=8))[0][2]], [400, 300])
+
+if __name__ == '__main__':
+  unittest.main()
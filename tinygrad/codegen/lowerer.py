@@ -77,6 +77,8 @@ def get_index(ast:UOp, opts:Renderer) -> IndexContext:
     # all loops are RANGES
     idxs = [UOp(UOps.RANGE, dtypes.int, (UOp.const(dtypes.int, 0), variable_to_uop(g)), (i, False))
                   for i,g in enumerate(full_shape[:first_reduce])]
+    # the runtime runs each index of the thread dim on its own core
+    if ki.threaded: idxs[0] = UOp(UOps.SPECIAL, dtypes.int, (), ("core0", full_shape[0]))
 
   # reduce loops
   idxs += [UOp(UOps.RANGE, dtypes.int, (UOp.const(dtypes.int, 0), variable_to_uop(g)), (i, True))
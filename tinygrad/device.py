@@ -1,9 +1,11 @@
 from __future__ import annotations
 from dataclasses import dataclass, replace
 from collections import defaultdict
-from typing import Optional, Dict, Tuple, Any, Iterator
-import multiprocessing, importlib, inspect, functools, pathlib, os, ctypes, contextlib
-from tinygrad.helpers import getenv, diskcache_get, diskcache_put, DEBUG, GlobalCounters, flat_mv, from_mv
+from typing import Optional, Dict, DefaultDict, Tuple, Any, Iterator, List
+import multiprocessing, importlib, inspect, functools, pathlib, os, ctypes, contextlib, bisect, itertools, mmap, platform, sys, weakref
+import contextvars, time, atexit, json
+from tinygrad.helpers import getenv, diskcache_get, diskcache_put, DEBUG, GlobalCounters, flat_mv, from_mv, round_up, memsize_to_str
+from tinygrad.helpers import MEMPROFILE, MEMPROFILEPATH, AMX, Metadata, _METADATA
 from tinygrad.dtype import DType, ImageDType, PtrDType
 from tinygrad.renderer import Renderer
 
@@ -89,7 +91,8 @@ class Buffer:
       self._buf: Any = self.allocator.offset(self.base._buf, self.nbytes, self.offset)
     else:
       self._buf = opaque if opaque is not None else self.allocator.alloc(self.nbytes, self.options)
-      if not self.device.startswith("DISK"): GlobalCounters.mem_used += self.nbytes
+      if not self.device.startswith("DISK") and (self.options is None or self.options.external_ptr is None): GlobalCounters.mem_used += self.nbytes
+    if MEMPROFILE and not self.device.startswith("DISK"): mem_profiler.record(self, True)
     return self
   def __reduce__(self):
     buf = None
@@ -104,6 +107,7 @@ class Buffer:
   def nbytes(self): return self.size*self.dtype.itemsize
   def __del__(self):
     if not hasattr(self, '_buf'): return
+    if MEMPROFILE and not self.device.startswith("DISK"): mem_profiler.record(self, False)
     if self._base is None and (self.options is None or self.options.external_ptr is None):
       if not self.device.startswith("DISK"): GlobalCounters.mem_used -= self.nbytes
       self.allocator.free(self._buf, self.nbytes, self.options)
@@ -134,6 +138,99 @@ class Buffer:
     if self._base is not None: return Buffer(self.device, size, dtype, base=self._base, offset=self.offset+offset)
     return Buffer(self.device, size, dtype, base=self, offset=offset)
 
+# **************** memory profiler ****************
+
+@dataclass(frozen=True)
+class MemEvent:
+  ts: float                        # seconds since the profiler started
+  alloc: bool
+  device: str
+  nbytes: int
+  key: int
+  base: Optional[int]              # key of the base for views, they don't add to the footprint
+  planned: bool                    # the memory planner put this buffer into the memory of another one, or it is a planner arena
+  metadata: Tuple[Metadata, ...]   # the ops that allocated it
+
+class MemProfiler:
+  """
+  Records every Buffer alloc/free with MEMPROFILE=1 and writes a chrome trace to MEMPROFILEPATH plus a peak summary at exit.
+  Only the last `max_events` (MEMPROFILE_EVENTS) events are kept, the older half is dropped when there are more. The footprint and the peak
+  still count all of them, but the buffers alive at the peak are only known while it's in the kept events.
+  """
+  def __init__(self, max_events:int=getenv("MEMPROFILE_EVENTS", 1<<20)):
+    self.events: List[MemEvent] = []
+    self.max_events = max_events
+    self.live: Dict[int, MemEvent] = {}
+    # the buffers alive before the first kept event, and the peak footprint over all events with when it happened
+    self.base_live: Dict[int, MemEvent] = {}
+    self.top: Dict[str, Tuple[int, float]] = {}
+    self.used: DefaultDict[str, int] = defaultdict(int)
+    self.planned: weakref.WeakSet[Buffer] = weakref.WeakSet()
+    self.owner: contextvars.ContextVar[Optional[Tuple[Metadata, ...]]] = contextvars.ContextVar("owner", default=None)
+    self.st = time.perf_counter()
+  @contextlib.contextmanager
+  def owning(self, metadata:Optional[Tuple[Metadata, ...]]):
+    token = self.owner.set(metadata)
+    try: yield
+    finally: self.owner.reset(token)
+  def record(self, buf:Buffer, alloc:bool):
+    if not self.events: atexit.register(self.save)
+    if alloc:
+      md = self.owner.get() or ((m,) if (m:=_METADATA.get()) is not None else ())
+      self.live[id(buf)] = ev = MemEvent(time.perf_counter()-self.st, True, buf.device, buf.nbytes, id(buf),
+                                         None if buf._base is None else id(buf._base), buf in self.planned, md)
+    elif (ev:=self.live.pop(id(buf), None)) is not None: ev = replace(ev, ts=time.perf_counter()-self.st, alloc=False)
+    else: return
+    self.events.append(ev)
+    if ev.base is None:
+      self.used[ev.device] += ev.nbytes if ev.alloc else -ev.nbytes
+      if self.used[ev.device] > self.top.get(ev.device, (0, 0.0))[0]: self.top[ev.device] = (self.used[ev.device], ev.ts)
+    if len(self.events) > self.max_events:
+      for e in self.events[:(drop:=len(self.events)-self.max_events//2)]:
+        if e.alloc: self.base_live[e.key] = e
+        else: self.base_live.pop(e.key, None)
+      del self.events[:drop]
+
+  def peak(self) -> Dict[str, Tuple[int, float, List[MemEvent]]]:
+    """for every device, the peak footprint in bytes, when it happened and the buffers alive at that point"""
+    ret = {}
+    for device,(peak,ts) in self.top.items():
+      live = {k:e for k,e in self.base_live.items() if e.device == device}
+      used, found = sum(e.nbytes for e in live.values() if e.base is None), False
+      for e in self.events:
+        if e.device != device: continue
+        if e.alloc: live[e.key] = e
+        else: live.pop(e.key, None)
+        if e.base is None: used += e.nbytes if e.alloc else -e.nbytes
+        if (found:=used == peak and e.ts == ts): break
+      ret[device] = (peak, ts, sorted(live.values(), key=lambda e: -e.nbytes) if found else [])
+    return ret
+
+  def to_trace(self) -> List[Dict]:
+    pids = {d:i for i,d in enumerate(dict.fromkeys(e.device for e in itertools.chain(self.base_live.values(), self.events)))}
+    ret: List[Dict] = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": d}} for d,pid in pids.items()]
+    used: DefaultDict[str, int] = defaultdict(int)
+    for e in itertools.chain(self.base_live.values(), self.events):
+      name = "arena" if e.planned and e.base is None else (", ".join(str(m) for m in e.metadata) or "unknown")
+      ret.append({"name": name, "cat": "view" if e.base is not None else "buffer", "ph": "b" if e.alloc else "e", "id": e.key, "pid": pids[e.device],
+                  "ts": e.ts*1e6, "args": {"nbytes": e.nbytes, "planned": e.planned, "owner": [repr(m) for m in e.metadata]}})
+      if e.base is None:
+        used[e.device] += e.nbytes if e.alloc else -e.nbytes
+        ret.append({"name": "memory", "ph": "C", "pid": pids[e.device], "ts": e.ts*1e6, "args": {"bytes": used[e.device]}})
+    return ret
+
+  def save(self, fn:Optional[str]=None, top:int=10):
+    with open(fn or MEMPROFILEPATH.value, "w") as f: json.dump({"traceEvents": self.to_trace()}, f)
+    for device,(peak,ts,live) in self.peak().items():
+      print(f"peak memory on {device}: {memsize_to_str(peak)} at {ts:.3f}s, {len(live)} buffers alive")
+      for e in live[:top]:
+        kind = "view" if e.base is not None else "arena" if e.planned else "buf"
+        print(f"  {memsize_to_str(e.nbytes):>10s} {kind:5s}{' planned' if e.planned and e.base is not None else '':8s} "
+              f"{', '.join(repr(m) for m in e.metadata) or 'unknown'}")
+    print(f"Saved memory profile to {fn or MEMPROFILEPATH.value}. Use https://ui.perfetto.dev/ to open it.")
+
+mem_profiler = MemProfiler()
+
 # TODO: size, dest, src are the same type. can we enforce this?
 class Allocator:
   def alloc(self, size:int, options:Optional[BufferOptions]=None):
@@ -145,29 +242,129 @@ class Allocator:
   def copyin(self, dest, src:memoryview): raise NotImplementedError("need copyin")
   def copyout(self, dest:memoryview, src): raise NotImplementedError("need copyout")
 
+def _size_class(size:int, steps:int) -> int:
+  # round up to one of `steps` classes between neighbouring powers of two, keeping every class 256 byte aligned
+  return round_up(size, max(256, (1 << (size-1).bit_length()) // (2*steps)))
+
+@dataclass(eq=False)
+class _Block:
+  seg: Any
+  offset: int
+  size: int
+  options: Optional[BufferOptions]
+  uid: int
+  prev: Optional[_Block] = None
+  next: Optional[_Block] = None
+  free: bool = False
+
 class LRUAllocator(Allocator):  # pylint: disable=abstract-method
   """
   The LRU Allocator is responsible for caching buffers.
   It ensures that buffers are not freed until it is absolutely necessary, optimizing performance.
+
+  If the allocator supports `offset`, sizes are rounded up to LRU_BUCKET classes per power of two (0 for exact sizes) and cached blocks are
+  split to serve smaller requests and merged again when freed (LRU_SPLIT). LRU_LIMIT caps the idle bytes at 4 GB by default (0 for no cap),
+  the least recently freed segments are released first. A segment is released once all blocks split from it are freed and merged back.
   """
-  def __init__(self): self.cache: Dict[Tuple[int, Optional[BufferOptions]], Any] = defaultdict(list)
+  def __init__(self):
+    self.bucket, self.split, self.limit = getenv("LRU_BUCKET", 8), getenv("LRU_SPLIT", 1), getenv("LRU_LIMIT", 4<<30)
+    self.cache: DefaultDict[Optional[BufferOptions], List[Tuple[int, int, _Block]]] = defaultdict(list)
+    self.idle: Dict[_Block, None] = {}   # unsplit free segments, least recently freed first
+    self.live: Dict[int, Tuple[Any, _Block]] = {}
+    self.cached, self.uids = 0, itertools.count()
+  def _take(self, blk:_Block):
+    del (pool:=self.cache[blk.options])[bisect.bisect_left(pool, (blk.size, blk.uid))]
+    self.idle.pop(blk, None)
+    blk.free, self.cached, GlobalCounters.mem_cached = False, self.cached-blk.size, GlobalCounters.mem_cached-blk.size
+  def _put(self, blk:_Block):
+    bisect.insort(self.cache[blk.options], (blk.size, blk.uid, blk))
+    if blk.prev is None and blk.next is None: self.idle[blk] = None
+    blk.free, self.cached, GlobalCounters.mem_cached = True, self.cached+blk.size, GlobalCounters.mem_cached+blk.size
+  def _release(self, blk:_Block):
+    self._take(blk)
+    GlobalCounters.mem_reserved -= blk.size
+    super().free(blk.seg, blk.size, blk.options)
   def alloc(self, size:int, options:Optional[BufferOptions]=None):
-    if len(c := self.cache[(size, options)]): return c.pop()
-    try: return super().alloc(size, options)
-    except (RuntimeError, MemoryError):
-      self.free_cache()
-      return super().alloc(size, options)
+    if not getenv("LRU", 1) or (options is not None and (options.nolru or options.external_ptr is not None)): return super().alloc(size, options)
+    bucketed = self.bucket > 0 and hasattr(self, "offset") and (options is None or options.image is None)
+    split, csize = bucketed and self.split, _size_class(size, self.bucket) if bucketed else size
+    pool = self.cache[options]
+    if (i:=bisect.bisect_left(pool, (csize,))) < len(pool) and (split or pool[i][0] == csize):
+      GlobalCounters.alloc_hits += 1
+      self._take(blk:=pool[i][2])
+      if split and blk.size > csize:
+        rest = _Block(blk.seg, blk.offset+csize, blk.size-csize, options, next(self.uids), prev=blk, next=blk.next)
+        if blk.next is not None: blk.next.prev = rest
+        blk.next, blk.size = rest, csize
+        self._put(rest)
+    else:
+      GlobalCounters.alloc_misses += 1
+      try: seg = super().alloc(csize, options)
+      except (RuntimeError, MemoryError):
+        self.free_cache()
+        seg = super().alloc(csize, options)
+      blk, GlobalCounters.mem_reserved = _Block(seg, 0, csize, options, next(self.uids)), GlobalCounters.mem_reserved+csize
+    ret = blk.seg if blk.offset == 0 and blk.size == size and blk.next is None else getattr(self, "offset")(blk.seg, size, blk.offset)
+    self.live[id(ret)] = (ret, blk)
+    GlobalCounters.mem_allocated += size
+    return ret
   def free_cache(self):
-    for (sz,options),opaques in self.cache.items():
-      for opaque in opaques: super().free(opaque, sz, options)
-      opaques.clear()
+    for blk in list(self.idle): self._release(blk)
   def free(self, opaque:Any, size:int, options:Optional[BufferOptions]=None):
-    if getenv("LRU", 1) and (options is None or not options.nolru): self.cache[(size, options)].append(opaque)
-    else: super().free(opaque, size, options)
+    if (ent:=self.live.pop(id(opaque), None)) is None: return super().free(opaque, size, options)
+    GlobalCounters.mem_allocated -= size
+    ret, blk = ent
+    if options is not None and options.nolru:
+      # it might still be referenced through a zero copy view, so it is only reused once the opaque is gone
+      if ret is not blk.seg:
+        if not sys.is_finalizing(): weakref.finalize(ret, self._return, blk)
+      else:
+        GlobalCounters.mem_reserved -= blk.size
+        super().free(blk.seg, blk.size, blk.options)
+    else: self._return(blk)
+  def _return(self, blk:_Block):
+    if (prv:=blk.prev) is not None and prv.free:
+      self._take(prv)
+      prv.size, prv.next = prv.size+blk.size, blk.next
+      if blk.next is not None: blk.next.prev = prv
+      blk = prv
+    if (nxt:=blk.next) is not None and nxt.free:
+      self._take(nxt)
+      blk.size, blk.next = blk.size+nxt.size, nxt.next
+      if nxt.next is not None: nxt.next.prev = blk
+    self._put(blk)
+    while self.limit and self.cached > self.limit and self.idle: self._release(next(iter(self.idle)))
+
+SYS_MBIND = {"x86_64": 237, "AMD64": 237, "aarch64": 235, "arm64": 235}
 
 class _MallocAllocator(LRUAllocator):
+  """
+  Host memory for the CPU backends. Every buffer is aligned to `alignment` bytes (renderers may rely on this for vector loads).
+  Blocks of HOST_MMAP bytes or more are mmapped, advised to use huge pages and bound to `numa_node` if there is one.
+  """
+  def __init__(self, numa_node:Optional[int]=None, alignment:int=64):
+    self.numa_node, self.alignment, self.mmap_min = numa_node, alignment, getenv("HOST_MMAP", 2<<20)
+    super().__init__()
   def _alloc(self, size:int, options:BufferOptions):
-    return (ctypes.c_uint8 * size).from_address(options.external_ptr) if options.external_ptr else (ctypes.c_uint8 * size)()
+    if options.external_ptr: return (ctypes.c_uint8 * size).from_address(options.external_ptr)
+    if size >= self.mmap_min:
+      mem = mmap.mmap(-1, size) if os.name == "nt" else mmap.mmap(-1, size, mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+      if hasattr(mmap, "MADV_HUGEPAGE"): mem.madvise(mmap.MADV_HUGEPAGE)
+      ret = (ctypes.c_uint8 * size).from_buffer(mem)
+      if self.numa_node is not None: self._mbind(ctypes.addressof(ret), size)
+      return ret
+    raw = (ctypes.c_uint8 * (size + self.alignment - 1))()
+    return (ctypes.c_uint8 * size).from_buffer(raw, -ctypes.addressof(raw) % self.alignment)
+  def _mbind(self, addr:int, size:int):
+    # MPOL_BIND before the first touch, so every page lands on the node
+    nodemask = (ctypes.c_ulong * (self.numa_node//64 + 1))()
+    nodemask[-1] = 1 << (self.numa_node%64)
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(SYS_MBIND[platform.machine()], ctypes.c_void_p(addr), ctypes.c_ulong(size), 2, nodemask, ctypes.c_ulong(len(nodemask)*64+1), 0):
+      if DEBUG >= 1: print(f"mbind to node {self.numa_node} failed: {os.strerror(ctypes.get_errno())}")
+  def can_wrap(self, ptr:int, dtype:DType) -> bool:
+    # outside memory can be used in place if it's aligned for the widest vector loads of the CPU renderers
+    return ptr % ((16 if AMX else 4) * dtype.itemsize) == 0
   def as_buffer(self, src) -> memoryview: return flat_mv(memoryview(src))
   def copyin(self, dest, src:memoryview): ctypes.memmove(dest, from_mv(src), len(src))
   def copyout(self, dest:memoryview, src): ctypes.memmove(from_mv(dest), src, len(dest))
@@ -175,6 +372,14 @@ class _MallocAllocator(LRUAllocator):
 
 MallocAllocator = _MallocAllocator()
 
+@functools.lru_cache(None)
+def host_allocator(device:str) -> _MallocAllocator:
+  # CLANG:1 gets its memory from NUMA node 1, if the machine has one
+  node = int(idx) if len(parts:=device.split(":")) > 1 and (idx:=parts[1]).isdigit() else None
+  if node is None or sys.platform != "linux" or not os.path.isdir(f"/sys/devices/system/node/node{node}") or platform.machine() not in SYS_MBIND:
+    return MallocAllocator
+  return _MallocAllocator(numa_node=node)
+
 # **************** for Compiled Devices ****************
 
 class CompileError(Exception): pass
@@ -188,6 +393,7 @@ class Compiler:
       lib = self.compile(src)
       if self.cachekey is not None: diskcache_put(self.cachekey, src, lib)
     return lib
+  def compile_batch(self, srcs:List[str]) -> List[bytes]: return [self.compile_cached(src) for src in srcs]
 
 class Compiled:
   def __init__(self, device:str, allocator:Allocator, renderer:Optional[Renderer], compiler:Optional[Compiler], runtime, graph=None):
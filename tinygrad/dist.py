@@ -0,0 +1,121 @@
+from __future__ import annotations
+import os, functools, secrets, traceback, queue
+import multiprocessing as mp
+from typing import Any, Callable, List, Optional, Tuple
+from tinygrad.helpers import round_up, getenv, DEBUG
+from tinygrad.dtype import DType, dtypes
+from tinygrad.ops import ReduceOps
+from tinygrad.tensor import Tensor
+from tinygrad.multi import shard_bounds
+try: import _posixshmem
+except ImportError: _posixshmem = None
+
+SLOT_ALIGN = 4096
+REDUCE_FXN = {ReduceOps.SUM: Tensor.add, ReduceOps.MAX: Tensor.maximum}
+
+def _segment_size(world_size:int, slot_size:int) -> int: return (world_size + 1) * round_up(slot_size, SLOT_ALIGN)
+
+class ProcessGroup:
+  """
+  A group of processes on this machine, every rank runs its own tinygrad and they talk through a POSIX shared memory segment.
+
+  The segment holds a slot of `slot_size` bytes per rank and one for results. The slots are `disk:shm:` tensors, so the collectives
+  are copies between the device of a rank and the shared memory. The ranks wait for each other on `barrier`, a multiprocessing Barrier.
+  Use `spawn` to create the segment and the barrier and start the ranks.
+  """
+  def __init__(self, rank:int, world_size:int, name:str, slot_size:int, barrier:Any):
+    if _posixshmem is None: raise RuntimeError("ProcessGroup needs POSIX shared memory")
+    assert 0 <= rank < world_size, f"rank {rank} isn't in a group of {world_size}"
+    self.rank, self.world_size, self.name, self.slot_size = rank, world_size, name, round_up(slot_size, SLOT_ALIGN)
+    self._barrier = barrier
+    self._shm = Tensor.empty(_segment_size(world_size, slot_size), dtype=dtypes.uint8, device=f"disk:shm:{name}")
+
+  def _slot(self, i:int, numel:int, dtype:DType) -> Tensor:
+    # slot i, the last one holds results. it's a view of the segment as a flat tensor of dtype
+    start = i * self.slot_size
+    return self._shm[start:start+numel*dtype.itemsize].bitcast(dtype)
+
+  def barrier(self):
+    """Waits until every rank got here."""
+    # the semaphores of the barrier order the memory, the slot writes of a rank are seen by the others once they are past it.
+    # a counter in the segment would need atomics with release and acquire ordering on weakly ordered CPUs, and spin while it waits
+    self._barrier.wait()
+
+  def all_reduce(self, t:Tensor, op:ReduceOps=ReduceOps.SUM) -> Tensor:
+    """
+    Returns the reduction of `t` over all ranks on the device of `t`.
+
+    Every rank writes `t` to its slot and reduces its part of all slots into the result slot, then all ranks read the result.
+    Tensors larger than a slot are reduced in pieces.
+    """
+    flat, step = t.flatten().contiguous().realize(), self.slot_size // t.dtype.itemsize
+    pieces = [self._all_reduce_piece(flat[st:min(st+step, flat.numel())], op) for st in range(0, flat.numel(), step)]
+    if DEBUG >= 2: print(f"SHM ALLREDUCE rank {self.rank}/{self.world_size} {flat.numel()} | {t.dtype} in {len(pieces)} pieces")
+    return (pieces[0] if len(pieces) == 1 else Tensor.cat(*pieces)).reshape(t.shape) if pieces else t
+
+  def _all_reduce_piece(self, x:Tensor, op:ReduceOps) -> Tensor:
+    numel, dtype = x.numel(), x.dtype
+    self._slot(self.rank, numel, dtype).assign(x.contiguous().realize()).realize()
+    self.barrier()
+    # reduce-scatter: every rank reduces its even part of all slots
+    st, en = shard_bounds(numel, self.world_size)[self.rank]
+    if en > st:
+      parts = [self._slot(r, numel, dtype)[st:en].to(x.device) for r in range(self.world_size)]
+      self._slot(self.world_size, numel, dtype)[st:en].assign(functools.reduce(REDUCE_FXN[op], parts)).realize()
+    self.barrier()
+    # all-gather: every collective writes the slots only after a barrier, which every rank reaches after reading this result
+    return self._slot(self.world_size, numel, dtype).to(x.device).realize()
+
+  def broadcast(self, t:Tensor, src:int=0) -> Tensor:
+    """Returns `t` of rank `src` on every rank, on the device of `t`."""
+    flat, step = t.flatten().contiguous().realize(), self.slot_size // t.dtype.itemsize
+    pieces: List[Tensor] = []
+    for st in range(0, flat.numel(), step):
+      x = flat[st:min(st+step, flat.numel())]
+      # the result slot is written after every rank read what was in it, like the result of an all_reduce
+      self.barrier()
+      if self.rank == src: self._slot(self.world_size, x.numel(), x.dtype).assign(x.contiguous().realize()).realize()
+      self.barrier()
+      pieces.append(x if self.rank == src else self._slot(self.world_size, x.numel(), x.dtype).to(x.device).realize())
+    return (pieces[0] if len(pieces) == 1 else Tensor.cat(*pieces)).reshape(t.shape) if pieces else t
+
+def _run(fn:Callable, rank:int, world_size:int, name:str, slot_size:int, barrier:Any, results:Any, args:Tuple):
+  # a rank is a main process with its own devices, not a worker of the parent
+  mp.current_process().name = "MainProcess"
+  try: results.put((rank, fn(ProcessGroup(rank, world_size, name, slot_size, barrier), *args), None))
+  except Exception as e: results.put((rank, None, f"{e!r}\n{traceback.format_exc()}"))
+
+def spawn(fn:Callable[..., Any], world_size:int, *args, slot_size:int=getenv("SHM_SLOT", 64<<20), name:Optional[str]=None) -> List[Any]:
+  """
+  Runs `fn(pg, *args)` in `world_size` new processes on this machine, `pg` is the ProcessGroup of the rank. Returns the results by rank.
+
+  `fn` and its results have to be picklable, the shared memory segment is removed once all ranks are done.
+  """
+  if _posixshmem is None: raise RuntimeError("spawn needs POSIX shared memory")
+  name = name or f"tinygrad_pg_{os.getpid()}_{secrets.token_hex(4)}"
+  fd = _posixshmem.shm_open("/"+name, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+  try:
+    os.ftruncate(fd, _segment_size(world_size, slot_size))
+    os.close(fd)
+    # every rank starts a fresh interpreter with its own tinygrad and devices
+    ctx = mp.get_context("spawn")
+    results, barrier = ctx.Queue(), ctx.Barrier(world_size)
+    procs = [ctx.Process(target=_run, args=(fn, rank, world_size, name, slot_size, barrier, results, args), daemon=True)
+             for rank in range(world_size)]
+    for p in procs: p.start()
+    ret: List[Any] = [None] * world_size
+    for _ in range(world_size):
+      # a rank that died without reporting would leave the others waiting in a barrier forever
+      while True:
+        try: rank, out, err = results.get(timeout=1)
+        except queue.Empty:
+          if (dead:=next((i for i,p in enumerate(procs) if p.exitcode not in (None, 0)), None)) is None: continue
+          rank, out, err = dead, None, f"exited with code {procs[dead].exitcode}"
+        break
+      if err is not None:
+        for p in procs: p.terminate()
+        raise RuntimeError(f"rank {rank} failed: {err}")
+      ret[rank] = out
+    for p in procs: p.join()
+    return ret
+  finally: _posixshmem.shm_unlink("/"+name)
@@ -1,9 +1,10 @@
 from __future__ import annotations
-from typing import TypeVar, Generic, Callable, List, Tuple, Union, Dict, cast, Optional, Any
-import functools, itertools, collections
+from typing import TypeVar, Generic, Callable, List, Tuple, Union, Dict, Set, cast, Optional, Any
+import functools, itertools, collections, contextlib, inspect, types, pickle, hashlib, io, sys, pathlib
 from tinygrad.tensor import Tensor
 from tinygrad.engine.lazy import LazyBuffer
-from tinygrad.helpers import flatten, merge_dicts, DEBUG, Context, BEAM, getenv, colored, JIT, dedup, partition
+from tinygrad.helpers import flatten, merge_dicts, DEBUG, Context, BEAM, getenv, colored, JIT, JITCACHE, dedup, partition
+from tinygrad.helpers import diskcache_get, diskcache_put
 from tinygrad.device import Buffer, Compiled, Device
 from tinygrad.dtype import DType
 from tinygrad.ops import UOp, ssimplify, Variable, sint, sym_infer
@@ -12,7 +13,7 @@ from tinygrad.engine.realize import ExecItem, capturing, EmptyOp, ViewOp, Buffer
 from tinygrad.engine.memory import _internal_memory_planner
 from tinygrad.nn.state import get_parameters
 from dataclasses import dataclass
-from weakref import WeakKeyDictionary
+from weakref import WeakKeyDictionary, WeakSet
 
 class GraphException(Exception): pass
 
@@ -185,13 +186,174 @@ def _prepare_jit_inputs(args, kwargs):
   st_vars_dtype_device = [(x[0], tuple(sorted(x[1].keys(), key=lambda v: v.expr)), x[2], x[3]) for x in st_varvals_dtype_device]
   return input_buffers, var_vals, names, st_vars_dtype_device
 
+# **************** persistent jit cache ****************
+
+def _fxn_code(fxn:Callable) -> types.CodeType:
+  return fxn.__code__ if hasattr(fxn:=inspect.unwrap(fxn), "__code__") else type(fxn).__call__.__code__  # type: ignore[operator]
+
+def _arg_key(x) -> Any:
+  # plain values are baked into the kernels, anything else only by type. Variables are bound on every call
+  if x is None or isinstance(x, (bool, int, float, str)): return x
+  if isinstance(x, (list, tuple)): return type(x).__name__, tuple(_arg_key(y) for y in x)
+  if isinstance(x, dict): return tuple((k, _arg_key(v)) for k,v in sorted(x.items()))
+  return type(x).__name__
+
+def _code_key(code:types.CodeType) -> Tuple:
+  # the repr of a nested code object has its address in it, they are keyed by their contents
+  return (code.co_name, code.co_code, code.co_names, tuple(_code_key(c) if isinstance(c, types.CodeType) else repr(c) for c in code.co_consts))
+
+@functools.lru_cache(None)
+def _tinygrad_key() -> str:
+  # the source of tinygrad itself, a graph captured by another version isn't replayed
+  return hashlib.sha256(b"".join(p.read_bytes() for p in sorted(pathlib.Path(__file__).parent.parent.rglob("*.py")))).hexdigest()
+
+@functools.lru_cache(None)
+def _file_key(path:str, mtime:int) -> str: return hashlib.sha256(pathlib.Path(path).read_bytes()).hexdigest()
+
+def _walk_code(obj, seen:Set[int], codes:Dict[str, Tuple], mods:Set[str]):
+  # the functions the function can call through its globals, closures and the objects it reaches, and the modules they are in.
+  # tinygrad is covered by _tinygrad_key
+  if id(obj) in seen or isinstance(obj, (Tensor, str, bytes, int, float)) or obj is None: return
+  seen.add(id(obj))
+  if isinstance(obj, types.ModuleType): mods.add(obj.__name__)
+  elif isinstance(obj, (types.MethodType, functools.partial)): _walk_code(getattr(obj, "__func__", getattr(obj, "func", None)), seen, codes, mods)
+  elif isinstance(obj, types.FunctionType):
+    if (obj.__module__ or "").startswith("tinygrad"): return
+    mods.add(obj.__module__)
+    codes[f"{obj.__module__}.{obj.__qualname__}"] = _code_key(code:=obj.__code__)
+    names = set(code.co_names).union(*(c.co_names for c in code.co_consts if isinstance(c, types.CodeType)))
+    for name in sorted(names & obj.__globals__.keys()): _walk_code(obj.__globals__[name], seen, codes, mods)
+    for cell in obj.__closure__ or ():
+      with contextlib.suppress(ValueError): _walk_code(cell.cell_contents, seen, codes, mods)  # cells can be empty
+  elif isinstance(obj, type):
+    for c in obj.__mro__:
+      if c.__module__.startswith("tinygrad") or c.__module__ == "builtins": continue
+      mods.add(c.__module__)
+      for v in vars(c).values(): _walk_code(v.__func__ if isinstance(v, (staticmethod, classmethod)) else v, seen, codes, mods)
+  elif isinstance(obj, dict):
+    for v in obj.values(): _walk_code(v, seen, codes, mods)
+  elif isinstance(obj, (list, tuple)):
+    for v in obj: _walk_code(v, seen, codes, mods)
+  elif hasattr(obj, "__dict__"):
+    _walk_code(type(obj), seen, codes, mods)
+    _walk_code(obj.__dict__, seen, codes, mods)
+
+def _jit_key(fxn:Callable, names:List[Union[int, str]], st_vars_dtype_device:List, state:Dict[str, Tensor], args, kwargs) -> str:
+  """
+  the key of a graph in the persistent cache: the source of tinygrad, the code of the function and of everything it can call through its
+  globals, closures, instance and args, the source files of their modules, the input signature, the state and the python args.
+  NOTE: it doesn't cover code reached another way, like a getattr by name, modules without a python source file or environment variables
+  """
+  code = _fxn_code(fxn)
+  codes: Dict[str, Tuple] = {}
+  mods: Set[str] = set()
+  _walk_code([inspect.unwrap(fxn), *(v for v in itertools.chain(args, kwargs.values()) if v.__class__ is not Tensor)], set(), codes, mods)
+  files = sorted(f for m in mods if isinstance(f:=getattr(sys.modules.get(m), "__file__", None), str) and f.endswith(".py"))
+  # the same code with other weights or other python args is another graph
+  state_key = [(k, t.shape, t.dtype, t.device) for k,t in state.items()]
+  arg_key = [(k, _arg_key(v)) for k,v in itertools.chain(enumerate(args), sorted(kwargs.items())) if v.__class__ is not Tensor]
+  return hashlib.sha256(repr((_tinygrad_key(), code.co_filename, _code_key(code), sorted(codes.items()),
+                              [(f, _file_key(f, pathlib.Path(f).stat().st_mtime_ns)) for f in files], names, st_vars_dtype_device, state_key,
+                              arg_key)).encode()).hexdigest()
+
+def _walk_state(obj, prefix:str, seen:Set[int], state:Dict[str, Tensor]):
+  if id(obj) in seen or isinstance(obj, (types.ModuleType, type, types.FunctionType, types.BuiltinFunctionType, str, bytes)): return
+  seen.add(id(obj))
+  if isinstance(obj, Tensor): state[prefix] = obj
+  elif isinstance(obj, types.MethodType): _walk_state(obj.__self__, prefix, seen, state)
+  elif isinstance(obj, dict):
+    for k,v in obj.items(): _walk_state(v, f"{prefix}.{k}", seen, state)
+  elif isinstance(obj, (list, tuple)):
+    for i,v in enumerate(obj): _walk_state(v, f"{prefix}.{i}", seen, state)
+  elif hasattr(obj, '__dict__'): _walk_state(obj.__dict__, prefix, seen, state)
+
+def _jit_state(fxn:Callable, args, kwargs) -> Dict[str, Tensor]:
+  # the tensors the function can reach without being passed them: non tensor args, closures and globals. unlike get_state_dict this handles cycles
+  fxn = inspect.unwrap(fxn)
+  roots: Dict[str, Any] = {f"arg{k}":v for k,v in itertools.chain(enumerate(args), sorted(kwargs.items())) if v.__class__ is not Tensor}
+  # bound methods and callable objects reach their instance
+  if isinstance(fxn, types.MethodType): roots["self"] = fxn.__self__
+  elif not hasattr(fxn, "__code__"): roots["self"], fxn = fxn, type(fxn).__call__
+  code = _fxn_code(fxn)
+  for name,cell in zip(code.co_freevars, getattr(fxn, "__closure__", None) or ()):
+    with contextlib.suppress(ValueError): roots[f"closure_{name}"] = cell.cell_contents  # cells can be empty
+  roots.update({f"global_{name}":fxn.__globals__[name] for name in code.co_names if name in fxn.__globals__})
+  state: Dict[str, Tensor] = {}
+  _walk_state(roots, "", set(), state)
+  return state
+
+class _JitPickler(pickle.Pickler):
+  # buffers that existed before the capture are saved as their path in the state, the ones owned by the jit are saved without their contents
+  def __init__(self, file, state_bufs:Dict[Buffer, Tuple[str, int]], external:Set[Buffer]):
+    super().__init__(file)
+    self.state_bufs, self.external = state_bufs, external
+  def persistent_id(self, obj):
+    if obj.__class__ is not Buffer or obj._base is not None: return None
+    if obj in self.state_bufs: return ("state", *self.state_bufs[obj], obj.size, obj.dtype, obj.device)
+    if obj in self.external: raise pickle.PicklingError(f"{obj} was used by the jit but isn't reachable from the function")
+    return ("buf", id(obj), obj.device, obj.size, obj.dtype, obj.options, obj.lb_refcount, obj.is_allocated())
+
+class _JitUnpickler(pickle.Unpickler):
+  def __init__(self, file, state:Dict[str, Tensor]):
+    super().__init__(file)
+    self.state, self.bufs = state, {}
+  def persistent_load(self, pid):
+    if pid[0] == "buf":
+      if pid[1] not in self.bufs: self.bufs[pid[1]] = Buffer(*pid[2:5], options=pid[5], lb_refcount=pid[6], preallocate=pid[7])
+      return self.bufs[pid[1]]
+    if (buf:=(t:=self.state[pid[1]]).lazydata.lbs[pid[2]].base.realized) is None: buf = t.realize().lazydata.lbs[pid[2]].base.buffer
+    if (buf.size, buf.dtype, buf.device) != pid[3:]: raise pickle.UnpicklingError(f"{pid[1]} is {buf}, the jit was captured with {pid[3:]}")
+    return buf
+
+def _state_bufs(state:Dict[str, Tensor]) -> Dict[Buffer, Tuple[str, int]]:
+  return {lb.base.realized:(k,i) for k,t in reversed(state.items()) for i,lb in enumerate(t.lazydata.lbs) if lb.base.realized is not None}
+
+def _warmup_items(jit_cache:List[ExecItem], input_buffers:List[Buffer], fresh:WeakSet[Buffer], keep:Set[Buffer]) -> Set[int]:
+  """
+  finds the items a first eager call would have run once: the first write to state created in the call, unless it reads what the
+  replayed items write, and what only feeds those
+  """
+  def outs(ei:ExecItem) -> List[Buffer]: return [cast(Buffer, ei.bufs[i]) for i in (ei.prg.p.outs if isinstance(ei.prg, CompiledRunner) else [0])]
+  depends, writes = set(input_buffers), collections.Counter(b.base for ei in jit_cache for b in outs(ei))
+  warmup: Set[int] = set()
+  written: Set[Buffer] = set()
+  for j,ei in enumerate(jit_cache):
+    if any(b.base in depends for b in ei.bufs if b is not None): depends.update(b.base for b in outs(ei))
+    elif any(b.base in fresh and b.lb_refcount > 0 and b.base not in written and (b.base not in keep or writes[b.base] > 1) for b in outs(ei)):
+      warmup.add(j)
+    written.update(b.base for b in outs(ei))
+  # a warmup item can't read what the replayed items write, it would compute something else on every call
+  def reads(ei:ExecItem) -> List[Buffer]: return [b for b in ei.bufs if b is not None and b not in outs(ei)]
+  while True:
+    replayed = {b.base for j,ei in enumerate(jit_cache) if j not in warmup for b in outs(ei)}
+    if not (stale:={j for j in warmup if any(b.base in replayed for b in reads(jit_cache[j]))}): break
+    warmup -= stale
+  needed = set(keep)
+  for j,ei in reversed(list(enumerate(jit_cache))):
+    if j not in warmup and all(b.lb_refcount == 0 and b.base not in needed for b in outs(ei)): warmup.add(j)
+    if j not in warmup: needed.update(b.base for b in ei.bufs if b is not None)
+  return warmup
+
 class TinyJit(Generic[ReturnType]):
-  def __init__(self, fxn:Optional[Callable[..., ReturnType]], captured:Optional[CapturedJit]=None, prune=False):
+  def __init__(self, fxn:Optional[Callable[..., ReturnType]], captured:Optional[CapturedJit]=None, prune=False, max_captured:int=1,
+               buckets:Optional[Dict[Union[int, str], Dict[int, Tuple[int, ...]]]]=None, capture_first=False):
     assert fxn or captured, "need either a function or a CapturedJit"
+    assert max_captured >= 1, "need to keep at least one captured graph"
     self.fxn = fxn
     self.captured: Optional[CapturedJit] = captured
-    self.cnt: int = 2 if self.fxn is None else 0
+    # with capture_first there is no eager warmup call, the kernels that only initialize state are run once by the capture and not replayed
+    self.capture_first, self.first_cnt = capture_first, 1 if capture_first else 0
+    self.cnt: int = 2 if self.fxn is None else self.first_cnt
     self.prune = prune
+    # with max_captured > 1 each input signature gets its own captured graph, the least recently used ones are dropped
+    self.max_captured = max_captured
+    # the max_captured most recently used signatures are tracked, a signature that is dropped warms up again
+    self.captures: collections.OrderedDict[Tuple, CapturedJit] = collections.OrderedDict()
+    self._cnts: collections.OrderedDict[Tuple, int] = collections.OrderedDict()
+    # {arg position or name: {axis: sizes}}, only these args are zero padded up to the next size on these axes, so fewer signatures are captured.
+    # fxn sees the padded shapes and the outputs come back padded. a reduction over a padded axis has to mask the padding, with a length or a
+    # mask fxn takes as an input tensor
+    self.buckets = {arg:{axis:tuple(sorted(sizes)) for axis,sizes in axes.items()} for arg,axes in buckets.items()} if buckets else {}
 
   def add_buffer(self, b:Buffer) -> Buffer:
     if found:=self._buffer_replace.get(b, None): return found
@@ -203,12 +365,16 @@ class TinyJit(Generic[ReturnType]):
     return ret
 
   def add(self, ei:ExecItem):
+    for b in ei.bufs:
+      if b is not None and b.base not in self._captured_bufs: (self._external_bufs if b.base.is_allocated() else self._captured_bufs).add(b.base)
     self._jit_cache.append(ExecItem(ei.prg, [self.add_buffer(buf) for buf in ei.bufs if buf is not None]))
 
   def reset(self):
     assert self.fxn is not None, "can't reset without function"
-    self.cnt = 0
+    self.cnt = self.first_cnt
     self.captured = None
+    self.captures.clear()
+    self._cnts.clear()
 
   def __reduce__(self):
     assert self.captured is not None, "can't pickle an uncaptured JIT"
@@ -222,8 +388,41 @@ class TinyJit(Generic[ReturnType]):
 
   def __get__(self, obj, objtype): return functools.partial(self.__call__, obj) # add support for instance methods
 
+  def _load(self, key:str, state:Dict[str, Tensor]) -> Optional[CapturedJit]:
+    if (data:=diskcache_get("jit", key)) is None: return None
+    try: captured = _JitUnpickler(io.BytesIO(data), state).load()
+    except Exception as e:
+      # a graph pickled by other code may not load at all
+      if DEBUG >= 1: print(f"JIT cache can't load {e!r} of {self.fxn}, capturing again")
+      return None
+    if DEBUG >= 1: print(f"JIT cache loaded {len(captured.jit_cache)} kernels for {self.fxn}")
+    return captured
+
+  def _save(self, key:str, state:Dict[str, Tensor], external:Set[Buffer]):
+    pickler = _JitPickler(f:=io.BytesIO(), _state_bufs(state), external)
+    try: pickler.dump(self.captured)
+    except pickle.PicklingError as e:
+      if DEBUG >= 1: print(f"JIT cache not saved for {self.fxn}: {e}")
+      return
+    diskcache_put("jit", key, f.getvalue())
+
   def __call__(self, *args, **kwargs) -> ReturnType:
+    if not self.buckets: return self._call(*args, **kwargs)
+    def pad(arg:Union[int, str], t:Any) -> Any:
+      if t.__class__ is not Tensor or not (axes:=self.buckets.get(arg)): return t
+      pads = [(0, next((b for b in axes[i] if b >= s), s) - s) if i in axes and isinstance(s, int) else None for i,s in enumerate(t.shape)]
+      return t.pad(tuple(pads)).contiguous() if any(p is not None and p[1] for p in pads) else t
+    return self._call(*[pad(i, x) for i,x in enumerate(args)], **{k:pad(k, x) for k,x in kwargs.items()})
+
+  def _call(self, *args, **kwargs) -> ReturnType:
     input_buffers, var_vals, names, st_vars_dtype_device = _prepare_jit_inputs(args, kwargs)
+    if self.max_captured > 1:
+      key = (tuple(names), tuple(st_vars_dtype_device))
+      self.captured, self.cnt = self.captures.get(key), self._cnts.get(key, self.first_cnt)
+    if JITCACHE and JIT and self.cnt < 2 and self.fxn is not None:
+      state = _jit_state(self.fxn, args, kwargs)
+      if (captured:=self._load(_jit_key(self.fxn, names, st_vars_dtype_device, state, args, kwargs), state)) is not None:
+        self.captured, self.cnt = captured, 2
     if not JIT or self.cnt == 0:
       # jit ignore
       assert self.fxn is not None
@@ -236,7 +435,13 @@ class TinyJit(Generic[ReturnType]):
       if capturing: raise RuntimeError(f"having TinyJit inside another TinyJit is not supported {len(capturing)=} {capturing=}")
       self._jit_cache: List[ExecItem] = []
       self._buffer_replace: WeakKeyDictionary[Buffer, Buffer] = WeakKeyDictionary()
+      # buffers that were allocated before the capture aren't owned by the jit
+      self._captured_bufs: WeakSet[Buffer] = WeakSet()
+      self._external_bufs: Set[Buffer] = set()
       # TODO: should we always disable the memory planner here? it must be off for prune
+      # without a warmup call, the state the function reaches (like lazily initialized weights) is realized before capturing
+      if self.capture_first and len(state:=[t for t in _jit_state(self.fxn, args, kwargs).values() if not t.lazydata.is_realized()]):
+        Tensor.realize(*state)
       with Context(BEAM=getenv("JITBEAM", BEAM.value), NO_MEMORY_PLANNER=int(self.prune)):
         capturing.append(self)
         try:
@@ -244,8 +449,12 @@ class TinyJit(Generic[ReturnType]):
           if len(params:=get_parameters(ret)): Tensor.realize(params[0], *params[1:])
         except Exception as e: raise e
         finally: capturing.clear()
-      jit_cache = self._jit_cache
-      del self._buffer_replace, self._jit_cache
+      jit_cache, external = self._jit_cache, self._external_bufs - set(input_buffers)
+      if self.capture_first:
+        warmup = _warmup_items(jit_cache, input_buffers, self._captured_bufs, {lb.base.buffer for t in get_parameters(ret) for lb in t.lazydata.lbs})
+        if DEBUG >= 1 and warmup: print(f"JIT ran {len(warmup)} warmup kernels once")
+        jit_cache = [ei for j,ei in enumerate(jit_cache) if j not in warmup]
+      del self._buffer_replace, self._jit_cache, self._captured_bufs, self._external_bufs
       assert len(jit_cache), "didn't JIT anything!"
       if DEBUG >= 1: print(f"JIT captured {len(jit_cache)} kernels with {len(input_buffers)} inputs")
 
@@ -285,6 +494,10 @@ class TinyJit(Generic[ReturnType]):
 
       # set this for next run
       self.captured = CapturedJit(ret, jit_cache, input_replace, extra_view_inputs, names, st_vars_dtype_device)
+      if JITCACHE:
+        # the state after the capture, weights a first call initialized are bound too
+        state = _jit_state(self.fxn, args, kwargs)
+        self._save(_jit_key(self.fxn, names, st_vars_dtype_device, state, args, kwargs), state, external)
     elif self.cnt >= 2:
       # jit exec
       assert self.captured is not None
@@ -294,4 +507,11 @@ class TinyJit(Generic[ReturnType]):
       ret = self.captured(input_buffers, var_vals)
 
     self.cnt += 1
+    if self.max_captured > 1:
+      self._cnts[key] = self.cnt
+      self._cnts.move_to_end(key)
+      if self.captured is not None:
+        self.captures[key] = self.captured
+        self.captures.move_to_end(key)
+      while len(self._cnts) > self.max_captured: self.captures.pop(self._cnts.popitem(last=False)[0], None)
     return ret
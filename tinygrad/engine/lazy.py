@@ -7,10 +7,14 @@ from tinygrad.ops import identity_element, MathTrait, resolve, UOp, sint
 from tinygrad.shape.shapetracker import ShapeTracker
 from tinygrad.device import Buffer
 from weakref import ref, ReferenceType, WeakValueDictionary
+import itertools
 
 lazycache: WeakValueDictionary[Any, LazyBuffer] = WeakValueDictionary()
+# bases are numbered in the order they are made, see Tensor.checkpoint
+lb_seq = itertools.count()
 def create_lazybuffer(device:str, st:ShapeTracker, dtype:DType, op:Optional[Op]=None, arg:Any=None, srcs:Tuple[LazyBuffer, ...]=(),
-                      base:Optional[LazyBuffer]=None, enable_cache=bool(LAZYCACHE)):
+                      base:Optional[LazyBuffer]=None, enable_cache:Optional[bool]=None):
+  if enable_cache is None: enable_cache = bool(LAZYCACHE)
   if st.size == 0: op, arg, srcs, base = MetaOps.CONST, 0, (), None
   dtype = to_dtype(dtype)
   if op is MetaOps.CONST: arg, enable_cache = dtypes.as_const(arg, dtype) if not isinstance(arg, UOp) else arg, True
@@ -42,6 +46,9 @@ class LazyBuffer(MathTrait):
       self.buffer.ref(1)
       self.contiguous_child: Optional[Tuple[ReferenceType[LazyBuffer], ShapeTracker]] = None
       self.forced_realize = False
+      # a recomputed activation is scheduled after this buffer, see Tensor.checkpoint
+      self.after: Optional[LazyBuffer] = None
+      self.seq = next(lb_seq)
     else:
       # properties on view
       assert base.base == base, "base must be a base itself"
@@ -111,7 +118,9 @@ class LazyBuffer(MathTrait):
     elif getenv("CAST_BEFORE_VIEW", 1) and dtype.itemsize <= self.dtype.itemsize and self is not self.base:
       # TODO: applying this makes gpt2 slower
       return self.base.cast(dtype, bitcast)._view(self.st)
-    cast_op: Union[MetaOps, UnaryOps] = (MetaOps.VIEW if self.can_view() and allow_buffer_view else UnaryOps.BITCAST) if bitcast else UnaryOps.CAST
+    # a bitcast of a buffer is a view of it, a bitcast of a computed value stays in the kernel computing it
+    buffer_view = allow_buffer_view and self.can_view() and (self.base.realized is not None or isinstance(self.base.op, MetaOps))
+    cast_op: Union[MetaOps, UnaryOps] = (MetaOps.VIEW if buffer_view else UnaryOps.BITCAST) if bitcast else UnaryOps.CAST
     return create_lazybuffer(self.device, ShapeTracker.from_shape(new_shape), dtype, cast_op, dtype, (self,))
 
   def is_unrealized_const(self): return self.base.realized is None and self.base.op is MetaOps.CONST and not isinstance(self.base.arg, UOp)
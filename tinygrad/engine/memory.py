@@ -1,12 +1,29 @@
 from typing import List, Union, Tuple, Dict
 from collections import defaultdict
 from tinygrad.engine.schedule import ScheduleItem
-from tinygrad.device import Device, Buffer
-from tinygrad.helpers import NO_MEMORY_PLANNER, dedup, DEBUG
+from tinygrad.device import Device, Buffer, mem_profiler
+from tinygrad.dtype import dtypes
+from tinygrad.helpers import NO_MEMORY_PLANNER, MEMPROFILE, dedup, DEBUG, round_up, partition
 from tinygrad.ops import UOps
 
 # **************** memory planning ****************
 
+ARENA_ALIGN = 0x100
+
+def _plan_arena(requests:List[Tuple[int, int, Buffer]]) -> Tuple[Dict[Buffer, int], int]:
+  """assigns every (first use, last use, buffer) an offset so buffers that are alive at the same time never overlap, returns offsets and peak"""
+  # greedy by size: place the largest buffers first, each in the tightest gap left between the buffers it is alive with
+  placed: List[Tuple[int, int, int, int]] = []  # (start offset, end offset, first use, last use)
+  offsets: Dict[Buffer, int] = {}
+  for st, en, buf in sorted(requests, key=lambda x: -x[2].nbytes):
+    sz, gap, prev_end = round_up(buf.nbytes, ARENA_ALIGN), None, 0
+    for ost, oen in sorted((ost, oen) for ost,oen,pst,pen in placed if pst <= en and st <= pen):
+      if ost - prev_end >= sz and (gap is None or ost - prev_end < gap[1]): gap = (prev_end, ost - prev_end)
+      prev_end = max(prev_end, oen)
+    offsets[buf] = off = gap[0] if gap is not None else prev_end
+    placed.append((off, off+sz, st, en))
+  return offsets, max((oen for _,oen,_,_ in placed), default=0)
+
 def _internal_memory_planner(buffers:List[Union[List[Buffer], Tuple[Buffer, ...]]], noopt_buffers=None, debug_prefix="") -> Dict[Buffer, Buffer]:
   if NO_MEMORY_PLANNER: return {}
   first_appearance, last_appearance = {}, {}
@@ -31,15 +48,27 @@ def _internal_memory_planner(buffers:List[Union[List[Buffer], Tuple[Buffer, ...]
     return seg_buf if seg_buf.nbytes == buf.nbytes else Buffer(buf.device, buf.size, buf.dtype, base=seg_buf)
 
   buffer_requests = sorted([(first_appearance[buf], last_appearance[buf], buf) for buf in first_appearance.keys()], key=lambda x: -x[2].nbytes)
-  assigned = {buf:find_replace_buffer(buf, st, en) for st, en, buf in buffer_requests}
+  # on devices that can offset into a buffer, all the buffers are carved out of one arena per device
+  arena_requests, buffer_requests = partition(buffer_requests, lambda x: x[2].options is None and hasattr(Device[x[2].device].allocator, "offset"))
+  assigned: Dict[Buffer, Buffer] = {}
+  for device in dedup(buf.device for _,_,buf in arena_requests):
+    offsets, peak = _plan_arena(reqs:=[x for x in arena_requests if x[2].device == device])
+    if len(reqs) == 1 or peak == 0: continue
+    arena = Buffer(device, peak, dtypes.uint8)
+    if MEMPROFILE: mem_profiler.planned.add(arena)
+    for buf,off in offsets.items(): assigned[buf] = Buffer(device, buf.size, buf.dtype, base=arena, offset=off)
+    if DEBUG >= 1: print(debug_prefix+f"arena on {device}: planned peak {peak/1e6:.2f} MB, naive {sum(x[2].nbytes for x in reqs)/1e6:.2f} MB")
+  assigned.update({buf:find_replace_buffer(buf, st, en) for st, en, buf in buffer_requests})
 
   for i,u in enumerate(buffers):
     for buf in u:
       if buf.is_allocated() or buf.lb_refcount > 0 or (noopt_buffers is not None and buf.base in noopt_buffers): continue
-      if buf._base is not None: assigned[buf] = Buffer(buf.device, buf.size, buf.dtype, base=assigned.get(buf.base, buf.base).base, offset=buf.offset)
+      if buf._base is not None:
+        assigned[buf] = Buffer(buf.device, buf.size, buf.dtype, base=(nb:=assigned.get(buf.base, buf.base)).base, offset=nb.offset+buf.offset)
       else: assigned[buf] = assigned.get(buf, buf)
 
-  if DEBUG >= 1 and len(ak:=dedup(x for x in assigned.keys() if x._base is None)) != len(av:=dedup(x for x in assigned.values() if x._base is None)):
+  if MEMPROFILE: mem_profiler.planned.update(v for k,v in assigned.items() if v is not k)
+  if DEBUG >= 1 and len(ak:=dedup(x.base for x in assigned.keys())) != len(av:=dedup(x.base for x in assigned.values())):
     print(debug_prefix+f"memory reduced from {sum([x.nbytes for x in ak])/1e6:.2f} MB -> {sum([x.nbytes for x in av])/1e6:.2f} MB,",
           f"{len(ak)} -> {len(av)} bufs")
   return assigned
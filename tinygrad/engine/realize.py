@@ -1,10 +1,13 @@
-from typing import List, Dict, Optional, cast, Generator, Tuple
-import time, pprint
+from typing import List, Dict, Optional, cast, Generator, Tuple, Deque, DefaultDict
+import time, pprint, os, contextlib, functools
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, Future
 from dataclasses import dataclass, replace
 from tinygrad.helpers import colored, getenv, DEBUG, GlobalCounters, ansilen, BEAM, NOOPT, all_int, CAPTURING, Metadata, Context, TRACEMETA
+from tinygrad.helpers import COMPILE_AHEAD, THREADS, MEMPROFILE
 from tinygrad.ops import UOps, UOp, Variable, sym_infer, sint
 from tinygrad.dtype import dtypes
-from tinygrad.device import Device, Buffer
+from tinygrad.device import Device, Buffer, Compiler, mem_profiler
 from tinygrad.renderer import Renderer, Program
 from tinygrad.codegen.kernel import Kernel
 from tinygrad.engine.schedule import ScheduleItem
@@ -139,19 +142,19 @@ class BufferXfer(BufferCopy):
 
 # **************** method cache ****************
 
-method_cache: Dict[Tuple[str, bytes, int, int, bool], CompiledRunner] = {}
-def get_runner(dname:str, ast:UOp) -> CompiledRunner:
-  ckey = (dname, ast.key, BEAM.value, NOOPT.value, False)
+method_cache: Dict[Tuple[str, bytes, int, int, int, bool], CompiledRunner] = {}
+def get_runner(dname:str, ast:UOp, precompiled:Optional[Tuple[Program, bytes]]=None) -> CompiledRunner:
+  ckey = (dname, ast.key, BEAM.value, NOOPT.value, THREADS.value, False)
   if cret:=method_cache.get(ckey): return cret
-  bkey = (dname.split(":")[0], ast.key, BEAM.value, NOOPT.value, True)
+  bkey = (dname.split(":")[0], ast.key, BEAM.value, NOOPT.value, THREADS.value, True)
   if bret:=method_cache.get(bkey):
     method_cache[ckey] = ret = CompiledRunner(replace(bret.p, dname=dname), bret.lib)
   else:
-    prg: Program = get_kernel(Device[dname].renderer, ast).to_program()
+    prg, lib = precompiled if precompiled is not None else (get_kernel(Device[dname].renderer, ast).to_program(), None)
     if getenv("FUZZ_UOPS"):
       from test.external.fuzz_uops import UOpsFuzzerRunner
       return UOpsFuzzerRunner(replace(prg, dname=dname))
-    method_cache[ckey] = method_cache[bkey] = ret = CompiledRunner(replace(prg, dname=dname))
+    method_cache[ckey] = method_cache[bkey] = ret = CompiledRunner(replace(prg, dname=dname), lib)
   return ret
 
 # **************** lowering functions ****************
@@ -163,7 +166,10 @@ class ExecItem:
   metadata: Optional[Tuple[Metadata, ...]] = None
   def run(self, _var_vals:Optional[Dict[Variable, int]]=None, wait=False, jit=False, do_update_stats=True) -> Optional[float]:
     var_vals = {} if _var_vals is None else _var_vals
-    bufs = [cast(Buffer, x) for x in self.bufs] if jit else [cast(Buffer, x).ensure_allocated() for x in self.bufs]
+    if jit: bufs = [cast(Buffer, x) for x in self.bufs]
+    else:
+      with mem_profiler.owning(self.metadata) if MEMPROFILE else contextlib.nullcontext():
+        bufs = [cast(Buffer, x).ensure_allocated() for x in self.bufs]
     et = self.prg(bufs, var_vals, wait=wait or DEBUG >= 2)
     if do_update_stats:
       GlobalCounters.kernel_count += 1
@@ -180,10 +186,10 @@ class ExecItem:
       self.prg.first_run = False
     return et
 
-def lower_schedule_item(si:ScheduleItem) -> ExecItem:
+def lower_schedule_item(si:ScheduleItem, precompiled:Optional[Tuple[Program, bytes]]=None) -> ExecItem:
   assert len(set(x.device for x in si.bufs)) == 1 or si.ast.op is UOps.COPY
   if si.ast.op is UOps.SINK:
-    runner = get_runner(si.outputs[0].device, si.ast)
+    runner = get_runner(si.outputs[0].device, si.ast, precompiled)
     return ExecItem(runner, [si.bufs[x] for x in runner.p.globals], si.metadata)
   out, arg = si.outputs[0], si.ast.arg
   if si.ast.op is UOps.COPY:
@@ -195,10 +201,31 @@ def lower_schedule_item(si:ScheduleItem) -> ExecItem:
   if si.ast.op is UOps.BUFFER_VIEW: return ExecItem(ViewOp(out), list(si.bufs))
   raise RuntimeError(f"don't know how to lower {si.ast}")
 
+def precompile_schedule(schedule:List[ScheduleItem]) -> Dict[Tuple[str, bytes, int, int, int, bool], Tuple[Program, bytes]]:
+  """
+  render the kernels that miss the method cache and hand them to compile_batch together, one call per device.
+  only for compilers with their own compile_batch, the others compile each kernel right before it runs. BEAM searches them one by one too
+  """
+  if BEAM >= 1: return {}
+  todo: DefaultDict[str, Dict[Tuple[str, bytes, int, int, int, bool], Program]] = defaultdict(dict)
+  for si in schedule:
+    if si.ast.op is not UOps.SINK: continue
+    compiler = Device[dname:=si.outputs[0].device].compiler
+    if compiler is None or type(compiler).compile_batch is Compiler.compile_batch: continue
+    if (bkey:=(dname.split(":")[0], si.ast.key, BEAM.value, NOOPT.value, THREADS.value, True)) in method_cache or bkey in todo[dname]: continue
+    todo[dname][bkey] = get_kernel(Device[dname].renderer, si.ast).to_program()
+  ret: Dict[Tuple[str, bytes, int, int, int, bool], Tuple[Program, bytes]] = {}
+  for dname,prgs in todo.items():
+    libs = cast(Compiler, Device[dname].compiler).compile_batch([p.src for p in prgs.values()])
+    ret.update({bkey:(p, lib) for (bkey,p),lib in zip(prgs.items(), libs)})
+  return ret
+
 def lower_schedule(schedule:List[ScheduleItem]) -> Generator[ExecItem, None, None]:
+  precompiled = precompile_schedule(schedule)
   while len(schedule):
     si = schedule.pop(0)
-    try: yield lower_schedule_item(si)
+    bkey = (si.outputs[0].device.split(":")[0], si.ast.key, BEAM.value, NOOPT.value, THREADS.value, True) if si.ast.op is UOps.SINK else None
+    try: yield lower_schedule_item(si, precompiled.pop(bkey, None))
     except Exception as e:
       if DEBUG >= 2:
         print(f"error lowering {si.ast.op}")
@@ -206,11 +233,46 @@ def lower_schedule(schedule:List[ScheduleItem]) -> Generator[ExecItem, None, Non
         pprint.pprint(si.metadata, indent=2)
       raise e
 
+@functools.lru_cache(None)
+def _compile_pool(pid:int) -> ThreadPoolExecutor:
+  # made on first use and kept for the life of the process, its threads are joined at exit. a forked child doesn't have the threads
+  return ThreadPoolExecutor(getenv("COMPILE_WORKERS", os.cpu_count() or 1), thread_name_prefix="compile")
+
+def lower_schedule_pipelined(schedule:List[ScheduleItem], lookahead:int) -> Generator[ExecItem, None, None]:
+  """like lower_schedule, but the next `lookahead` kernels are compiled on a thread pool while the ones before them run"""
+  # NOTE: only compile runs on the pool. rendering mutates the renderer and creates UOps, so it stays on this thread in order
+  pending: Dict[Tuple[str, bytes, int, int, bool], Tuple[Program, Future]] = {}
+  window: Deque[ScheduleItem] = deque()
+  pool = _compile_pool(os.getpid())
+  try:
+    while len(schedule) or len(window):
+      while len(schedule) and len(window) < lookahead:
+        window.append(si:=schedule.pop(0))
+        if si.ast.op is not UOps.SINK: continue
+        dname = si.outputs[0].device
+        if (bkey:=(dname.split(":")[0], si.ast.key, BEAM.value, NOOPT.value, THREADS.value, True)) in method_cache or bkey in pending: continue
+        # if this fails, lower_schedule_item raises the error again when we get to it
+        try: prg = get_kernel(Device[dname].renderer, si.ast).to_program()
+        except Exception: continue
+        pending[bkey] = (prg, pool.submit(Device[dname].compiler.compile_cached, prg.src))
+      si = window.popleft()
+      try:
+        bkey = (si.outputs[0].device.split(":")[0], si.ast.key, BEAM.value, NOOPT.value, THREADS.value, True)
+        yield lower_schedule_item(si, (p[0], p[1].result()) if (p:=pending.pop(bkey, None)) is not None else None)
+      except Exception as e:
+        if DEBUG >= 2:
+          print(f"error lowering {si.ast.op}")
+          print("tensor operations:")
+          pprint.pprint(si.metadata, indent=2)
+        raise e
+  finally:
+    for _,fut in pending.values(): fut.cancel()
+
 # **************** main run function ****************
 
 capturing: List = []  # put classes with an add method in here
 
 def run_schedule(schedule:List[ScheduleItem], var_vals:Optional[Dict[Variable, int]]=None, do_update_stats=True):
-  for ei in lower_schedule(schedule):
+  for ei in (lower_schedule_pipelined(schedule, COMPILE_AHEAD.value) if COMPILE_AHEAD else lower_schedule(schedule)):
     if len(capturing) and CAPTURING: capturing[0].add(ei)
     ei.run(var_vals, do_update_stats=do_update_stats)
@@ -1,9 +1,10 @@
 import sys, atexit, functools, itertools
-from collections import defaultdict, deque
+from collections import Counter, defaultdict, deque
 from dataclasses import dataclass, field
-from typing import Callable, Set, Tuple, List, Dict, Optional, DefaultDict, cast
+from typing import Callable, Deque, Set, Tuple, List, Dict, Optional, DefaultDict, cast
 from tinygrad.ops import BUFFER_UOPS, MetaOps, ReduceOps, UnaryOps, UOp, UOps, PatternMatcher, UPat, Variable, graph_rewrite, track_rewrites, sint
-from tinygrad.helpers import DEBUG, Metadata, all_same, colored, diskcache_put, prod, dedup, getenv, unwrap
+from tinygrad.helpers import DEBUG, FUSE_ARANGE, FUSE_CONV_BW, SCHEDULE_CACHE, MEMORY_ORDER, Metadata, all_same, colored, diskcache_put, prod, \
+  dedup, getenv, unwrap
 from tinygrad.dtype import ImageDType, dtypes
 from tinygrad.shape.shapetracker import ShapeTracker
 from tinygrad.shape.view import View, strides_for_shape
@@ -227,6 +228,50 @@ if getenv("RUN_PROCESS_REPLAY"):
   def save_process_replay():
     for x,ret in PROCESS_REPLAY_CAPTURE: diskcache_put("schedule_process_replay", str(x[0].key), (x, {}, ret))
 
+# **** schedule cache
+
+# a structurally identical LazyBuffer graph always produces the same schedule, only the Buffers change
+# the cache stores the schedule with Buffers and LazyBuffers replaced by their index in the graph walk, so it keeps nothing alive
+@dataclass(frozen=True)
+class CachedSchedule:
+  items: Tuple[Tuple[UOp, Tuple[int, ...], Tuple[Metadata, ...], Tuple[UOp, ...]], ...]
+  realized_lbs: Tuple[int, ...]
+  var_vals: Dict[Variable, int]
+
+schedule_cache: Dict[Tuple, CachedSchedule] = {}
+
+def _walk_lb(lb:LazyBuffer, lbs:Dict[LazyBuffer, int], bufs:Dict[Buffer, int], nodes:List[Tuple]) -> int:
+  if (n:=lbs.get(lb)) is not None: return n
+  if lb is not lb.base: node: Tuple = (lb.st, _walk_lb(lb.base, lbs, bufs, nodes))
+  elif lb.realized is not None: node = (bufs.setdefault(lb.buffer, len(bufs)), lb.dtype, lb.device, lb.st)
+  else:
+    # NOTE: CONST is never a kernel, so its metadata doesn't end up in the schedule
+    metadata = lb.metadata if lb.op is not MetaOps.CONST else None
+    srcs = tuple(_walk_lb(x, lbs, bufs, nodes) for x in lb.srcs)
+    # the ordering edge of Tensor.checkpoint changes the schedule too
+    after = _walk_lb(lb.after, lbs, bufs, nodes) if lb.after is not None else None
+    node = (lb.op, lb.arg, lb.dtype, lb.device, lb.st, lb.forced_realize, metadata, bufs.setdefault(lb.buffer, len(bufs)), srcs, after)
+  lbs[lb] = len(nodes)
+  nodes.append(node)
+  return lbs[lb]
+
+def _walk_graph(outs:List[LazyBuffer]) -> Optional[Tuple[Tuple, Dict[LazyBuffer, int], Dict[Buffer, int]]]:
+  """returns a canonical key for the graph, along with the LazyBuffers and Buffers numbered in the order they were found"""
+  lbs: Dict[LazyBuffer, int] = {}
+  bufs: Dict[Buffer, int] = {}
+  nodes: List[Tuple] = []
+  out_idxs = tuple(_walk_lb(x, lbs, bufs, nodes) for x in outs)
+  # NOTE: images can be downgraded to float32 in get_realizes, that mutates the graph so it isn't cached
+  if any(isinstance(lb.dtype, ImageDType) for lb in lbs): return None
+  return (tuple(nodes), out_idxs, FUSE_ARANGE.value, FUSE_CONV_BW.value, MEMORY_ORDER.value), lbs, bufs
+
+def _schedule_from_cache(cached:CachedSchedule, lbs:Dict[LazyBuffer, int], bufs:Dict[Buffer, int]) -> Tuple[List[ScheduleItem], Dict[Variable, int]]:
+  lb_list, buf_list = list(lbs), list(bufs)
+  for i in cached.realized_lbs: del lb_list[i].srcs  # can only schedule once
+  schedule = [ScheduleItem(ast, tuple(buf_list[i] for i in idxs), metadata, preloads) for ast,idxs,metadata,preloads in cached.items]
+  if DEBUG >= 1 and len(schedule) >= 10: print(f"scheduled {len(schedule)} kernels from cache")
+  return schedule, dict(cached.var_vals)
+
 # **** Schedule creation and BFS toposort
 
 def _add_realize(realizes:Dict[UOp, UOp], b:UOp, store:UOp, load:UOp) -> Optional[UOp]:
@@ -235,8 +280,19 @@ def _add_realize(realizes:Dict[UOp, UOp], b:UOp, store:UOp, load:UOp) -> Optiona
   return UOp(UOps.LOAD, load.dtype, (b, load.st_arg.to_uop()))
 break_sched = PatternMatcher([(UPat.load(b:=UPat.var("b"), UPat(), UPat.store(b, UPat(), UPat(), name="store"), name="load"), _add_realize),])
 
+def _pop_least_live(queue:Deque[ScheduleItem], uses:Dict[Buffer, int]) -> ScheduleItem:
+  """pops the ready item that grows the live bytes the least, ties go to the most recently readied one to finish a branch before starting another"""
+  def live_delta(si:ScheduleItem) -> int:
+    return sum(b.nbytes for b in si.outputs if not b.is_allocated()) - sum(b.nbytes for b in dedup(si.inputs) if uses.get(b) == 1)
+  queue.remove(si:=min(reversed(queue), key=live_delta))
+  for b in dedup(si.inputs):
+    if b in uses: uses[b] -= 1
+  return si
+
 @track_rewrites(named=True)
 def create_schedule_with_vars(outs:List[LazyBuffer]) -> Tuple[List[ScheduleItem], Dict[Variable, int]]:
+  if (walked:=_walk_graph(outs) if SCHEDULE_CACHE and not getenv("RUN_PROCESS_REPLAY") else None) is not None:
+    if (cached:=schedule_cache.get(walked[0])) is not None: return _schedule_from_cache(cached, walked[1], walked[2])
   store_groups, lazybufs_to_realize, assigns = get_realizes(outs)
   if len(store_groups) == 0: return [], {} # nothing to schedule
   ctx = ScheduleContext(lazybufs_to_realize)
@@ -266,10 +322,17 @@ def create_schedule_with_vars(outs:List[LazyBuffer]) -> Tuple[List[ScheduleItem]
     for x in scheduled_parents:
       graph[x].append(si)
       in_degree[si] += 1
+    # activations recomputed by Tensor.checkpoint wait for the gradient that needs them
+    for x in dedup(xsi for b in si.outputs if (a:=lazybufs_to_realize[b].after) is not None and (xsi:=schedule_targets.get(a.buffer)) is not None):
+      graph[x].append(si)
+      in_degree[si] += 1
   queue = deque(si for si in prescheduled if in_degree[si] == 0)
   schedule: List[ScheduleItem] = []
+  # remaining consumers of each intermediate, the outputs stay alive after the schedule so they are never freed
+  keep = {x.base.buffer for x in outs}
+  uses = Counter(b for si in prescheduled for b in dedup(si.inputs) if b in schedule_targets and b not in keep) if MEMORY_ORDER else Counter()
   while queue:
-    schedule.append(si:=queue.popleft())
+    schedule.append(si:=_pop_least_live(queue, uses) if MEMORY_ORDER else queue.popleft())
     for b in si.outputs: del lazybufs_to_realize[b].srcs  # can only schedule once
     if (m:=BUF_LIMIT.get(device:=si.outputs[0].device)) and len(si.bufs) >= m:
       if DEBUG >= 3: print(si)
@@ -280,6 +343,11 @@ def create_schedule_with_vars(outs:List[LazyBuffer]) -> Tuple[List[ScheduleItem]
   # confirm everything was scheduled correctly
   if len(schedule) != (ps:=len(prescheduled)): raise RuntimeError(f"cycle detected in graph, prescheduled {ps} but only scheduled {len(schedule)}")
   if DEBUG >= 1 and len(schedule) >= 10: print(f"scheduled {len(schedule)} kernels")
+  if walked is not None:
+    key, lbs, bufs = walked
+    if len(schedule_cache) >= getenv("SCHEDULE_CACHE_SIZE", 1000): del schedule_cache[next(iter(schedule_cache))]
+    schedule_cache[key] = CachedSchedule(tuple((si.ast, tuple(bufs[b] for b in si.bufs), si.metadata, si.assign_preloads) for si in schedule),
+                                         tuple(lbs[lazybufs_to_realize[b]] for si in schedule for b in si.outputs), dict(ctx.var_vals))
   return schedule, ctx.var_vals
 
 def create_schedule(outs:List[LazyBuffer]) -> List[ScheduleItem]:
@@ -1,6 +1,6 @@
 """This is where the forwards and backwards passes live."""
 import math
-from typing import Tuple, Optional
+from typing import Callable, Tuple, Optional, Union
 from tinygrad.helpers import argsort
 from tinygrad.dtype import dtypes, DType, sum_acc_dtype
 from tinygrad.ops import ReduceOps, resolve, sint
@@ -15,6 +15,15 @@ class ContiguousBackward(Function):
   def forward(self, x:LazyBuffer) -> LazyBuffer: return x
   def backward(self, grad_output:LazyBuffer) -> LazyBuffer: return grad_output.contiguous()
 
+class Checkpoint(Function):
+  def forward(self, *x:LazyBuffer, ret:LazyBuffer, recompute:Callable[[LazyBuffer], Tuple[Optional[LazyBuffer], ...]]) -> LazyBuffer:
+    self.recompute = recompute
+    return ret
+
+  def backward(self, grad_output:LazyBuffer) -> Union[Optional[LazyBuffer], Tuple[Optional[LazyBuffer], ...]]:
+    grads = self.recompute(grad_output)
+    return grads[0] if len(grads) == 1 else grads
+
 class Cast(Function):
   def forward(self, x:LazyBuffer, dtype:DType, bitcast:bool=False) -> LazyBuffer:
     self.input_dtype, self.bitcast = x.dtype, bitcast
@@ -1,6 +1,6 @@
 from __future__ import annotations
 import os, functools, platform, time, re, contextlib, operator, hashlib, pickle, sqlite3, tempfile, pathlib, string, ctypes, sys, gzip
-import urllib.request, subprocess, shutil, math, contextvars, types, copyreg, inspect, importlib
+import urllib.request, subprocess, shutil, math, contextvars, types, copyreg, inspect, importlib, threading
 from dataclasses import dataclass
 from typing import Dict, Tuple, Union, List, ClassVar, Optional, Iterable, Any, TypeVar, TYPE_CHECKING, Callable, Sequence
 if TYPE_CHECKING:  # TODO: remove this and import TypeGuard from typing once minimum python supported version is 3.10
@@ -105,6 +105,14 @@ PROFILE, PROFILEPATH = ContextVar("PROFILE", 0), ContextVar("PROFILEPATH", temp(
 USE_TC, TC_OPT, AMX, TRANSCENDENTAL = ContextVar("TC", 1), ContextVar("TC_OPT", 0), ContextVar("AMX", 0), ContextVar("TRANSCENDENTAL", 1)
 FUSE_ARANGE, FUSE_CONV_BW, LAZYCACHE = ContextVar("FUSE_ARANGE", 0), ContextVar("FUSE_CONV_BW", 0), ContextVar("LAZYCACHE", 1)
 SPLIT_REDUCEOP, NO_MEMORY_PLANNER, RING = ContextVar("SPLIT_REDUCEOP", 1), ContextVar("NO_MEMORY_PLANNER", 0), ContextVar("RING", 1)
+SCHEDULE_CACHE, COMPILE_AHEAD, MEMORY_ORDER = ContextVar("SCHEDULE_CACHE", 1), ContextVar("COMPILE_AHEAD", 0), ContextVar("MEMORY_ORDER", 0)
+JITCACHE, THREADS = ContextVar("JITCACHE", 0), ContextVar("THREADS", 0)
+# gradients of data parallel training are all-reduced in buckets of this many bytes at the end of backward, like 25<<20.
+# 0 reduces each one where it's computed
+ALLREDUCE_BUCKET = ContextVar("ALLREDUCE_BUCKET", 0)
+# ZeRO stage of data parallel training, 1 shards the optimizer state across the devices, 2 also reduce-scatters the gradients
+ZERO = ContextVar("ZERO", 0)
+MEMPROFILE, MEMPROFILEPATH = ContextVar("MEMPROFILE", 0), ContextVar("MEMPROFILEPATH", temp("tinygrad_memprofile.json"))
 
 @dataclass(frozen=True)
 class Metadata:
@@ -124,8 +132,18 @@ class GlobalCounters:
   time_sum_s: ClassVar[float] = 0.0
   kernel_count: ClassVar[int] = 0
   mem_used: ClassVar[int] = 0   # NOTE: this is not reset
+  # caching allocator stats. NOTE: the mem_ ones are not reset
+  alloc_hits: ClassVar[int] = 0
+  alloc_misses: ClassVar[int] = 0
+  mem_reserved: ClassVar[int] = 0   # held from the devices
+  mem_cached: ClassVar[int] = 0     # held but idle
+  mem_allocated: ClassVar[int] = 0  # requested by live buffers
   @staticmethod
-  def reset(): GlobalCounters.global_ops, GlobalCounters.global_mem, GlobalCounters.time_sum_s, GlobalCounters.kernel_count = 0,0,0.0,0
+  def reset():
+    GlobalCounters.global_ops, GlobalCounters.global_mem, GlobalCounters.time_sum_s, GlobalCounters.kernel_count = 0,0,0.0,0
+    GlobalCounters.alloc_hits, GlobalCounters.alloc_misses = 0,0
+  @staticmethod
+  def fragmentation() -> float: return 1 - GlobalCounters.mem_allocated / GlobalCounters.mem_reserved if GlobalCounters.mem_reserved else 0.0
 
 # **************** timer and profiler ****************
 
@@ -164,17 +182,17 @@ CACHEDB: str = getenv("CACHEDB", os.path.abspath(os.path.join(_cache_dir, "tinyg
 CACHELEVEL = getenv("CACHELEVEL", 2)
 
 VERSION = 16
-_db_connection = None
+# NOTE: sqlite connections can't be shared between threads, so there's one per thread. it's closed when the thread ends
+_db_local = threading.local()
 def db_connection():
-  global _db_connection
-  if _db_connection is None:
+  if (conn:=getattr(_db_local, "conn", None)) is None:
     os.makedirs(CACHEDB.rsplit(os.sep, 1)[0], exist_ok=True)
-    _db_connection = sqlite3.connect(CACHEDB, timeout=60, isolation_level="IMMEDIATE")
+    _db_local.conn = conn = sqlite3.connect(CACHEDB, timeout=60, isolation_level="IMMEDIATE")
     # another connection has set it already or is in the process of setting it
     # that connection will lock the database
-    with contextlib.suppress(sqlite3.OperationalError): _db_connection.execute("PRAGMA journal_mode=WAL").fetchone()
-    if DEBUG >= 7: _db_connection.set_trace_callback(print)
-  return _db_connection
+    with contextlib.suppress(sqlite3.OperationalError): conn.execute("PRAGMA journal_mode=WAL").fetchone()
+    if DEBUG >= 7: conn.set_trace_callback(print)
+  return conn
 
 def diskcache_clear():
   cur = db_connection().cursor()
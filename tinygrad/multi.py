@@ -1,21 +1,39 @@
 from __future__ import annotations
-from typing import Optional, Union, Tuple, List, Dict
-import functools, itertools, operator
-from tinygrad.helpers import all_same, all_int, dedup, prod, DEBUG, RING, getenv
+from typing import Optional, Union, Tuple, List, Dict, cast
+import functools, itertools, operator, contextvars
+from tinygrad.helpers import all_same, all_int, dedup, prod, round_up, DEBUG, RING, getenv
 from tinygrad.dtype import DType
 from tinygrad.ops import REDUCE_ALU, BinaryOps, MetaOps, UnaryOps, TernaryOps, ReduceOps, MathTrait
 from tinygrad.engine.lazy import LazyBuffer
 from tinygrad.shape.shapetracker import sint
 
+def _use_ring(n_lbs:int, dim:int) -> bool:
+  # Ring allreduce doesn't provide a benefit with only 2 nodes or where number of elements is less than 256k (empirically)
+  # so just fallback to naive allreduce to save on kernel dispatch, chunking and reassembling chunks.
+  return RING >= 2 or (n_lbs > 2 and dim > getenv("RING_ALLREDUCE_THRESHOLD", 256_000) and RING >= 1)
+
+# chunked[d][i] is chunk i on device d, in the ring every device sends one chunk to the next one per step. the chunk i ends up on owners[i]
+def _ring_reduce_scatter(bop:BinaryOps, chunked:List[List[LazyBuffer]], devices:Tuple[str, ...], owners:List[int]):
+  n_lbs = len(devices)
+  for step in range(n_lbs - 1):
+    for i,o in enumerate(owners):
+      s, r = (o+step+1)%n_lbs, (o+step+2)%n_lbs
+      chunked[r][i] = chunked[r][i].alu(bop, chunked[s][i].copy_to_device(devices[r], force=True))
+
+def _ring_all_gather(chunked:List[List[Optional[LazyBuffer]]], devices:Tuple[str, ...], owners:List[int]):
+  n_lbs = len(devices)
+  for step in range(n_lbs - 1):
+    for i,o in enumerate(owners):
+      s, r = (o+step)%n_lbs, (o+step+1)%n_lbs
+      chunked[r][i] = cast(LazyBuffer, chunked[s][i]).copy_to_device(devices[r], force=True)
+
 def all_reduce(op: ReduceOps, lbs: List[LazyBuffer]) -> List[LazyBuffer]:
   assert all_int(lbs[0].shape), f"does not support symbolic shape {lbs[0].shape}"
   assert all_same([lb.shape[0] for lb in lbs]), "allreduce with uneven shards is undefined"
   bop = REDUCE_ALU[op]
 
   n_lbs, dim = len(lbs), prod(lbs[0].shape)
-  # Ring allreduce doesn't provide a benefit with only 2 nodes or where number of elements is less than 256k (empirically)
-  # so just fallback to naive allreduce to save on kernel dispatch, chunking and reassembling chunks.
-  use_ring = (RING >= 2 or (n_lbs > 2 and dim > getenv("RING_ALLREDUCE_THRESHOLD", 256_000) and RING >= 1))
+  use_ring = _use_ring(n_lbs, dim)
   if DEBUG >= 2: print(f"{'RING ALLREDUCE' if use_ring else 'NAIVE ALLREDUCE'} {n_lbs}x{dim} | {lbs[0].dtype}")
   if not use_ring:
     return [functools.reduce(lambda x,y: x.alu(bop, y), [x.copy_to_device(lb.device) for x in lbs]) for lb in lbs]
@@ -26,23 +44,97 @@ def all_reduce(op: ReduceOps, lbs: List[LazyBuffer]) -> List[LazyBuffer]:
   chunks = [(acc, (acc := acc + i)) for i in c_lens if i > 0]
   chunked = [[lb.reshape((dim,)).shrink(((s,e),)) for s,e in chunks] for lb in lbs]
 
-  # Scatter-reduce step
-  for step in range(n_lbs - 1):
-    for i in range(len(chunks)):
-      s, r = (i+step)%n_lbs, (i+step+1)%n_lbs
-      chunked[r][i] = chunked[r][i].alu(bop, chunked[s][i].copy_to_device(chunked[r][i].device, force=True))
-
-  # Allgather step
-  for step in range(n_lbs - 1):
-    for i in range(len(chunks)):
-      s, r = (i+step-1)%n_lbs, (i+step)%n_lbs
-      chunked[r][i] = chunked[s][i].copy_to_device(chunked[r][i].device, force=True)
+  # a reduce-scatter followed by an all-gather of the chunks
+  devices, owners = tuple(lb.device for lb in lbs), list(range(len(chunks)))
+  _ring_reduce_scatter(bop, chunked, devices, owners)
+  _ring_all_gather(cast(List[List[Optional[LazyBuffer]]], chunked), devices, owners)
 
   # Assemble chunks back
   pads = [((s,dim-e),) for s,e in chunks]
   return [functools.reduce(lambda x,y: x.alu(BinaryOps.ADD, y),
                            [c.pad(pads[i]) for i,c in enumerate(lb_c)]).reshape(lbs[0].shape) for lb_c in chunked]
 
+# reduces the same shaped lbs, device i only gets the part bounds[i] of axis of the result
+def reduce_scatter(op:ReduceOps, lbs:List[LazyBuffer], axis:int, bounds:Tuple[Tuple[int, int], ...]) -> List[LazyBuffer]:
+  assert all_int(lbs[0].shape), f"does not support symbolic shape {lbs[0].shape}"
+  assert all_same([lb.shape for lb in lbs]) and len(bounds) == len(lbs), "reduce-scatter needs one bound per lb of the same shape"
+  bop, devices = REDUCE_ALU[op], tuple(lb.device for lb in lbs)
+  chunked = [to_sharded([lb]*len(bounds), axis, bounds) for lb in lbs]
+  use_ring = _use_ring(len(lbs), prod(lbs[0].shape))
+  if DEBUG >= 2: print(f"{'RING' if use_ring else 'NAIVE'} REDUCESCATTER {len(lbs)}x{prod(lbs[0].shape)} | {lbs[0].dtype}")
+  if not use_ring: return [functools.reduce(lambda x,y: x.alu(bop, y), [c[i].copy_to_device(d) for c in chunked]) for i,d in enumerate(devices)]
+  _ring_reduce_scatter(bop, chunked, devices, list(range(len(lbs))))
+  return [chunked[i][i] for i in range(len(lbs))]
+
+# every device gets the concatenation of the lbs along axis
+def all_gather(lbs:List[LazyBuffer], axis:int) -> List[LazyBuffer]:
+  assert all_int(lbs[0].shape), f"does not support symbolic shape {lbs[0].shape}"
+  devices = tuple(lb.device for lb in lbs)
+  splits = list(itertools.accumulate([lb.shape[axis] for lb in lbs], initial=0))
+  pads = [tuple((0,0) if a != axis else (st, splits[-1]-en) for a in range(len(lbs[0].shape))) for st,en in zip(splits, splits[1:])]
+  use_ring = _use_ring(len(lbs), sum(lb.size for lb in lbs))
+  if DEBUG >= 2: print(f"{'RING' if use_ring else 'NAIVE'} ALLGATHER {len(lbs)}x{splits[-1]} | {lbs[0].dtype}")
+  if not use_ring: chunked = [[lb.copy_to_device(d) for lb in lbs] for d in devices]
+  else:
+    chunked = cast(List[List[LazyBuffer]], [[lb if i == j else None for i,lb in enumerate(lbs)] for j in range(len(lbs))])
+    _ring_all_gather(cast(List[List[Optional[LazyBuffer]]], chunked), devices, list(range(len(lbs))))
+  return [functools.reduce(lambda x,y: x.alu(BinaryOps.ADD, y), [c.pad(pad) for c,pad in zip(lb_c, pads)]) for lb_c in chunked]
+
+def shard_bounds(total:int, n:int) -> Tuple[Tuple[int, int], ...]:
+  # even split of total into n parts, the last ones are smaller or empty if it doesn't divide
+  sz = round_up(total, n) // n
+  boundaries = tuple(itertools.accumulate([max(0, min(sz, total - sz*i)) for i in range(n)]))
+  return tuple(zip((0,) + boundaries, boundaries))
+
+def shard_axis(shape:Tuple[sint, ...], n:int) -> Optional[int]:
+  # the first axis that splits evenly into n parts
+  return next((a for a,s in enumerate(shape) if isinstance(s, int) and s >= n and s % n == 0), None)
+
+# set in the backward of an expand, a reduce over the sharded axis then leaves a partial sum on every device for bucketed_all_reduce
+DEFER_ALLREDUCE: contextvars.ContextVar[bool] = contextvars.ContextVar("DEFER_ALLREDUCE", default=False)
+
+def bucketed_all_reduce(op:ReduceOps, lbss:List[List[LazyBuffer]], bucket_size:int,
+                        axes:Optional[List[Optional[int]]]=None) -> List[List[LazyBuffer]]:
+  # many small tensors are flattened into buckets of up to bucket_size bytes, each bucket pays for one all_reduce instead of one per tensor
+  # tensors with an axis in axes are reduce-scattered along it instead, device i gets the part shard_bounds(shape[axis], n)[i]
+  ret: List[List[LazyBuffer]] = [[] for _ in lbss]
+  axes = axes or [None]*len(lbss)
+  def shard(lb:LazyBuffer, i:int, d:int) -> LazyBuffer:
+    return lb if (axis:=axes[i]) is None else to_sharded([lb], axis, (shard_bounds(lb.shape[axis], len(lbss[i]))[d],))[0]
+  def flush(idxs:List[int]):
+    n, sharded = len(lbss[idxs[0]]), axes[idxs[0]] is not None
+    if len(idxs) == 1 and not sharded:
+      ret[idxs[0]] = all_reduce(op, lbss[idxs[0]])
+      return
+    # the bucket holds the part of every tensor that goes to device d next to each other, so device d reduces one contiguous region.
+    # the parts start 64 byte aligned, they are used as buffer views by vectorized kernels
+    parts = [(i, d) for d in range(n if sharded else 1) for i in idxs]
+    shapes = [shard(lbss[i][0], i, d).shape for i,d in parts]
+    align = max(1, 64 // lbss[idxs[0]][0].dtype.itemsize)
+    starts = list(itertools.accumulate([round_up(prod(sh), align) for sh in shapes], initial=0))
+    total = starts.pop()
+    flat = [functools.reduce(lambda x,y: x.alu(BinaryOps.ADD, y), [shard(lbss[i][k], i, d).reshape((prod(sh),)).pad(((st, total-st-prod(sh)),))
+                                                                  for (i,d),st,sh in zip(parts, starts, shapes)]) for k in range(n)]
+    if not sharded:
+      reduced = all_reduce(op, flat)
+      for (i,_),st,sh in zip(parts, starts, shapes): ret[i] = [lb.shrink(((st,st+prod(sh)),)).reshape(sh) for lb in reduced]
+      return
+    regions = tuple(zip(starts[::len(idxs)], starts[len(idxs)::len(idxs)] + [total]))
+    reduced = reduce_scatter(op, flat, 0, regions)
+    for (i,d),st,sh in zip(parts, starts, shapes): ret[i].append(reduced[d].shrink(((st-regions[d][0], st-regions[d][0]+prod(sh)),)).reshape(sh))
+  # a bucket only holds tensors of the same dtype on the same devices, it's reduced once it's full
+  buckets: Dict[Tuple[DType, Tuple[str, ...], bool], List[int]] = {}
+  for i,lbs in enumerate(lbss):
+    assert all_int(lbs[0].shape), f"does not support symbolic shape {lbs[0].shape}"
+    bucket = buckets.setdefault((lbs[0].dtype, tuple(lb.device for lb in lbs), axes[i] is not None), [])
+    if bucket and sum(lbss[j][0].size for j in bucket+[i]) * lbs[0].dtype.itemsize > bucket_size:
+      flush(bucket)
+      bucket.clear()
+    bucket.append(i)
+  for bucket in buckets.values():
+    if bucket: flush(bucket)
+  return ret
+
 def to_sharded(lbs:List[LazyBuffer], axis:int, bounds: Tuple[Tuple[int, int], ...]) -> List[LazyBuffer]:
   if DEBUG >= 3 and lbs[0].shape[axis] % len(lbs) != 0: print(f"multi axis uneven: {lbs[0].shape=} {axis=} {len(lbs)=}, bounds={bounds}")
   return [lb.shrink(tuple((0,s) if a != axis else bound for a,s in enumerate(lb.shape))) for i, (bound, lb) in enumerate(zip(bounds, lbs))]
@@ -121,11 +213,25 @@ class MultiLazyBuffer(MathTrait):
     if self.axis is not None and self.axis in axis:
       # all-reduce on sharded axes
       reduced_parts = [(x if r else x.const_like(0)).r(op, axis) for x,r in zip(self.lbs, self.real)]
-      if all(self.real): return MultiLazyBuffer(all_reduce(op, reduced_parts), None)
+      if all(self.real): return MultiLazyBuffer(reduced_parts if DEFER_ALLREDUCE.get() else all_reduce(op, reduced_parts), None)
       return MultiLazyBuffer(reduced_parts, None, self.real)
     # reduce on non sharded axes, piecewise is fine. if axis is None this is also correct
     return MultiLazyBuffer([x.r(op, axis) for x in self.lbs], self.axis, self.real)
 
+  # *** collectives ***
+
+  def reduce_scatter(self, op:ReduceOps, axis:int) -> MultiLazyBuffer:
+    # the lbs are reduced across devices and every device keeps an even shard of the result along axis
+    assert self.axis is None and all(self.real), "reduce-scatter needs a MultiLazyBuffer that isn't sharded"
+    if not isinstance(total:=self.shape[axis], int): raise RuntimeError(f"cannot reduce-scatter symbolic shape {self.shape=}, {axis=}")
+    return MultiLazyBuffer(reduce_scatter(op, self.lbs, axis, shard_bounds(total, len(self.lbs))), axis)
+
+  def all_gather(self) -> MultiLazyBuffer:
+    # every device gets the whole tensor
+    if self.axis is None: return self
+    assert all(self.real), "all-gather needs all lbs to be real"
+    return MultiLazyBuffer(all_gather(self.lbs, self.axis), None)
+
   # *** movement ops ***
 
   def _shape_to_single_shard(self, shape:Tuple[sint, ...], lb:LazyBuffer) -> Tuple[sint, ...]:
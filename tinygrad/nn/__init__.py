@@ -1,10 +1,21 @@
 from __future__ import annotations
 import math
-from typing import Optional, Union, Tuple, List
+from typing import Optional, Union, Tuple, List, Callable
 from tinygrad.tensor import Tensor
+from tinygrad.dtype import dtypes
 from tinygrad.helpers import prod, make_tuple, flatten
 from tinygrad.nn import optim, state, datasets  # noqa: F401
 
+def checkpoint(fn:Callable[..., Tensor], *args) -> Tensor:
+  """
+  Runs `fn(*args)` with activation recomputation, see `Tensor.checkpoint`.
+
+  ```python
+  x = nn.checkpoint(block, x)
+  ```
+  """
+  return Tensor.checkpoint(fn, *args)
+
 class BatchNorm:
   """
   Applies Batch Normalization over a 2D or 3D input.
@@ -180,6 +191,30 @@ class Linear:
   def __call__(self, x:Tensor) -> Tensor:
     return x.linear(self.weight.transpose(), self.bias)
 
+class GGMLLinear:
+  """
+  Applies a linear transformation with a weight that stays in a ggml quantized format (Q4_0, Q4_1, Q8_0 or Q6_K).
+
+  The weight holds the raw blocks as loaded by `nn.state.gguf_load(..., dequantize=False)`.
+  They are dequantized inside the matmul kernel, so only the quantized bytes are ever read from memory.
+
+  ```python exec="true" source="above" session="tensor" result="python"
+  lin = nn.GGMLLinear(64, 4, bias=False, ggml_type=8)
+  print(lin.weight.shape)
+  ```
+  """
+  def __init__(self, in_features:int, out_features:int, bias=True, ggml_type:int=2):
+    block_elements, block_bytes = state.GGML_BLOCKS[ggml_type]
+    assert in_features % block_elements == 0, f"{in_features=} must be a multiple of the {block_elements} elements in a block"
+    self.in_features, self.out_features, self.ggml_type = in_features, out_features, ggml_type
+    self.weight = Tensor.empty(out_features, in_features // block_elements, block_bytes, dtype=dtypes.uint8)
+    bound = 1 / math.sqrt(in_features)
+    self.bias = Tensor.uniform(out_features, low=-bound, high=bound) if bias else None
+
+  def __call__(self, x:Tensor) -> Tensor:
+    weight = state.ggml_dequantize(self.weight, self.ggml_type).reshape(self.out_features, self.in_features).cast(x.dtype)
+    return x.linear(weight.transpose(), self.bias)
+
 class GroupNorm:
   """
   Applies Group Normalization over a mini-batch of inputs.
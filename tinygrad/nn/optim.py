@@ -1,8 +1,23 @@
 # sorted in order of increasing complexity
 from typing import List
-from tinygrad.helpers import dedup, flatten, getenv
+from tinygrad.helpers import dedup, flatten, getenv, ZERO
 from tinygrad.tensor import Tensor
-from tinygrad.dtype import dtypes, least_upper_dtype
+from tinygrad.dtype import DType, dtypes, least_upper_dtype
+from tinygrad.multi import MultiLazyBuffer, shard_axis
+
+def _zeros_like(t:Tensor, dtype:DType) -> Tensor:
+  # with ZERO the state of a parameter replicated on multiple devices is sharded across them, every device holds its part of the update.
+  # it's realized, otherwise the first update could leave it a shrink of the gradient which can't be assigned to
+  if ZERO and isinstance(t.lazydata, MultiLazyBuffer) and t.lazydata.axis is None and (axis:=shard_axis(t.shape, len(t.device))) is not None:
+    return Tensor.zeros(*t.shape, dtype=dtype, device=t.device[0], requires_grad=False).shard(t.device, axis).contiguous()
+  return Tensor.zeros(*t.shape, dtype=dtype, device=t.device, requires_grad=False)
+
+def _gather(x:Tensor, t:Tensor) -> Tensor:
+  # the update of a replicated parameter computed on sharded optimizer state is all-gathered before it's assigned,
+  # the shards are realized first so the assign doesn't read the parameter it writes through a shrink
+  if isinstance(x.lazydata, MultiLazyBuffer) and x.lazydata.axis is not None and isinstance(t.lazydata, MultiLazyBuffer) and t.lazydata.axis is None:
+    return Tensor(x.lazydata.contiguous().all_gather(), device=x.device, requires_grad=False)
+  return x
 
 class Optimizer:
   """
@@ -74,7 +89,7 @@ class LARS(Optimizer):
   def __init__(self, params:List[Tensor], lr=0.001, momentum=0.9, weight_decay=1e-4, nesterov=False, classic=True, tcoef=0.001):
     super().__init__(params, lr)
     self.momentum, self.wd, self.nesterov, self.classic, self.tcoef = momentum, weight_decay, nesterov, classic, tcoef
-    self.b = [Tensor.zeros(*t.shape, dtype=t.dtype, device=t.device, requires_grad=False) for t in self.params] if self.momentum else []
+    self.b = [_zeros_like(t, t.dtype) for t in self.params] if self.momentum else []
 
   def _step(self) -> List[Tensor]:
     for i, t in enumerate(self.params):
@@ -95,7 +110,7 @@ class LARS(Optimizer):
         g = (g + self.momentum * self.b[i]) if self.nesterov else self.b[i]
       # popular momentum does pre learning rate update
       if not self.classic: g = g * r * self.lr
-      t.assign((t.detach() - g).cast(t.dtype))
+      t.assign(_gather((t.detach() - g).cast(t.dtype), t))
     return self.b
 
 # LAMB is essentially just the trust ratio part of LARS applied to Adam/W so if we just set the trust ratio to 1.0 its just Adam/W.
@@ -127,8 +142,8 @@ class LAMB(Optimizer):
     super().__init__(params, lr)
     self.b1, self.b2, self.eps, self.wd, self.adam = b1, b2, eps, weight_decay, adam
     self.b1_t, self.b2_t = (Tensor.ones((1,), dtype=dtypes.float32, device=self.device, requires_grad=False).contiguous() for _ in [b1, b2])
-    self.m = [Tensor.zeros(*t.shape, dtype=dtypes.float32, device=t.device, requires_grad=False).contiguous() for t in self.params]
-    self.v = [Tensor.zeros(*t.shape, dtype=dtypes.float32, device=t.device, requires_grad=False).contiguous() for t in self.params]
+    self.m = [_zeros_like(t, dtypes.float32).contiguous() for t in self.params]
+    self.v = [_zeros_like(t, dtypes.float32).contiguous() for t in self.params]
 
   def _step(self) -> List[Tensor]:
     self.b1_t *= self.b1
@@ -146,5 +161,5 @@ class LAMB(Optimizer):
         r = Tensor.where(r1 > 0, Tensor.where(r2 > 0, r1 / r2, 1.0), 1.0)
       else:
         r = 1.0
-      t.assign((t.detach() - self.lr * r * up).cast(t.dtype))
+      t.assign(_gather((t.detach() - self.lr * r * up).cast(t.dtype), t))
     return [self.b1_t, self.b2_t] + self.m + self.v
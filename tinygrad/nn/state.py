@@ -1,8 +1,11 @@
 import os, json, pathlib, zipfile, pickle, tarfile, struct, functools
-from typing import Dict, Union, List, Optional, Any, Tuple, Callable
+from typing import Dict, Union, List, Optional, Any, Tuple, Callable, Iterator, MutableMapping, cast
 from tinygrad.tensor import Tensor
+from tinygrad.device import Buffer, Device
+from tinygrad.engine.lazy import LazyBuffer
+from tinygrad.ops import MetaOps
 from tinygrad.dtype import dtypes
-from tinygrad.helpers import prod, argsort, DEBUG, Timing, CI, unwrap, GlobalCounters, tqdm
+from tinygrad.helpers import prod, argsort, all_int, DEBUG, Timing, CI, unwrap, GlobalCounters, tqdm
 from tinygrad.shape.view import strides_for_shape
 from tinygrad.multi import MultiLazyBuffer
 
@@ -18,14 +21,41 @@ def safe_load_metadata(fn:Union[Tensor,str]) -> Tuple[Tensor, int, Any]:
   json_len = t[0:8].bitcast(dtypes.int64).item()
   return t, json_len, json.loads(t[8:8+json_len].data().tobytes())
 
+class SafeShards(MutableMapping[str, Tensor]):
+  """
+  The state_dict of a sharded .safetensors checkpoint, described by a .safetensors.index.json.
+  Each shard is only opened when one of its tensors is first accessed.
+  """
+  def __init__(self, fn:str):
+    with open(fn) as f: index = json.load(f)
+    self.weight_map: Dict[str, str] = dict(index["weight_map"])
+    self.metadata: Dict[str, Any] = index.get("metadata", {})
+    self.shards: Dict[str, Dict[str, Tensor]] = {}
+    self.replaced: Dict[str, Tensor] = {}
+    self.root = pathlib.Path(fn).parent
+  def shard(self, name:str) -> Dict[str, Tensor]:
+    if name not in self.shards: self.shards[name] = safe_load(str(self.root / name))
+    return self.shards[name]
+  def __getitem__(self, k:str) -> Tensor: return self.replaced[k] if k in self.replaced else self.shard(self.weight_map[k])[k]
+  def __setitem__(self, k:str, v:Tensor): self.replaced[k] = v
+  def __delitem__(self, k:str):
+    if k not in self: raise KeyError(k)
+    if (name:=self.weight_map.pop(k, None)) in self.shards: self.shards[name].pop(k)
+    self.replaced.pop(k, None)
+  def __contains__(self, k) -> bool: return k in self.weight_map or k in self.replaced
+  def __iter__(self) -> Iterator[str]: return iter({**self.weight_map, **self.replaced})
+  def __len__(self) -> int: return len(self.weight_map.keys() | self.replaced.keys())
+
 def safe_load(fn:Union[Tensor,str]) -> Dict[str, Tensor]:
   """
   Loads a .safetensor file from disk, returning the state_dict.
+  A .safetensors.index.json loads all the shards it lists into one state_dict, the shards are opened when they are used.
 
   ```python
   state_dict = nn.state.safe_load("test.safetensor")
   ```
   """
+  if isinstance(fn, str) and fn.endswith(".index.json"): return cast(Dict[str, Tensor], SafeShards(fn))
   t, json_len, metadata = safe_load_metadata(fn)
   ret = {}
   for k,v in metadata.items():
@@ -35,15 +65,30 @@ def safe_load(fn:Union[Tensor,str]) -> Dict[str, Tensor]:
     ret[k] = t[8+json_len+v['data_offsets'][0]:8+json_len+v['data_offsets'][0]+sz].bitcast(dtype).reshape(v['shape'])
   return ret
 
-def safe_save(tensors:Dict[str, Tensor], fn:str, metadata:Optional[Dict[str, Any]]=None):
+def safe_save(tensors:Dict[str, Tensor], fn:str, metadata:Optional[Dict[str, Any]]=None, max_shard_size:Optional[int]=None) -> str:
   """
   Saves a state_dict to disk in a .safetensor file with optional metadata.
+  If the tensors are more than `max_shard_size` bytes, they are split into `model-00001-of-0000N.safetensors` files next to `fn`
+  and a `fn.index.json` that `safe_load` reads. Returns the file to load.
 
   ```python
   t = Tensor([1, 2, 3])
   nn.state.safe_save({'t':t}, "test.safetensor")
   ```
   """
+  if max_shard_size is not None and sum(v.nbytes() for v in tensors.values()) > max_shard_size:
+    shards: List[Dict[str, Tensor]] = [{}]
+    size = 0
+    for k,v in tensors.items():
+      if shards[-1] and size + v.nbytes() > max_shard_size: shards, size = shards + [{}], 0
+      shards[-1][k], size = v, size + v.nbytes()
+    stem, weight_map = pathlib.Path(fn).stem, {}
+    for i,shard in enumerate(shards):
+      safe_save(shard, str(pathlib.Path(fn).with_name(name:=f"{stem}-{i+1:05d}-of-{len(shards):05d}.safetensors")), metadata)
+      weight_map.update({k:name for k in shard})
+    index = {"metadata": {**(metadata or {}), "total_size": sum(v.nbytes() for v in tensors.values())}, "weight_map": weight_map}
+    with open(fn+".index.json", "w") as f: json.dump(index, f, indent=2)
+    return fn+".index.json"
   headers, offset = {}, 0
   if metadata: headers['__metadata__'] = metadata
   for k,v in tensors.items():
@@ -56,6 +101,8 @@ def safe_save(tensors:Dict[str, Tensor], fn:str, metadata:Optional[Dict[str, Any
   t[0:8].bitcast(dtypes.int64).assign([len(j)])
   t[8:8+len(j)].assign(list(j.encode('utf-8')))
   for k,v in safe_load(t).items(): v.assign(tensors[k])
+  Device[t.device].synchronize()
+  return fn
 
 # state dict
 
@@ -98,6 +145,60 @@ def get_parameters(obj) -> List[Tensor]:
   """
   return list(get_state_dict(obj).values())
 
+def _disk_views(ts:Dict[str, Tensor]) -> Dict[str, LazyBuffer]:
+  # tensors that are a whole DISK buffer, maybe permuted. loading those is a straight read of the buffer and doesn't need a schedule
+  def is_view(lb:LazyBuffer) -> bool:
+    return lb.base.realized is not None or lb.base.op is MetaOps.EMPTY or (lb.base.op is MetaOps.VIEW and is_view(lb.base.srcs[0]))
+  return {k:lb for k,t in ts.items() if isinstance(lb:=t.lazydata, LazyBuffer) and lb.device.startswith("DISK") and lb.size == lb.base.size
+          and all(v.mask is None for v in lb.st.views) and is_view(lb)}
+
+def _disk_sink(dest:Buffer) -> Callable[[int, memoryview], None]:
+  if hasattr(dest.allocator, "as_buffer"):
+    mv = dest.as_buffer(force_zero_copy=True)
+    def sink(off:int, data:memoryview): mv[off:off+len(data)] = data
+    return sink
+  # the data is gone after the callback and copyin can be async, so it is staged until the whole buffer arrived
+  staged, left = memoryview(bytearray(dest.nbytes)), dest.nbytes
+  def staged_sink(off:int, data:memoryview):
+    nonlocal left
+    staged[off:off+len(data)] = data
+    if (left := left - len(data)) == 0: dest.copyin(staged)
+  return staged_sink
+
+def _storage_order(lb:LazyBuffer) -> Optional[List[int]]:
+  # the axes of a DISK view from the outermost in the file, if it's a permute of the whole buffer
+  if len(lb.st.views) != 1 or (v:=lb.st.views[0]).offset != 0 or v.mask is not None or not all_int(v.shape): return None
+  order = argsort([-st for st in v.strides])
+  return order if tuple(v.strides[i] for i in order) == strides_for_shape(tuple(v.shape[i] for i in order)) else None
+
+def _strided_sink(sink:Callable[[int, memoryview], None], chunk:int, stride:int) -> Callable[[int, memoryview], None]:
+  # only the first `chunk` bytes of every `stride` bytes read are for this sink
+  def strided_sink(off:int, data:memoryview):
+    for r in range(off // stride, (off + len(data) + stride - 1) // stride):
+      if (st:=max(off, r*stride)) < (en:=min(off+len(data), r*stride+chunk)): sink(r*chunk + st - r*stride, data[st-off:en-off])
+  return strided_sink
+
+def _disk_dest(shape:Tuple[int, ...], dtype, device:str) -> LazyBuffer:
+  if (ret:=cast(LazyBuffer, Tensor.empty(*shape, dtype=dtype, device=device).lazydata)).size:
+    ret.buffer.allocate()
+    del ret.srcs # fake realize
+  return ret
+
+def _disk_shard(lb:LazyBuffer, device:str, axis:Optional[int], bound:Optional[Tuple[int, int]],
+                reads:List[Tuple[Any, Callable[[int, memoryview], None]]]) -> LazyBuffer:
+  # the slice of a DISK view on one device is read in file order, with one offset read per device when the slice is a range of the file
+  order, src = cast(List[int], _storage_order(lb)), lb.base.buffer.ensure_allocated()
+  shape = tuple(lb.shape[i] if i != axis or bound is None else bound[1]-bound[0] for i in order)
+  dest = _disk_dest(shape, lb.dtype, device)
+  if axis is None or bound is None: reads.append((src._buf, _disk_sink(dest.buffer)))
+  elif dest.size:
+    ax = order.index(axis)
+    inner = prod(shape[ax+1:]) * lb.dtype.itemsize
+    chunk, stride, outer = shape[ax] * inner, lb.shape[axis] * inner, prod(shape[:ax])
+    sink = _disk_sink(dest.buffer) if outer == 1 or chunk == stride else _strided_sink(_disk_sink(dest.buffer), chunk, stride)
+    reads.append((src.view(((outer-1)*stride + chunk) // lb.dtype.itemsize, lb.dtype, bound[0]*inner).ensure_allocated()._buf, sink))
+  return dest.permute(tuple(argsort(order)))
+
 def load_state_dict(model, state_dict:Dict[str, Tensor], strict=True, verbose=True, consume=False) -> None:
   """
   Loads a state_dict into a model.
@@ -118,8 +219,31 @@ def load_state_dict(model, state_dict:Dict[str, Tensor], strict=True, verbose=Tr
     model_state_dict = get_state_dict(model)
     if DEBUG >= 1 and len(state_dict) > len(model_state_dict):
       print("WARNING: unused weights in state_dict", sorted(list(state_dict.keys() - model_state_dict.keys())))
+    # plain reads from disk are all submitted together and land on the devices as they complete
+    bulk = _disk_views({k:state_dict[k] for k,v in model_state_dict.items() if k in state_dict and not (isinstance(v.device, str)
+                        and v.device.startswith("DISK"))})
+    # sharded weights are read straight into their shards, each device only gets its slice
+    bulk = {k:lb for k,lb in bulk.items() if not isinstance(model_state_dict[k].lazydata, MultiLazyBuffer) or _storage_order(lb) is not None}
+    if bulk:
+      from tinygrad.runtime.ops_disk import copyout_batch
+      reads: List[Tuple[Any, Callable[[int, memoryview], None]]] = []
+      loaded: Dict[str, Tensor] = {}
+      for k,lb in bulk.items():
+        if isinstance(mlb:=model_state_dict[k].lazydata, MultiLazyBuffer):
+          shards = [_disk_shard(lb, d, mlb.axis, b, reads) for d,b in zip(mlb.device, mlb.bounds if mlb.axis is not None else [None]*len(mlb.device))]
+          loaded[k] = Tensor(MultiLazyBuffer(shards, mlb.axis), device=mlb.device)
+        else:
+          dest = _disk_dest(lb.base.shape, lb.dtype, model_state_dict[k].device)
+          reads.append((lb.base.buffer.ensure_allocated()._buf, _disk_sink(dest.buffer)))
+          # permuted tensors are read as stored, the permute stays a view on their device
+          loaded[k] = Tensor(dest._view(lb.st))
+      copyout_batch(reads)
+      for k,v in loaded.items():
+        model_state_dict[k].replace(v)
+        if consume: del state_dict[k]
     for k,v in (t := tqdm(model_state_dict.items(), disable=CI or not verbose)):
       t.desc = f"ram used: {GlobalCounters.mem_used/1e9:5.2f} GB, {k:50s}: "
+      if k in bulk: continue
       if k not in state_dict and not strict:
         if DEBUG >= 1: print(f"WARNING: not loading {k}")
         continue
@@ -162,16 +286,13 @@ def torch_load(fn:str) -> Dict[str, Tensor]:
     byte_offset = offsets[storage[2]]+storage_offset*storage[1].itemsize
     ret = t[byte_offset:byte_offset+prod(size)*storage[1].itemsize].bitcast(storage[1])
 
-    # 7 lines to deal with permuted tensors. NOTE: this currently requires reading off the disk
+    # permuted tensors stay a view on the disk, the storage is read as is and the permute happens on the device it's copied to
     shape_strides = [(s, st) for s,st in zip(size, stride) if s != 1]
-    permute_indexes = [len(shape_strides)-1-y for y in argsort([x[1] for x in shape_strides])]
-    if tuple(permute_indexes) != tuple(range(len(permute_indexes))):
-      intermediate_shape = tuple([shape_strides[x][0] for x in argsort(permute_indexes)])
-      assert tuple([shape_strides[i][1] for i in argsort(permute_indexes)]) == strides_for_shape(intermediate_shape), "nonpermutable strides"
-      if DEBUG >= 3: print(f"WARNING: this torch load is slow. CLANG to permute {intermediate_shape} with {permute_indexes}")
-      assert storage[1] != dtypes.bfloat16, "can't CLANG permute BF16"
-      # TODO: find a nice way to support all shapetracker on disktensors
-      ret = ret.to(None).reshape(intermediate_shape).permute(permute_indexes)
+    storage_order = argsort([-st for _,st in shape_strides])
+    if storage_order != list(range(len(storage_order))):
+      intermediate_shape = tuple(shape_strides[i][0] for i in storage_order)
+      assert tuple(shape_strides[i][1] for i in storage_order) == strides_for_shape(intermediate_shape), "nonpermutable strides"
+      ret = ret.reshape(intermediate_shape).permute(argsort(storage_order))
 
     return ret.reshape(size)
 
@@ -227,6 +348,33 @@ def torch_load(fn:str) -> Dict[str, Tensor]:
       f.seek(rwd)
       return TorchPickle(f).load()
 
+# ggml quantized types, (elements, bytes) of a block
+GGML_BLOCKS = {2: (32, 18), 3: (32, 20), 8: (32, 34), 14: (256, 210)}
+
+def ggml_dequantize(blocks: Tensor, ggml_type: int) -> Tensor:
+  """
+  Dequantizes ggml blocks of shape (..., block bytes) to float32 of shape (..., block elements).
+
+  Supported quantized types: Q4_0 (id: 2), Q4_1 (id: 3), Q8_0 (id: 8), Q6_K (id: 14)
+  """
+  if ggml_type not in GGML_BLOCKS: raise ValueError(f"GGML type '{ggml_type}' is not supported!")
+  # NOTE: bytes are expanded before any math and there are no divisions, so this fuses into the kernel using it (like a matmul)
+  def f16(i: int) -> Tensor:
+    lo, hi = (blocks[..., j:j+1].expand(*blocks.shape[:-1], GGML_BLOCKS[ggml_type][0]).cast(dtypes.uint16) for j in (i, i+1))
+    return (lo + hi * 256).bitcast(dtypes.float16).cast(dtypes.float32)
+  def fields(t: Tensor, b: int) -> Tensor:
+    # the b bit fields of each byte, lowest first, one after the other along the last axis
+    return Tensor.cat(*[t.bitwise_and(((1 << b) - 1) << s).cast(dtypes.float32) * 2.0**-s for s in range(0, 8, b)], dim=-1)
+
+  if ggml_type == 2: return (fields(blocks[..., 2:], 4) - 8) * f16(0)
+  if ggml_type == 3: return fields(blocks[..., 4:], 4) * f16(0) + f16(2)
+  if ggml_type == 8: return blocks[..., 2:].bitcast(dtypes.int8).cast(dtypes.float32) * f16(0)
+  # Q6_K
+  xl = fields(blocks[..., :128].reshape(*blocks.shape[:-1], 2, 64), 4)
+  xh = fields(blocks[..., 128:192].reshape(*blocks.shape[:-1], 2, 32), 2)
+  scales = blocks[..., 192:208].bitcast(dtypes.int8).unsqueeze(-1).expand(*blocks.shape[:-1], 16, 16).reshape(*blocks.shape[:-1], 256)
+  return f16(208) * (xl + xh * 16 - 32).flatten(-2) * scales.cast(dtypes.float32)
+
 def ggml_data_to_tensor(t: Tensor, n: int, ggml_type: int) -> Tensor:
   """
   Converts ggml tensor data to a tinygrad tensor.
@@ -240,29 +388,14 @@ def ggml_data_to_tensor(t: Tensor, n: int, ggml_type: int) -> Tensor:
   if (dtype := { 0: dtypes.float32, 1: dtypes.float16, 16: dtypes.int8, 17: dtypes.int16, 18: dtypes.int32 }.get(ggml_type)) is not None:
     return t[:dtype.itemsize * n].bitcast(dtype)
 
-  def q_to_uint8(t: Tensor, b: int) -> Tensor:
-    # TODO: rewrite with arange?
-    shift_tensor, bitmask = Tensor.stack(*[ Tensor(2**(i*b), device=t.device, dtype=t.dtype) for i in range(8//b) ]), 0xff >> (8 - b)
-    return t.unsqueeze(-1).expand((*t.shape,8//b)).idiv(shift_tensor).bitwise_and(bitmask).transpose(-1, -2).flatten(-2)
-
-  # map to (number of elements, number of bytes)
-  if (nelements_nbytes := { 2: (32, 18), 3: (32, 20), 14: (256, 210), 8: (32, 34) }.get(ggml_type)) is not None:
-    blocks = t[:(n//nelements_nbytes[0])*nelements_nbytes[1]].reshape((-1, nelements_nbytes[1]))
-    if ggml_type == 2: return (q_to_uint8(blocks[:,2:], 4).bitcast(dtypes.int8) - 8) * blocks[:,:2].bitcast(dtypes.float16).cast(dtypes.float32)
-    if ggml_type == 3:
-      d, m = (blocks[:,s:s+2].bitcast(dtypes.float16).cast(dtypes.float32) for s in [ 0, 2 ])
-      return q_to_uint8(blocks[:,4:], 4).bitcast(dtypes.int8) * d + m
-    if ggml_type == 8: return blocks[:,:2].bitcast(dtypes.float16).cast(dtypes.float32) * blocks[:,2:].bitcast(dtypes.int8)
-    if ggml_type == 14:
-      xl, xh = q_to_uint8(blocks[:,:128].reshape((-1, 2, 64)), 4), q_to_uint8(blocks[:,128:192].reshape((-1, 2, 32)), 2).lshift(4)
-      scales = blocks[:,192:208].bitcast(dtypes.int8).unsqueeze(-1).expand((-1, 16, 16)).reshape((-1, 256))
-      d = blocks[:,-2:].bitcast(dtypes.float16).cast(dtypes.float32).expand((-1, 256))
-      return d * (xl.bitwise_or(xh).bitcast(dtypes.int8) - 32).flatten(-2) * scales
+  if (nelements_nbytes := GGML_BLOCKS.get(ggml_type)) is not None:
+    return ggml_dequantize(t[:(n//nelements_nbytes[0])*nelements_nbytes[1]].reshape((-1, nelements_nbytes[1])), ggml_type)
   raise ValueError(f"GGML type '{ggml_type}' is not supported!")
 
-def gguf_load(tensor: Tensor) -> Tuple[Dict, Dict[str, Tensor]]:
+def gguf_load(tensor: Tensor, dequantize=True) -> Tuple[Dict, Dict[str, Tensor]]:
   """
   Loads a gguf file from a tensor.
+  With `dequantize=False`, quantized weights stay the raw uint8 blocks of shape (..., blocks per row, block bytes), see `nn.GGMLLinear`.
 
   ```python
   fn = "Meta-Llama-3-8B-Instruct.Q4_0.gguf"
@@ -296,6 +429,10 @@ def gguf_load(tensor: Tensor) -> Tuple[Dict, Dict[str, Tensor]]:
   alignment = kv_data.get("general.alignment", 32)
   data_start = pos = pos + (alignment - pos % alignment if pos % alignment != 0 else 0)
 
-  for name, dims, typ, off in t_infos: state_dict[name] = ggml_data_to_tensor(tensor[data_start + off:], prod(dims), typ).reshape(*reversed(dims))
+  for name, dims, typ, off in t_infos:
+    if not dequantize and (nelements_nbytes := GGML_BLOCKS.get(typ)) is not None:
+      nblocks = prod(dims) // nelements_nbytes[0]
+      state_dict[name] = tensor[data_start+off:data_start+off+nblocks*nelements_nbytes[1]].reshape(*reversed(dims[1:]), -1, nelements_nbytes[1])
+    else: state_dict[name] = ggml_data_to_tensor(tensor[data_start + off:], prod(dims), typ).reshape(*reversed(dims))
 
   return kv_data, state_dict
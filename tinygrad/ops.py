@@ -446,6 +446,7 @@ class KernelInfo:
   local_dims: int = 0           # number of local dimensions  (this is remapping RANGE to SPECIAL)
   upcasted: int = 0             # count that are upcasted     (this is remapping RANGE to EXPAND)
   dont_use_locals: bool = False # don't use local indexing
+  threaded: bool = False        # first global dim is split across cores (this is remapping RANGE to SPECIAL)
 
 # ***** ops in python *****
 
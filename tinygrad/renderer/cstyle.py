@@ -167,12 +167,14 @@ class ClangRenderer(CStyleLanguage):
   device = "CLANG"
   float4 = "(float4)"
   has_local = False
+  has_threads = True
   global_max = None
   infinity = "__builtin_inff()"
   nan = '__builtin_nanf("")'
 
   # language options
   buffer_suffix = " restrict"
+  code_for_workitem = {"c": lambda _: "core_id"}
   type_map = {dtypes.bool:"_Bool", dtypes.half:"__fp16"}
   code_for_op = {**({k:v for k,v in CStyleLanguage.code_for_op.items() if k not in [UnaryOps.EXP2, UnaryOps.SIN, UnaryOps.LOG2]}),
                  UnaryOps.SQRT: lambda x,dtype: f"__builtin_sqrt({x})" if dtype == dtypes.float64 else f"__builtin_sqrtf({x})"}
@@ -186,6 +188,8 @@ class ClangRenderer(CStyleLanguage):
 
   def render_kernel(self, function_name, kernel, bufs, uops, prefix=None) -> str:
     prefix = [self.render_vector_prefix(dt) for dt in uops_to_dtypes(uops) if dt.count > 1]
+    # threaded kernels get the index of their chunk as the last arg
+    if any(u.op is UOps.SPECIAL for u in uops): bufs = bufs + [("core_id", (dtypes.int, False))]
     # https://github.com/corsix/amx
     for name, (N, M, _), dtype_in, _, _, _, _, _ in dedup([uop.arg for uop in uops if uop.op is UOps.WMMA]):
       prefix += [
@@ -428,6 +432,7 @@ class AMDRenderer(CStyleLanguage):
 class DSPRenderer(ClangRenderer):
   device = "DSP"
   supports_float4 = False
+  has_threads = False
   buffer_suffix = " restrict __attribute__((align_value(128)))"
   kernel_prefix = "__attribute__((noinline)) "
   type_map = { **ClangRenderer.type_map, dtypes.uint64: "unsigned long long", dtypes.int64: "long long" }
@@ -1,4 +1,4 @@
-from typing import List, Dict, cast
+from typing import List, Dict, Optional, Tuple, cast
 import ctypes
 from tinygrad.helpers import dedup, cpu_time_execution, DEBUG
 from tinygrad.engine.jit import GraphRunner, GraphException
@@ -14,26 +14,36 @@ class ClangGraph(GraphRunner):
     super().__init__(jit_cache, input_rawbuffers, var_vals)
     if not all(isinstance(ji.prg, CompiledRunner) for ji in jit_cache): raise GraphException
 
-    prgs = '\n'.join(dedup([cast(CompiledRunner, ji.prg).p.src for ji in jit_cache]))
-    args = [f"{render_dtype(x.dtype)}* arg{i}" for i,x in enumerate(input_rawbuffers)]
-    args += sorted([f"int {v.expr}" for v in var_vals])
-    code = ["void batched("+','.join(args)+") {"]
+    # buffers are passed in a pointer table so the code doesn't depend on where they are allocated and can be cached
+    bufs = dedup([cast(Buffer, buf) for ji in jit_cache for buf in ji.bufs])
+    self.table = (ctypes.c_void_p * len(bufs))(*[ctypes.addressof(buf._buf) if buf not in input_rawbuffers else None for buf in bufs])
+    self.input_slots = {bufs.index(buf):i for i,buf in enumerate(input_rawbuffers) if buf in bufs}
+
+    # kernels run back to back in one call, except a threaded kernel gets its own call so the runtime can spread its chunks across the cores
+    stages: List[List[ExecItem]] = []
     for ji in jit_cache:
-      args = []
-      for buf in ji.bufs:
-        assert buf is not None
-        if buf in input_rawbuffers:
-          args.append(f"arg{input_rawbuffers.index(buf)}")
-        else:
-          args.append(f"({render_dtype(buf.dtype)}*)0x{ctypes.addressof(buf._buf):X}")
-      args += [x.expr for x in cast(CompiledRunner, ji.prg).p.vars]
-      code.append(f"  {cast(CompiledRunner, ji.prg).p.function_name}({','.join(args)});")
-    code.append("}")
+      if not stages or cast(CompiledRunner, ji.prg).p.global_size is not None or cast(CompiledRunner, stages[-1][0].prg).p.global_size is not None:
+        stages.append([])
+      stages[-1].append(ji)
+
+    prgs = '\n'.join(dedup([cast(CompiledRunner, ji.prg).p.src for ji in jit_cache]))
+    code, global_sizes = [], []
+    for i,stage in enumerate(stages):
+      global_sizes.append(gs if (gs:=cast(CompiledRunner, stage[0].prg).p.global_size) is None else tuple(gs))
+      params = ["void** bufs"] + sorted([f"int {v.expr}" for v in var_vals]) + ["int core_id"]*(gs is not None)
+      code.append(f"void batched{i}({','.join(params)}) {{")
+      for ji in stage:
+        args = [f"({render_dtype(buf.dtype)}*)bufs[{bufs.index(buf)}]" for buf in cast(List[Buffer], ji.bufs)]
+        args += [x.expr for x in cast(CompiledRunner, ji.prg).p.vars] + ["core_id"]*(gs is not None)
+        code.append(f"  {cast(CompiledRunner, ji.prg).p.function_name}({','.join(args)});")
+      code.append("}")
     if DEBUG >= 4: print("\n".join(code))
     compiler = Device["CLANG"].compiler
     assert compiler is not None
-    self.clprg = ClangProgram("batched", compiler.compile(prgs+"\n"+"\n".join(code))) # no point in caching the pointers
+    lib = compiler.compile_cached(prgs+"\n"+"\n".join(code))
+    self.clprgs: List[Tuple[ClangProgram, Optional[Tuple[int, ...]]]] = [(ClangProgram(f"batched{i}", lib), gs) for i,gs in enumerate(global_sizes)]
 
   def __call__(self, rawbufs: List[Buffer], var_vals: Dict[Variable, int], wait=False):
-    return cpu_time_execution(
-    lambda: self.clprg(*[x._buf for x in rawbufs], *[x[1] for x in sorted(var_vals.items(), key=lambda x: x[0].expr)]), enable=wait)
\ No newline at end of file
+    for slot,i in self.input_slots.items(): self.table[slot] = ctypes.addressof(rawbufs[i]._buf)
+    vals = [x[1] for x in sorted(var_vals.items(), key=lambda x: x[0].expr)]
+    return cpu_time_execution(lambda: [clprg(self.table, global_size=gs, vals=vals) for clprg,gs in self.clprgs], enable=wait)
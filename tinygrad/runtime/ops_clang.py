@@ -1,7 +1,9 @@
-from typing import Optional, List
-import ctypes, subprocess, pathlib, tempfile
-from tinygrad.device import Compiled, Compiler, MallocAllocator
-from tinygrad.helpers import cpu_time_execution, DEBUG, cpu_objdump
+from typing import Optional, List, Tuple
+import ctypes, subprocess, pathlib, tempfile, functools, os, re, itertools
+from concurrent.futures import ThreadPoolExecutor
+from weakref import WeakValueDictionary
+from tinygrad.device import Compiled, Compiler, host_allocator
+from tinygrad.helpers import cpu_time_execution, DEBUG, cpu_objdump, THREADS, dedup, diskcache_get
 from tinygrad.renderer.cstyle import ClangRenderer
 
 class ClangCompiler(Compiler):
@@ -16,18 +18,53 @@ class ClangCompiler(Compiler):
                                '-', '-o', str(output_file.name)], input=src.encode('utf-8'))
       return pathlib.Path(output_file.name).read_bytes()
 
+  def compile_batch(self, srcs:List[str]) -> List[bytes]:
+    # the kernels that aren't cached go in one library with a single clang call, as long as they don't define the same functions
+    batch, defined = [], set()
+    for src in dedup(srcs):
+      if self.cachekey is not None and diskcache_get(self.cachekey, src) is not None: continue
+      if defined.isdisjoint(fxns:=re.findall(r"^\w[^;=]*?\b(\w+)\([^;{]*\)\s*\{", src, re.M)): batch, defined = batch+[src], defined|set(fxns)
+    if len(batch) < 2: return super().compile_batch(srcs)
+    try: lib = self.compile_cached('\n'.join(batch))
+    except subprocess.CalledProcessError: return super().compile_batch(srcs)
+    return [lib if src in batch else self.compile_cached(src) for src in srcs]
+
+# NOTE: ctypes releases the GIL for the duration of the call, so the chunks of a threaded kernel run in parallel
+@functools.lru_cache(None)
+def thread_pool() -> ThreadPoolExecutor: return ThreadPoolExecutor(THREADS.value if THREADS.value > 1 else os.cpu_count(), "clang")
+
+_loaded_libs: WeakValueDictionary[bytes, ctypes.CDLL] = WeakValueDictionary()
+_load_cnt = itertools.count()
+def load_lib(lib:bytes) -> ctypes.CDLL:
+  if (ret:=_loaded_libs.get(lib)) is not None: return ret
+  if hasattr(os, "memfd_create"):
+    fd = os.memfd_create("tinygrad_clang")
+    try:
+      with open(fd, "wb", closefd=False) as f: f.write(lib)
+      # NOTE: dlopen hands back a loaded library with the same path and fd numbers get reused, so every load spells the path differently
+      ret = _loaded_libs[lib] = ctypes.CDLL("/proc/self" + ''.join("/." if b == "1" else "//" for b in f"{next(_load_cnt):b}") + f"/fd/{fd}")
+    finally: os.close(fd)
+  else:
+    # write to disk so we can load it
+    with tempfile.NamedTemporaryFile(delete=True) as cached_file_path:
+      pathlib.Path(cached_file_path.name).write_bytes(lib)
+      ret = _loaded_libs[lib] = ctypes.CDLL(str(cached_file_path.name))
+  return ret
+
 class ClangProgram:
   def __init__(self, name:str, lib:bytes):
     if DEBUG >= 6: cpu_objdump(lib)
     self.name, self.lib = name, lib
-    # write to disk so we can load it
-    with tempfile.NamedTemporaryFile(delete=True) as cached_file_path:
-      pathlib.Path(cached_file_path.name).write_bytes(lib)
-      self.fxn = ctypes.CDLL(str(cached_file_path.name))[name]
+    # the library can hold other kernels from the same batch
+    self.dll = load_lib(lib)
+    self.fxn = self.dll[name]
 
-  def __call__(self, *bufs, vals=(), wait=False): return cpu_time_execution(lambda: self.fxn(*bufs, *vals), enable=wait)
+  def __call__(self, *bufs, global_size:Optional[Tuple[int,int,int]]=None, local_size:Optional[Tuple[int,int,int]]=None, vals=(), wait=False):
+    if global_size is None: return cpu_time_execution(lambda: self.fxn(*bufs, *vals), enable=wait)
+    # threaded kernel, global_size[0] is the number of chunks and the chunk index is the last arg
+    return cpu_time_execution(lambda: list(thread_pool().map(functools.partial(self.fxn, *bufs, *vals), range(global_size[0]))), enable=wait)
 
 class ClangDevice(Compiled):
   def __init__(self, device:str):
     from tinygrad.runtime.graph.clang import ClangGraph
-    super().__init__(device, MallocAllocator, ClangRenderer(), ClangCompiler(), ClangProgram, ClangGraph)
+    super().__init__(device, host_allocator(device), ClangRenderer(), ClangCompiler(), ClangProgram, ClangGraph)
@@ -1,7 +1,8 @@
 from __future__ import annotations
 import os, sys, mmap, io, ctypes, ctypes.util, contextlib
-from typing import Optional, Generator, Tuple, Callable, List
-from tinygrad.helpers import OSX, round_up
+from collections import defaultdict
+from typing import Optional, Generator, Tuple, Callable, List, DefaultDict, Dict
+from tinygrad.helpers import OSX, round_up, getenv, mv_address
 from tinygrad.device import Compiled, Allocator
 with contextlib.suppress(ImportError):
   import _posixshmem
@@ -22,9 +23,17 @@ class DiskAllocator(Allocator):
     self.device._might_open(size)
     return DiskBuffer(self.device, size)
   def _free(self, opaque, options): self.device._might_close()
-  def as_buffer(self, src:DiskBuffer): return src._buf()
-  def copyin(self, dest:DiskBuffer, src:memoryview): dest._buf()[:] = src
+  def as_buffer(self, src:DiskBuffer):
+    DiskDevice._wait_writes()
+    return src._buf()
+  def copyin(self, dest:DiskBuffer, src:memoryview):
+    if self.device.wfd is None: dest._buf()[:] = src
+    else:
+      # the write is pipelined, but src belongs to the caller and can change once this returns. synchronize flushes it to the disk
+      self.device._write(dest.offset, src)
+      DiskDevice._wait_writes()
   def copyout(self, dest:memoryview, src:DiskBuffer):
+    DiskDevice._wait_writes()
     if OSX and self.device.fd is not None:
       # OSX doesn't seem great at mmap, this is faster
       with io.FileIO(self.device.fd, "a+b", closefd=False) as fo:
@@ -35,6 +44,7 @@ class DiskAllocator(Allocator):
 
   def _copyout_sharded(self, src:DiskBuffer, size:int, _get_free_buf:Callable, seg_len:int) -> Generator[Tuple[int, int, int, int], None, None]:
     assert hasattr(DiskDevice, 'io_uring'), "function requires io uring support"
+    DiskDevice._wait_writes()
 
     fd_offset = src.offset - (minor_offset := src.offset % mmap.PAGESIZE)
     processed_reqs_cnt, copied_in, next_read_offset, total_copy_size = 0, 0, 0, round_up(size + minor_offset, mmap.PAGESIZE)
@@ -67,15 +77,80 @@ class DiskAllocator(Allocator):
 
   def offset(self, buf:DiskBuffer, size:int, offset:int): return DiskBuffer(buf.device, size, offset)
 
+def copyout_batch(reads:List[Tuple[DiskBuffer, Callable[[int, memoryview], None]]], seg_len:int=getenv("DISK_SEG", 4<<20),
+                  depth:int=getenv("DISK_DEPTH", 16)):
+  """
+  Reads all the DiskBuffers, calling each callback with (offset, data) as the pieces arrive. The data is only valid during the call.
+  With io_uring, reads from the same file are coalesced into page aligned segments of `seg_len` bytes and `depth` of them are in flight at once.
+  """
+  seg_len = round_up(seg_len, mmap.PAGESIZE)
+  DiskDevice._wait_writes()
+  by_dev: DefaultDict[DiskDevice, List[int]] = defaultdict(list)
+  for i,(src,cb) in enumerate(reads):
+    if hasattr(DiskDevice, 'io_uring') and src.device.fd is not None: by_dev[src.device].append(i)
+    else: cb(0, src._buf())
+  for dev,idxs in by_dev.items():
+    # segments are seg_len aligned file ranges, the pieces are (read, offset in read, offset in segment, size)
+    pieces: DefaultDict[int, List[Tuple[int, int, int, int]]] = defaultdict(list)
+    for i in idxs:
+      pos, end = reads[i][0].offset, reads[i][0].offset + reads[i][0].size
+      while pos < end:
+        pieces[st:=pos - pos % seg_len].append((i, pos - reads[i][0].offset, pos - st, sz:=min(end, st + seg_len) - pos))
+        pos += sz
+    segs = sorted(pieces.items())
+
+    ring, bufs = DiskDevice.io_uring, [mmap.mmap(-1, seg_len) for _ in range(min(depth, len(segs)))]
+    free, inflight, nxt = [(b, mv_address(memoryview(b))) for b in bufs], {}, 0
+    try:
+      while nxt < len(segs) or inflight:
+        submit = 0
+        while nxt < len(segs) and free:
+          sqe_index = (tail:=ring.sq.ktail[0]) & ring.sq.kring_mask[0]
+          sqe = ring.sq.sqes[sqe_index]
+          sqe.opcode, sqe.fd, sqe.off, sqe.user_data = io_uring.IORING_OP_READ, dev.fd, segs[nxt][0], nxt
+          sqe.len = round_up(max(soff+sz for _,_,soff,sz in segs[nxt][1]), mmap.PAGESIZE)
+          inflight[nxt] = free.pop()
+          sqe.addr = inflight[nxt][1]
+          ring.sq.array[sqe_index] = sqe_index
+          ring.sq.ktail[0] = tail + 1
+          nxt, submit = nxt + 1, submit + 1
+        for seg,res in _reap(ring, submit):
+          assert res >= 0, f"read from disk failed, err: {res}"
+          buf = inflight.pop(seg)
+          for i, roff, soff, sz in segs[seg][1]:
+            assert soff + sz <= res, f"short read from disk, got {res} bytes, needed {soff + sz}"
+            reads[i][1](roff, memoryview(buf[0])[soff:soff+sz])
+          free.append(buf)
+    finally:
+      # don't leave completions of an aborted batch in the ring, the kernel is still writing into the staging buffers
+      while inflight:
+        for seg,_ in _reap(ring, 0): inflight.pop(seg, None)
+
+def _pwrite(fd:int, data:memoryview, offset:int):
+  while len(data): data, offset = data[(n:=os.pwrite(fd, data, offset)):], offset + n
+
+def _reap(ring, submit:int) -> List[Tuple[int, int]]:
+  libc.syscall(io_uring.NR_io_uring_enter, ring.ring_fd, submit, 1, io_uring.IORING_ENTER_GETEVENTS)
+  ret = []
+  while (head:=ring.cq.khead[0]) != ring.cq.ktail[0]:
+    cqe = ring.cq.cqes[head & ring.cq.kring_mask[0]]
+    ret.append((cqe.user_data, cqe.res))
+    ring.cq.khead[0] = head + 1
+  return ret
+
 class DiskDevice(Compiled):
   _tried_io_uring_init = False
+  # writes in flight on the ring, user_data -> (fd, offset, data). the data must stay alive until the kernel is done with it
+  _writes: Dict[int, Tuple[int, int, memoryview]] = {}
+  _write_id = 0
 
   def __init__(self, device:str):
     if not DiskDevice._tried_io_uring_init: self._iouring_setup()
 
     self.size: Optional[int] = None
     self.fd: Optional[int] = None
-    self.count = 0
+    self.wfd: Optional[int] = None
+    self.count, self.dirty = 0, False
     super().__init__(device, DiskAllocator(self), None, None, None)
   def _might_open(self, size):
     self.count += 1
@@ -92,14 +167,53 @@ class DiskDevice(Compiled):
       try: self.fd = os.open(filename, os.O_RDWR|os.O_CREAT|getattr(os, "O_DIRECT", 0))
       except OSError: self.fd = os.open(filename, os.O_RDWR|os.O_CREAT)
       if os.fstat(self.fd).st_size < self.size: os.ftruncate(self.fd, self.size)
+      # writes are at any offset, so they go through the page cache instead of O_DIRECT
+      if hasattr(os, "pwrite"): self.wfd = os.open(filename, os.O_RDWR)
       self.mem = mmap.mmap(self.fd, self.size)
     if hasattr(self.mem, 'madvise') and (hp := getattr(mmap, "MADV_HUGEPAGE", None)) is not None:
       with contextlib.suppress(OSError): self.mem.madvise(hp) # some systems have transparent_hugepage disabled
   def _might_close(self):
     self.count -= 1
     if self.count == 0:
+      self.synchronize()
       if self.fd is not None: os.close(self.fd)
-      self.size = None
+      if self.wfd is not None: os.close(self.wfd)
+      self.size, self.fd, self.wfd = None, None, None
+  def _write(self, offset:int, src:memoryview, seg_len:int=getenv("DISK_SEG", 4<<20), depth:int=getenv("DISK_DEPTH", 16)):
+    """
+    Writes `src` to the file at `offset`. With io_uring this is asynchronous, `src` is written from in place and must not change until synchronize.
+    """
+    assert self.wfd is not None
+    self.dirty = True
+    if not hasattr(DiskDevice, 'io_uring') or src.readonly: return _pwrite(self.wfd, src, offset)
+    ring, submit = DiskDevice.io_uring, 0
+    for st in range(0, len(src), seg_len):
+      if len(DiskDevice._writes) >= depth:
+        DiskDevice._complete_writes(_reap(ring, submit))
+        submit = 0
+      sqe_index = (tail:=ring.sq.ktail[0]) & ring.sq.kring_mask[0]
+      sqe = ring.sq.sqes[sqe_index]
+      sqe.opcode, sqe.fd, sqe.off, sqe.addr = io_uring.IORING_OP_WRITE, self.wfd, offset + st, mv_address(chunk:=src[st:st+seg_len])
+      sqe.len, sqe.user_data = len(chunk), (wid:=DiskDevice._write_id)
+      DiskDevice._writes[wid], DiskDevice._write_id = (self.wfd, offset + st, chunk), wid + 1
+      ring.sq.array[sqe_index] = sqe_index
+      ring.sq.ktail[0] = tail + 1
+      submit += 1
+    if submit: libc.syscall(io_uring.NR_io_uring_enter, ring.ring_fd, submit, 0, 0)
+  @staticmethod
+  def _complete_writes(cqes:List[Tuple[int, int]]):
+    for wid,res in cqes:
+      fd, offset, data = DiskDevice._writes.pop(wid)
+      assert res >= 0, f"write to disk failed, err: {res}"
+      if res < len(data): _pwrite(fd, data[res:], offset + res)
+  @staticmethod
+  def _wait_writes():
+    while DiskDevice._writes: DiskDevice._complete_writes(_reap(DiskDevice.io_uring, 0))
+  def synchronize(self):
+    # barrier: everything written so far is in the file and on the disk
+    DiskDevice._wait_writes()
+    if self.dirty and self.wfd is not None: getattr(os, "fdatasync", os.fsync)(self.wfd)
+    self.dirty = False
   def _iouring_setup(self):
     DiskDevice._tried_io_uring_init = True
 
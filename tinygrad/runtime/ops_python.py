@@ -2,12 +2,12 @@
 # a python uops emulator
 # works to test the tensor cores, and all the uops in general
 # this is the (living) definition of uops
-from typing import Tuple, List, Optional, Any, Dict
-import pickle, base64, itertools, time, struct
+from typing import Tuple, List, Optional, Any, Dict, Callable, cast
+import pickle, base64, itertools, time, struct, functools
 from tinygrad.dtype import DType, dtypes, ImageDType, PtrDType, truncate
-from tinygrad.helpers import all_same, getenv, flatten
+from tinygrad.helpers import all_same, getenv, flatten, prod
 from tinygrad.device import Compiled, Compiler, Allocator
-from tinygrad.ops import BinaryOps, TernaryOps, exec_alu, UOps, UOp
+from tinygrad.ops import BinaryOps, TernaryOps, UnaryOps, Op, exec_alu, UOps, UOp
 from tinygrad.renderer import Renderer
 from tinygrad.renderer.cstyle import CUDARenderer, MetalRenderer, AMDRenderer, IntelRenderer, ClangRenderer
 
@@ -24,6 +24,62 @@ def _store(m, i, v):
   if i < 0 or i >= len(m): raise IndexError(f"store out of bounds, size is {len(m)}, access is {i}, value is {v}")
   m[i] = v
 
+def wmma(arg, inp:List[Any], warp_size:int) -> List[List[Any]]:
+  # here are the models for the WMMA instruction on the different hardware
+  def wmma_helper(WARP_THREADS, K, NUM_A, NUM_B, NUM_C, a_elem, b_elem, c_map):
+    assert len(inp[0]) == NUM_A, f"A must have {NUM_A} elements per thread, it has {len(inp[0])}"
+    assert len(inp[1]) == NUM_B, f"B must have {NUM_B} elements per thread, it has {len(inp[1])}"
+    assert len(inp[2]) == NUM_C, f"C must have {NUM_C} elements per thread, it has {len(inp[2])}"
+    assert len(flatten(inp[0])) == NUM_A * warp_size, f"WMMA must have {NUM_A * warp_size} total elements for A in WMMA"
+    assert len(flatten(inp[1])) == NUM_B * warp_size, f"WMMA must have {NUM_B * warp_size} total elements for B in WMMA"
+    assert len(flatten(inp[2])) == NUM_C * warp_size, f"WMMA must have {NUM_C * warp_size} total elements for C in WMMA"
+    assert warp_size > 0 and warp_size % WARP_THREADS == 0, f"must have multiples of {WARP_THREADS} warp threads"
+    out = [inp[2][elem_idx][:] for elem_idx in range(NUM_C)]
+    for goff in range(0, warp_size, WARP_THREADS):
+      for lane_id in range(WARP_THREADS):
+        for elem_idx in range(NUM_C): # calculate new muls and add to acc
+          (c_i, c_j) = c_map(lane_id, elem_idx)
+          out[elem_idx][goff+lane_id] += sum(a_elem(inp[0], _k, c_j, goff) * b_elem(inp[1], c_i, _k, goff) for _k in range(K))
+    return out
+
+  # TODO: refactor these to a shared TensorCoreLayout in kernel.py
+  if arg[4] == "METAL":
+    # A (2 elements on 32 threads): row major
+    def a_b_elem(x, i, j, goff): return x[(i%2)][goff+(i//2)%2+(j%4)*2+(i//4)*8+(j//4)*16]
+    # (i, j), C, D (2 elements on 32 threads): row major same as A/B
+    def c_map(lane, elem): return (elem + ((lane%2)*2) + ((lane//8)%2)*4, ((lane//2)%4) + (lane//16)*4)
+    return wmma_helper(32, 8, 2, 2, 2, a_b_elem, a_b_elem, c_map)
+  elif arg[4] == "AMD":
+    # A (16 elements on 32 threads): col major, lane 16-32 == lane 0-15
+    def a_elem(x, i, j, goff):
+      assert x[i][goff+j] == x[i][goff+j+16], "warp elements not duplicated properly across lanes"
+      return x[i][goff+j]
+    # B (16 elements on 32 threads): row major, lane 16-32 == lane 0-15
+    def b_elem(x, i, j, goff): return a_elem(x, j, i, goff)  # pylint: disable=arguments-out-of-order
+    def c_map(lane, elem): return (lane%16, lane//16+elem*2) # (i, j), C, D (8 elements on 32 threads): row major
+    return wmma_helper(32, 16, 16, 16, 8, a_elem, b_elem, c_map)
+  elif arg[4] == "CUDA":
+    # A (8 elements on 32 threads)
+    def a_elem(x, i, j, goff): return x[(i%2)+(j//8)*2+(i//8)*4][goff+((i//2)%4)+(j%8)*4]
+    # B (4 elements on 32 threads)
+    def b_elem(x, i, j, goff): return x[(j%2)+(j//8)*2][goff+(j//2)%4+(i)*4]
+    # (i, j), C, D (4 elements on 32 threads)
+    def c_map(lane, elem): return ((elem%2)+(lane%4)*2, (lane//4)+(elem//2)*8)
+    return wmma_helper(32, 16, 8, 4, 4, a_elem, b_elem, c_map)
+  elif arg[4] == "INTEL":
+    # A (16 elements on 8 threads)
+    def a_elem(x, i, j, goff): return x[i%2+j*2][goff+i//2]
+    # B (16 elements on 8 threads)
+    def b_elem(x, i, j, goff): return x[j][goff+i]
+    # C, D (8 elements on 8 threads)
+    def c_map(lane, elem): return (lane, elem)
+    return wmma_helper(8, 16, 16, 16, 8, a_elem, b_elem, c_map)
+  elif arg[4] == "CLANG":
+    def elem(x, i, j, _): return x[i+j][0]
+    def c_map(_, elem): return (elem%16, elem//16)
+    return wmma_helper(1, 1, 16, 16, 256, elem, elem, c_map)
+  else: raise NotImplementedError(f"unimplemented tensor core {arg}")
+
 class PythonProgram:
   def __init__(self, name:str, lib:bytes):
     self.uops: List[Tuple[UOps, Optional[DType], List[int], Any]] = pickle.loads(lib)
@@ -125,61 +181,7 @@ class PythonProgram:
         elif uop is UOps.GEP:
           assert len(arg) == 1
           ul[i] = inp[0][arg[0]]
-        elif uop is UOps.WMMA:
-          # here are the models for the WMMA instruction on the different hardware
-          def wmma_helper(WARP_THREADS, K, NUM_A, NUM_B, NUM_C, a_elem, b_elem, c_map):
-            assert len(inp[0]) == NUM_A, f"A must have {NUM_A} elements per thread, it has {len(inp[0])}"
-            assert len(inp[1]) == NUM_B, f"B must have {NUM_B} elements per thread, it has {len(inp[1])}"
-            assert len(inp[2]) == NUM_C, f"C must have {NUM_C} elements per thread, it has {len(inp[2])}"
-            assert len(flatten(inp[0])) == NUM_A * warp_size, f"WMMA must have {NUM_A * warp_size} total elements for A in WMMA"
-            assert len(flatten(inp[1])) == NUM_B * warp_size, f"WMMA must have {NUM_B * warp_size} total elements for B in WMMA"
-            assert len(flatten(inp[2])) == NUM_C * warp_size, f"WMMA must have {NUM_C * warp_size} total elements for C in WMMA"
-            assert warp_size > 0 and warp_size % WARP_THREADS == 0, f"must have multiples of {WARP_THREADS} warp threads"
-            out = [inp[2][elem_idx][:] for elem_idx in range(NUM_C)]
-            for goff in range(0, warp_size, WARP_THREADS):
-              for lane_id in range(WARP_THREADS):
-                for elem_idx in range(NUM_C): # calculate new muls and add to acc
-                  (c_i, c_j) = c_map(lane_id, elem_idx)
-                  out[elem_idx][goff+lane_id] += sum(a_elem(inp[0], _k, c_j, goff) * b_elem(inp[1], c_i, _k, goff) for _k in range(K))
-            return out
-
-          # TODO: refactor these to a shared TensorCoreLayout in kernel.py
-          if arg[4] == "METAL":
-            # A (2 elements on 32 threads): row major
-            def a_b_elem(x, i, j, goff): return x[(i%2)][goff+(i//2)%2+(j%4)*2+(i//4)*8+(j//4)*16]
-            # (i, j), C, D (2 elements on 32 threads): row major same as A/B
-            def c_map(lane, elem): return (elem + ((lane%2)*2) + ((lane//8)%2)*4, ((lane//2)%4) + (lane//16)*4)
-            ul[i] = wmma_helper(32, 8, 2, 2, 2, a_b_elem, a_b_elem, c_map)
-          elif arg[4] == "AMD":
-            # A (16 elements on 32 threads): col major, lane 16-32 == lane 0-15
-            def a_elem(x, i, j, goff):
-              assert x[i][goff+j] == x[i][goff+j+16], "warp elements not duplicated properly across lanes"
-              return x[i][goff+j]
-            # B (16 elements on 32 threads): row major, lane 16-32 == lane 0-15
-            def b_elem(x, i, j, goff): return a_elem(x, j, i, goff)  # pylint: disable=arguments-out-of-order
-            def c_map(lane, elem): return (lane%16, lane//16+elem*2) # (i, j), C, D (8 elements on 32 threads): row major
-            ul[i] = wmma_helper(32, 16, 16, 16, 8, a_elem, b_elem, c_map)
-          elif arg[4] == "CUDA":
-            # A (8 elements on 32 threads)
-            def a_elem(x, i, j, goff): return x[(i%2)+(j//8)*2+(i//8)*4][goff+((i//2)%4)+(j%8)*4]
-            # B (4 elements on 32 threads)
-            def b_elem(x, i, j, goff): return x[(j%2)+(j//8)*2][goff+(j//2)%4+(i)*4]
-            # (i, j), C, D (4 elements on 32 threads)
-            def c_map(lane, elem): return ((elem%2)+(lane%4)*2, (lane//4)+(elem//2)*8)
-            ul[i] = wmma_helper(32, 16, 8, 4, 4, a_elem, b_elem, c_map)
-          elif arg[4] == "INTEL":
-            # A (16 elements on 8 threads)
-            def a_elem(x, i, j, goff): return x[i%2+j*2][goff+i//2]
-            # B (16 elements on 8 threads)
-            def b_elem(x, i, j, goff): return x[j][goff+i]
-            # C, D (8 elements on 8 threads)
-            def c_map(lane, elem): return (lane, elem)
-            ul[i] = wmma_helper(8, 16, 16, 16, 8, a_elem, b_elem, c_map)
-          elif arg[4] == "CLANG":
-            def elem(x, i, j, _): return x[i+j][0]
-            def c_map(_, elem): return (elem%16, elem//16)
-            ul[i] = wmma_helper(1, 1, 16, 16, 256, elem, elem, c_map)
-          else: raise NotImplementedError(f"unimplemented tensor core {arg}")
+        elif uop is UOps.WMMA: ul[i] = wmma(arg, inp, warp_size)
         elif uop is UOps.ALU:
           assert all_same([len(x) for x in inp]), f"{[len(x) for x in inp]} doesn't match on {arg}"
           assert all_same([dtype] + dtp) or arg in {BinaryOps.CMPNE, BinaryOps.CMPLT, TernaryOps.WHERE}, f"dtype mismatch on {arg}"
@@ -188,6 +190,127 @@ class PythonProgram:
         i += 1
     return time.perf_counter() - st
 
+@functools.lru_cache(None)
+def numpy_alu() -> Dict[Op, Callable]:
+  import numpy as np
+  def idiv(x, y):
+    q = np.abs(x) // np.abs(np.where(y == 0, 1, y))
+    return np.where((x < 0) != (y < 0), -q, q)
+  return {UnaryOps.LOG2: np.log2, UnaryOps.EXP2: np.exp2, UnaryOps.SQRT: np.sqrt, UnaryOps.RECIP: np.reciprocal, UnaryOps.SIN: np.sin,
+    UnaryOps.NEG: np.negative, BinaryOps.ADD: np.add, BinaryOps.SUB: np.subtract, BinaryOps.MUL: np.multiply, BinaryOps.MOD: np.fmod,
+    BinaryOps.IDIV: idiv, BinaryOps.MAX: np.maximum, BinaryOps.CMPNE: np.not_equal, BinaryOps.CMPLT: np.less, BinaryOps.XOR: np.bitwise_xor,
+    BinaryOps.OR: np.bitwise_or, BinaryOps.AND: np.bitwise_and, BinaryOps.SHR: np.right_shift, BinaryOps.SHL: np.left_shift,
+    TernaryOps.MULACC: lambda x,y,z: x*y+z, TernaryOps.WHERE: np.where}
+
+def _np_dtype(dtype:DType):
+  import numpy as np
+  return np.dtype((dtype.base if isinstance(dtype, PtrDType) else dtype).scalar().fmt)
+
+class PythonNumpyProgram(PythonProgram):
+  """runs each uop once for every thread of the launch, the values are numpy arrays with one element per thread"""
+  def __init__(self, name:str, lib:bytes):
+    super().__init__(name, lib)
+    self.loop_ends = {idp[0]:i for i,(uop,_,idp,_) in enumerate(self.uops) if uop is UOps.ENDRANGE}
+    # bfloat16 has no numpy type, those kernels use the scalar emulator
+    self.vectorizable = all((dtype.base if isinstance(dtype, PtrDType) else dtype).scalar().fmt is not None
+                            for _,dtype,_,_ in self.uops if dtype is not None and dtype != dtypes.void)
+
+  def __call__(self, *bufs, global_size:Tuple[int,int,int]=(1,1,1), local_size:Tuple[int,int,int]=(1,1,1), vals:Tuple[int, ...]=(), wait=False):
+    if not self.vectorizable: return super().__call__(*bufs, global_size=global_size, local_size=local_size, vals=vals, wait=wait)
+    import numpy as np
+    st = time.perf_counter()
+    # threads are ordered like the scalar emulator, globals (z,y,x) then locals (z,y,x). reversed, they index as (x,y,z)
+    lidx, gidx = np.split(np.indices((*global_size[::-1], *local_size[::-1])).reshape(6, -1)[::-1], 2)
+    n, group = gidx.shape[1], np.arange(gidx.shape[1]) // prod(local_size)
+
+    def access(idx, j, gate):
+      buf, off, base, size, valid = idx
+      if valid is not None: gate = gate & valid
+      if ((off+j < 0) | (off+j >= size))[gate].any(): raise IndexError(f"access out of bounds, size is {size} and access is {(off+j)[gate]}")
+      return buf, (off+j+base)[gate], gate
+
+    def load(idx, j, default, gate):
+      buf, off, gate = access(idx, j, gate)
+      ret = np.array(np.broadcast_to(default, (n,)))
+      ret[gate] = buf[off]
+      # masked image reads are 0
+      if idx[4] is not None: ret[~idx[4]] = 0
+      return ret
+
+    ul: Dict[int, Any] = {}
+    pbufs: List[memoryview] = list(bufs)
+    pvals: List[int] = list(vals)
+    gates = [np.ones(n, dtype=np.bool_)]
+    i = 0
+    with np.errstate(all="ignore"):
+      while i < len(self.uops):
+        uop, dtype, idp, arg = self.uops[i]
+        void_ops = {UOps.STORE, UOps.ENDRANGE, UOps.BARRIER, UOps.IF, UOps.ENDIF}
+        if uop is UOps.DEFINE_ACC: idp = [idp[0]]
+        inp = [ul[v] for v in idp if self.uops[v][0] not in void_ops]
+        dtp = [cast(DType, self.uops[v][1]) for v in idp if self.uops[v][0] not in void_ops]
+        if uop is UOps.STORE:
+          gate = gates[-1] if len(inp) == 2 else gates[-1] & inp[2]
+          for j,val in enumerate(inp[1] if dtp[1].count > 1 else [inp[1]]):
+            buf, off, g = access(inp[0], j, gate)
+            buf[off] = np.broadcast_to(val, (n,))[g]
+        elif uop is UOps.ENDRANGE:
+          i = idp[0]
+          continue
+        elif uop is UOps.IF: gates.append(gates[-1] & inp[0])
+        elif uop is UOps.ENDIF: gates.pop()
+        elif uop is UOps.BARRIER: pass  # every thread runs every uop together, they are always in sync
+        elif uop is UOps.DEFINE_GLOBAL: ul[i] = (buf:=np.frombuffer(pbufs.pop(0), _np_dtype(dtype)), 0, len(buf))
+        elif uop is UOps.DEFINE_LOCAL: ul[i] = (np.zeros(arg[1]*(group[-1]+1), _np_dtype(dtype)), group*arg[1], arg[1])
+        elif uop is UOps.DEFINE_VAR: ul[i] = np.full(n, pvals.pop(0), _np_dtype(dtype))
+        elif uop is UOps.SPECIAL:
+          dim = int(arg[0][-1])
+          ul[i] = {"g": gidx[dim], "l": lidx[dim], "i": gidx[dim]*local_size[dim]+lidx[dim]}[arg[0][0]].astype(_np_dtype(dtype))
+        elif uop is UOps.CONST:
+          ul[i] = [np.full(n, arg, _np_dtype(dtype))]*dtype.count if dtype.count > 1 else np.full(n, np.array(arg).astype(_np_dtype(dtype)))
+        elif uop is UOps.DEFINE_ACC: ul[i] = [x.copy() for x in inp[0]] if isinstance(inp[0], list) else inp[0].copy()
+        elif uop is UOps.INDEX:
+          buf, base, size = inp[0]
+          if isinstance(dtp[0], ImageDType):
+            ox, oy, (h, w) = inp[1][0].astype(np.int64), inp[1][1].astype(np.int64), dtp[0].shape[:2]
+            valid = (ox >= 0) & (ox < w) & (oy >= 0) & (oy < h)
+            ul[i] = (buf, np.where(valid, ox*4 + oy*w*4, 0), base, size, valid)
+          else: ul[i] = (buf, np.broadcast_to(inp[1], (n,)).astype(np.int64), base, size, None)
+        elif uop is UOps.CAST and isinstance(dtype, PtrDType): ul[i] = inp[0]
+        elif uop is UOps.RANGE:
+          v = int(inp[0][0]) if i not in ul else int(ul[i][0])+1
+          if v >= int(inp[1][0]):
+            ul.pop(i, None)
+            i = self.loop_ends[i] + 1
+            continue
+          ul[i] = np.full(n, v, _np_dtype(dtype))
+        elif uop is UOps.VECTORIZE: ul[i] = inp
+        elif uop is UOps.GEP:
+          assert len(arg) == 1
+          ul[i] = inp[0][arg[0]]
+        elif uop is UOps.BITCAST: ul[i] = np.ascontiguousarray(inp[0]).view(_np_dtype(dtype))
+        elif uop is UOps.CAST:
+          if dtype == dtypes.bool: ul[i] = inp[0] != 0
+          elif dtypes.is_int(dtype) and dtypes.is_float(dtp[0]): ul[i] = np.trunc(inp[0]).astype(np.int64).astype(_np_dtype(dtype))
+          else: ul[i] = inp[0].astype(_np_dtype(dtype))
+        elif uop is UOps.LOAD:
+          gate = gates[-1] if len(inp) == 1 else gates[-1] & inp[2]
+          default = np.zeros(n, _np_dtype(dtype)) if len(inp) == 1 else inp[1]
+          if dtype.count > 1: ul[i] = [load(inp[0], j, default[j] if isinstance(default, list) else default, gate) for j in range(dtype.count)]
+          else: ul[i] = load(inp[0], 0, default, gate)
+        elif uop is UOps.ASSIGN:
+          for acc,val in zip(inp[0], inp[1]) if isinstance(inp[0], list) else [(inp[0], inp[1])]: acc[...] = val
+          ul[i] = inp[0]
+        elif uop is UOps.WMMA:
+          # the tensor core models are in python, they run on lists
+          ul[i] = [np.array(x, _np_dtype(dtype)) for x in wmma(arg, [[y.tolist() for y in x] for x in inp], n)]
+        elif uop is UOps.ALU:
+          def alu(*srcs): return numpy_alu()[arg](*srcs).astype(_np_dtype(dtype), copy=False)
+          ul[i] = [alu(*[x[j] if isinstance(x, list) else x for x in inp]) for j in range(dtype.count)] if dtype.count > 1 else alu(*inp)
+        else: raise NotImplementedError(f"{uop} is not supported in the numpy emulator")
+        i += 1
+    return time.perf_counter() - st
+
 class PythonRenderer(Renderer):
   device = "PYTHON"
   def __init__(self):
@@ -211,4 +334,4 @@ class PythonAllocator(Allocator):
 
 class PythonDevice(Compiled):
   def __init__(self, device:str):
-    super().__init__(device, PythonAllocator(), PythonRenderer(), PythonCompiler(), PythonProgram)
+    super().__init__(device, PythonAllocator(), PythonRenderer(), PythonCompiler(), PythonNumpyProgram if getenv("PYTHON_NUMPY") else PythonProgram)
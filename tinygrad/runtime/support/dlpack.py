@@ -0,0 +1,75 @@
+from __future__ import annotations
+from typing import Dict, Tuple, Any, Optional
+import ctypes
+from tinygrad.dtype import DType, dtypes
+
+# https://dmlc.github.io/dlpack/latest/c_api.html, only host memory is exchanged
+kDLCPU = 1
+
+class DLDevice(ctypes.Structure): _fields_ = [("device_type", ctypes.c_int32), ("device_id", ctypes.c_int32)]
+class DLDataType(ctypes.Structure): _fields_ = [("code", ctypes.c_uint8), ("bits", ctypes.c_uint8), ("lanes", ctypes.c_uint16)]
+class DLTensor(ctypes.Structure):
+  _fields_ = [("data", ctypes.c_void_p), ("device", DLDevice), ("ndim", ctypes.c_int32), ("dtype", DLDataType),
+              ("shape", ctypes.POINTER(ctypes.c_int64)), ("strides", ctypes.POINTER(ctypes.c_int64)), ("byte_offset", ctypes.c_uint64)]
+class DLManagedTensor(ctypes.Structure): pass
+DLDeleter = ctypes.CFUNCTYPE(None, ctypes.POINTER(DLManagedTensor))
+DLManagedTensor._fields_ = [("dl_tensor", DLTensor), ("manager_ctx", ctypes.c_void_p), ("deleter", DLDeleter)]
+
+# type codes are 0: int, 1: uint, 2: float, 4: bfloat, 6: bool
+dl_dtypes: Dict[DType, Tuple[int, int]] = {dtypes.bool: (6, 8), dtypes.int8: (0, 8), dtypes.uint8: (1, 8), dtypes.int16: (0, 16),
+  dtypes.uint16: (1, 16), dtypes.int32: (0, 32), dtypes.uint32: (1, 32), dtypes.int64: (0, 64), dtypes.uint64: (1, 64), dtypes.float16: (2, 16),
+  dtypes.bfloat16: (4, 16), dtypes.float32: (2, 32), dtypes.float64: (2, 64)}
+inverse_dl_dtypes = {v:k for k,v in dl_dtypes.items()}
+
+_DLTENSOR, _USED_DLTENSOR = b"dltensor", b"used_dltensor"
+_PyCapsule_Destructor = ctypes.CFUNCTYPE(None, ctypes.c_void_p)
+_PyCapsule_New = ctypes.pythonapi["PyCapsule_New"]
+_PyCapsule_New.restype, _PyCapsule_New.argtypes = ctypes.py_object, [ctypes.c_void_p, ctypes.c_char_p, _PyCapsule_Destructor]
+_PyCapsule_GetPointer = ctypes.pythonapi["PyCapsule_GetPointer"]
+_PyCapsule_GetPointer.restype, _PyCapsule_GetPointer.argtypes = ctypes.c_void_p, [ctypes.py_object, ctypes.c_char_p]
+# the destructor gets a capsule that is being freed, it can't become a python object again
+_PyCapsule_IsValidRaw = ctypes.pythonapi["PyCapsule_IsValid"]
+_PyCapsule_IsValidRaw.restype, _PyCapsule_IsValidRaw.argtypes = ctypes.c_int, [ctypes.c_void_p, ctypes.c_char_p]
+_PyCapsule_GetPointerRaw = ctypes.pythonapi["PyCapsule_GetPointer"]
+_PyCapsule_GetPointerRaw.restype, _PyCapsule_GetPointerRaw.argtypes = ctypes.c_void_p, [ctypes.c_void_p, ctypes.c_char_p]
+_PyCapsule_SetName = ctypes.pythonapi["PyCapsule_SetName"]
+_PyCapsule_SetName.restype, _PyCapsule_SetName.argtypes = ctypes.c_int, [ctypes.py_object, ctypes.c_char_p]
+
+# the managed tensors handed out and what keeps their memory alive, until the consumer calls the deleter
+_exported: Dict[int, Tuple[DLManagedTensor, Any, Any]] = {}
+
+@DLDeleter
+def _deleter(mt): _exported.pop(ctypes.cast(mt, ctypes.c_void_p).value or 0, None)
+
+@_PyCapsule_Destructor
+def _capsule_destructor(capsule):
+  # a capsule that was never consumed still owns its tensor
+  if _PyCapsule_IsValidRaw(capsule, _DLTENSOR): _exported.pop(_PyCapsule_GetPointerRaw(capsule, _DLTENSOR), None)
+
+def to_dlpack(ptr:int, shape:Tuple[int, ...], dtype:DType, owner:Any) -> Any:
+  """Returns a DLPack capsule of the compact host memory at `ptr`. `owner` is kept alive until the consumer is done with it."""
+  mt, dl_shape = DLManagedTensor(), (ctypes.c_int64 * len(shape))(*shape)
+  mt.dl_tensor = DLTensor(ptr, DLDevice(kDLCPU, 0), len(shape), DLDataType(*dl_dtypes[dtype], 1), dl_shape, None, 0)
+  mt.deleter = _deleter
+  _exported[ctypes.addressof(mt)] = (mt, dl_shape, owner)
+  return _PyCapsule_New(ctypes.addressof(mt), _DLTENSOR, _capsule_destructor)
+
+class DLOwner:
+  """Holds a consumed DLPack tensor, the producer is told it can free the memory once this is gone."""
+  def __init__(self, mt:DLManagedTensor): self.mt = mt
+  def __del__(self):
+    if self.mt.deleter: self.mt.deleter(ctypes.pointer(self.mt))
+
+def from_dlpack(x:Any) -> Tuple[int, Tuple[int, ...], Optional[Tuple[int, ...]], DType, DLOwner]:
+  """Consumes a DLPack capsule or an object with `__dlpack__`, returns the pointer, shape, strides (None if compact), dtype and owner."""
+  capsule = x.__dlpack__() if hasattr(x, "__dlpack__") else x
+  mt = ctypes.cast(_PyCapsule_GetPointer(capsule, _DLTENSOR), ctypes.POINTER(DLManagedTensor)).contents
+  t = mt.dl_tensor
+  if t.device.device_type != kDLCPU: raise ValueError(f"only host DLPack tensors are supported, got device type {t.device.device_type}")
+  if t.dtype.lanes != 1 or (dtype:=inverse_dl_dtypes.get((t.dtype.code, t.dtype.bits))) is None:
+    raise ValueError(f"unsupported DLPack dtype {(t.dtype.code, t.dtype.bits, t.dtype.lanes)}")
+  shape = tuple(t.shape[i] for i in range(t.ndim))
+  strides = tuple(t.strides[i] for i in range(t.ndim)) if t.strides else None
+  # the capsule is consumed, calling the deleter is up to us now
+  _PyCapsule_SetName(capsule, _USED_DLTENSOR)
+  return (t.data or 0) + t.byte_offset, shape, strides, dtype, DLOwner(mt)
@@ -1,17 +1,19 @@
 # inspired by https://github.com/karpathy/micrograd/blob/master/micrograd/engine.py
 from __future__ import annotations
-import time, math, itertools, functools, struct, sys, inspect, pathlib, string, dataclasses, hashlib
+import time, math, itertools, functools, struct, sys, inspect, pathlib, string, dataclasses, hashlib, ctypes
 from contextlib import ContextDecorator
-from typing import List, Tuple, Callable, Optional, ClassVar, Type, Union, Sequence, Dict, DefaultDict, cast, get_args, Literal
+from typing import List, Tuple, Callable, Optional, ClassVar, Type, Union, Sequence, Dict, DefaultDict, Set, Any, cast, get_args, Literal
 from collections import defaultdict
 
 from tinygrad.dtype import DType, DTypeLike, dtypes, ImageDType, ConstType, least_upper_float, least_upper_dtype, sum_acc_dtype, to_dtype, truncate
 from tinygrad.helpers import argfix, make_tuple, flatten, prod, all_int, round_up, merge_dicts, argsort, getenv, all_same, fully_flatten, dedup
-from tinygrad.helpers import IMAGE, DEBUG, WINO, _METADATA, Metadata, TRACEMETA, ceildiv, fetch
-from tinygrad.multi import MultiLazyBuffer
-from tinygrad.ops import MetaOps, smax, smin, resolve, UOp, UOps, BinaryOps, sint, Variable, SimpleMathTrait
-from tinygrad.device import Device, Buffer, BufferOptions
-from tinygrad.engine.lazy import LazyBuffer
+from tinygrad.helpers import IMAGE, DEBUG, WINO, ALLREDUCE_BUCKET, ZERO, _METADATA, Metadata, TRACEMETA, ceildiv, fetch, Context, mv_address
+from tinygrad.multi import MultiLazyBuffer, DEFER_ALLREDUCE, all_reduce, bucketed_all_reduce, shard_bounds, shard_axis
+from tinygrad.ops import MetaOps, ReduceOps, smax, smin, resolve, UOp, UOps, BinaryOps, sint, Variable, SimpleMathTrait
+from tinygrad.device import Device, Buffer
+from tinygrad.engine.lazy import LazyBuffer, lb_seq
+from tinygrad.shape.shapetracker import ShapeTracker
+from tinygrad.shape.view import View, strides_for_shape
 from tinygrad.engine.realize import run_schedule
 from tinygrad.engine.memory import memory_planner
 from tinygrad.engine.schedule import ScheduleItem, create_schedule_with_vars
@@ -19,8 +21,10 @@ from tinygrad.engine.schedule import ScheduleItem, create_schedule_with_vars
 # **** start with two base classes, Tensor and Function ****
 
 class Function:
+  # functions are numbered in the order they are made, see Tensor.checkpoint
+  _seq = itertools.count()
   def __init__(self, device:Union[str, Tuple[str, ...]], *tensors:Tensor, metadata:Optional[Metadata]=None):
-    self.device = device
+    self.device, self.seq = device, next(Function._seq)
     self.needs_input_grad = [t.requires_grad for t in tensors]
     self.requires_grad = True if any(self.needs_input_grad) else None if None in self.needs_input_grad else False
     if self.requires_grad: self.parents = tensors
@@ -50,7 +54,34 @@ def _to_np_dtype(dtype:DType) -> Optional[type]:
   import numpy as np
   return np.dtype(dtype.fmt).type if dtype.fmt is not None else None
 
+def _linear_backward(ctx:Function) -> bool:
+  # the backward of these is linear in the gradient and doesn't mix devices, so a partial sum stays a partial sum
+  return isinstance(ctx, (F.Contiguous, F.ContiguousBackward, F.Add, F.Expand, F.Reshape, F.Permute, F.Pad, F.Shrink, F.Flip)) or \
+    (isinstance(ctx, F.Cast) and not ctx.bitcast)
+
+def _can_wrap(device:Union[str, Tuple[str, ...]]) -> bool:
+  # devices that run kernels on host memory, DISK is also host memory but is only read and written
+  return isinstance(device, str) and (d:=device.split(":")[0]) in Device._devices and d != "DISK" and hasattr(Device[device].allocator, "can_wrap")
+
+def _fromhost(ptr:int, shape:Tuple[int, ...], strides:Optional[Tuple[int, ...]], dtype:DType, device:str, owner:Any) -> Optional[LazyBuffer]:
+  # host memory the kernels of the device can run on is used in place, the owner lives as long as the opaque of the buffer
+  if not _can_wrap(device) or not Device[device].allocator.can_wrap(ptr, dtype) or 0 in shape: return None  # type: ignore[attr-defined]
+  if any(st < 0 for st in strides or ()): return None
+  strides = strides_for_shape(shape) if strides is None else strides
+  ret = LazyBuffer.metaop(MetaOps.EMPTY, (1 + sum((s-1)*st for s,st in zip(shape, strides)),), dtype, device)
+  ret.buffer.allocate(external_ptr=ptr)
+  ret.buffer._buf.owner = owner
+  del ret.srcs # fake realize
+  return ret._view(ShapeTracker((View.create(shape, strides),)))
+
+def _shared_memory(buf:Buffer) -> memoryview:
+  # host memory that stays valid as long as the memoryview does. it holds on to the buffer, which is freed to the allocator once the
+  # memoryview is gone. views hold on to their base
+  (arr:=(ctypes.c_char * buf.nbytes).from_buffer(buf.base.as_buffer(allow_zero_copy=True)[buf.offset:buf.offset+buf.nbytes])).buf = buf
+  return memoryview(arr).cast("B")
+
 def _fromnp(x: 'np.ndarray') -> LazyBuffer:  # type: ignore [name-defined] # noqa: F821
+  # the array is copied, assign and optimizer steps would write into it otherwise. Tensor.from_dlpack shares it
   ret = LazyBuffer.metaop(MetaOps.EMPTY, x.shape, _from_np_dtype(x.dtype), "NPY")
   # fake realize
   ret.buffer.allocate(x)
@@ -102,6 +133,7 @@ ReductionStr = Literal["mean", "sum", "none"]
 class Tensor(SimpleMathTrait):  # pylint: disable=abstract-method
   """
   A `Tensor` is a multi-dimensional matrix containing elements of a single data type.
+  Creating one from a list, bytes or a NumPy array copies the data, `Tensor.from_dlpack` shares host memory instead.
 
   ```python exec="true" session="tensor"
   from tinygrad import Tensor, dtypes, nn
@@ -237,7 +269,13 @@ class Tensor(SimpleMathTrait):  # pylint: disable=abstract-method
     # TODO: this is a hack for writing to DISK. remove with working assign
     if isinstance(self.device, str) and self.device.startswith("DISK"):
       if x.__class__ is not Tensor: x = Tensor(x, device="NPY", dtype=self.dtype)
-      self.contiguous().realize().lazydata.base.realized.copyin(x.numpy().data)
+      if isinstance(x.lazydata, LazyBuffer) and not x.device.startswith("DISK") and hasattr(Device[x.device].allocator, "as_buffer") and \
+          (buf:=cast(Buffer, x.contiguous().realize().lazydata.base.realized)).nbytes == x.nbytes():
+        # host memory is written to the file in place, copyin returns once the write is done with it
+        data = buf.as_buffer(allow_zero_copy=True)
+      else: data = x._data()
+      # NOTE: Device[self.device].synchronize() flushes the file to the disk
+      self.contiguous().realize().lazydata.base.realized.copyin(data)
       return self
     if x.__class__ is not Tensor: x = Tensor(x, device=self.device, dtype=self.dtype)
     if DEBUG >= 4: print(f"assign {self.lazydata} <- {x.lazydata}")
@@ -258,13 +296,25 @@ class Tensor(SimpleMathTrait):  # pylint: disable=abstract-method
     """
     return Tensor(self.lazydata, device=self.device, requires_grad=False)
 
+  def _host_buffer(self) -> Tuple[Buffer, bool]:
+    # the realized contiguous data on the device if it's in host memory, else on CLANG, and if no tensor can write to it again.
+    # that's a buffer this call made, without the lazycache no other tensor has its lazybuffer. the buffer of self is assigned to later,
+    # a buffer view is of memory other tensors have
+    # DISK can't run kernels, a permuted view is copied as is and made contiguous on CLANG
+    with Context(LAZYCACHE=0):
+      cpu = (self.to("CLANG") if isinstance(self.device, str) and self.device.startswith("DISK") else self).cast(self.dtype.scalar())
+      cpu = cpu.contiguous().to(cast(str, self.device) if _can_wrap(self.device) else "CLANG")
+    lb = cast(LazyBuffer, cpu.lazydata).base
+    private = lb.buffer._base is None and not lb.buffer.is_allocated() and lb is not getattr(self.lazydata, "base", None)
+    cpu.realize()
+    return cast(Buffer, lb.realized), private
+
   def _data(self) -> memoryview:
     if 0 in self.shape: return memoryview(bytearray(0))
     # NOTE: this realizes on the object from as_buffer being a Python object
-    cpu = self.cast(self.dtype.scalar()).contiguous().to("CLANG").realize()
-    buf = cast(Buffer, cast(LazyBuffer, cpu.lazydata).base.realized)
-    if self.device != "CLANG": buf.options = BufferOptions(nolru=True)
-    return buf.as_buffer(allow_zero_copy=True if self.device != "CLANG" else False)
+    # a buffer a tensor can write to later (assign, TinyJit outputs) is copied, one only this call made is handed out as is
+    buf, private = self._host_buffer()
+    return _shared_memory(buf) if private else buf.as_buffer()
 
   def data(self) -> memoryview:
     """
@@ -318,8 +368,25 @@ class Tensor(SimpleMathTrait):  # pylint: disable=abstract-method
     if self.dtype == dtypes.bfloat16: return self.float().numpy()
     assert _to_np_dtype(self.dtype) is not None, f"no np dtype for {self.dtype}"
     assert all_int(self.shape), f"no data if shape is symbolic, {self.shape=}"
+    # NOTE: the array shares the memory of a host buffer only numpy() made, it isn't copied again
     return np.frombuffer(self._data(), dtype=_to_np_dtype(self.dtype)).reshape(self.shape)
 
+  def __dlpack__(self, stream:Optional[int]=None, **kwargs):
+    """
+    Returns a DLPack capsule of the tensor for `from_dlpack` of other libraries. Tensors in host memory share it, others are copied to CLANG.
+
+    ```python exec="true" source="above" session="tensor" result="python"
+    t = Tensor([1, 2, 3, 4])
+    print(repr(np.from_dlpack(t)))
+    ```
+    """
+    from tinygrad.runtime.support.dlpack import to_dlpack
+    assert all_int(self.shape), f"no dlpack if shape is symbolic, {self.shape=}"
+    if 0 in self.shape: return to_dlpack(0, self.shape, self.dtype, None)
+    return to_dlpack(mv_address(mv:=_shared_memory(self._host_buffer()[0])), self.shape, self.dtype, mv)
+
+  def __dlpack_device__(self) -> Tuple[int, int]: return (1, 0)  # kDLCPU
+
   def to(self, device:Optional[Union[str, Tuple[str, ...]]]) -> Tensor:
     """
     Moves the tensor to the given device.
@@ -357,11 +424,11 @@ class Tensor(SimpleMathTrait):  # pylint: disable=abstract-method
       if axis < 0: axis += len(self.shape)
       if splits is None:
         if not isinstance(total:=self.shape[axis], int): raise RuntimeError(f"cannot shard symbolic shape {self.shape=}, {axis=}")
-        sz = round_up(total, len(devices)) // len(devices)
-        splits = tuple([max(0, min(sz, total - sz*i)) for i in range(len(devices))])
-      assert sum(splits) == self.shape[axis], "specified splits do not sum up to axis shape"
-      boundaries = tuple(itertools.accumulate(splits))
-      bounds = tuple(zip((0,) + boundaries, boundaries))
+        bounds = shard_bounds(total, len(devices))
+      else:
+        assert sum(splits) == self.shape[axis], "specified splits do not sum up to axis shape"
+        boundaries = tuple(itertools.accumulate(splits))
+        bounds = tuple(zip((0,) + boundaries, boundaries))
     return Tensor(MultiLazyBuffer.from_sharded(self.lazydata, devices, axis, bounds), device=devices, requires_grad=self.requires_grad)
 
   def shard_(self, devices:Tuple[str, ...], axis:Optional[int]=None, splits:Optional[Tuple[int, ...]]=None):
@@ -421,6 +488,31 @@ class Tensor(SimpleMathTrait):  # pylint: disable=abstract-method
     del r.lazydata.srcs # fake realize
     return r
 
+  @staticmethod
+  def from_dlpack(x, device:Optional[str]=None, **kwargs) -> Tensor:
+    """
+    Creates a tensor from a DLPack capsule or an object with `__dlpack__`, like a NumPy array or a torch tensor.
+    Host memory the device can run kernels on is shared, the object is kept alive until the tensor and its views are gone.
+    `Tensor(ndarray)` copies the array instead.
+
+    Additionally, all other keyword arguments are passed to the constructor of the tensor.
+
+    ```python exec="true" source="above" session="tensor" result="python"
+    t = Tensor.from_dlpack(np.arange(4, dtype=np.int32))
+    print(t.numpy())
+    ```
+    """
+    from tinygrad.runtime.support.dlpack import from_dlpack
+    ptr, shape, strides, dtype, owner = from_dlpack(x)
+    if 0 in shape: return Tensor.empty(*shape, dtype=dtype, device=device, **kwargs)
+    if (ret:=_fromhost(ptr, shape, strides, dtype, device:=Device.canonicalize(device), owner)) is None:
+      # everything else is copied, with the strides applied on the device
+      strides = strides_for_shape(shape) if strides is None else strides
+      offset, size = sum((s-1)*-st for s,st in zip(shape, strides) if st < 0), 1 + sum((s-1)*abs(st) for s,st in zip(shape, strides))
+      data = bytes((ctypes.c_uint8 * (size*dtype.itemsize)).from_address(ptr - offset*dtype.itemsize))
+      ret = cast(LazyBuffer, Tensor(_frompy(data, dtype), device).lazydata)._view(ShapeTracker((View.create(shape, strides, offset),)))
+    return Tensor(ret, device, **kwargs)
+
   @staticmethod
   def from_url(url:str, gunzip:bool=False, **kwargs) -> Tensor:
     """
@@ -869,20 +961,119 @@ class Tensor(SimpleMathTrait):  # pylint: disable=abstract-method
 
     assert self.shape == gradient.shape, f"grad shape must match tensor shape, {gradient.shape!r} != {self.shape!r}"
     self.grad = gradient
+    # in data parallel training the sum over the sharded batch in the backward of an expand stays a partial sum on every device,
+    # it's carried through linear backwards and the partial gradients of the leaves are all-reduced in buckets at the end
+    defer, bucket_size = isinstance(self.lazydata, MultiLazyBuffer) and (ALLREDUCE_BUCKET.value > 0 or ZERO >= 2), ALLREDUCE_BUCKET.value
+    partial: Dict[int, Tensor] = {}  # tensors with a partial grad, in the order their grad was last updated
     for t0 in reversed(toposorted):
       if t0.grad is None: raise RuntimeError(f"tensor {t0} has no grad")
+      if (is_partial:=id(t0) in partial) and not _linear_backward(t0._ctx): t0.grad, is_partial = partial.pop(id(t0)).grad._all_reduce(), False
+      if defer and isinstance(t0._ctx, F.Expand) and isinstance(g0:=t0.grad.lazydata, MultiLazyBuffer) and g0.axis in t0._ctx.expanded_axis \
+        and all(g0.real): is_partial = True
       token = _METADATA.set(dataclasses.replace(md, backward=True) if (md := t0._ctx.metadata) is not None else None)
+      deferred = DEFER_ALLREDUCE.set(is_partial)
       grads = t0._ctx.backward(t0.grad.lazydata)
+      DEFER_ALLREDUCE.reset(deferred)
       _METADATA.reset(token)
       grads = [Tensor(g, device=self.device, requires_grad=False) if g is not None else None
         for g in ([grads] if len(t0._ctx.parents) == 1 else grads)]
       for t, g in zip(t0._ctx.parents, grads):
         if g is not None and t.requires_grad:
           assert g.shape == t.shape, f"grad shape must match tensor shape, {g.shape!r} != {t.shape!r}"
+          if t.grad is not None and (id(t) in partial) != is_partial:
+            if is_partial: g = g._all_reduce()
+            else: t.grad = partial.pop(id(t)).grad._all_reduce()
           t.grad = g if t.grad is None else (t.grad + g)
+          if is_partial or id(t) in partial: partial[id(t)] = partial.pop(id(t), t)
       if not retain_graph: del t0._ctx
+    inner = {id(x) for x in toposorted}
+    leaves = [t for t in partial.values() if id(t) not in inner]
+    # with ZERO=2 every device only gets the shard of the gradients its optimizer state is for
+    axes = [shard_axis(t.shape, len(t.device)) if ZERO >= 2 else None for t in leaves]
+    reduced = bucketed_all_reduce(ReduceOps.SUM, [cast(MultiLazyBuffer, t.grad.lazydata).lbs for t in leaves], bucket_size, axes)
+    for t, lbs, axis in zip(leaves, reduced, axes):
+      t.grad = Tensor(MultiLazyBuffer(lbs, axis), device=t.device, requires_grad=False)
+    for t in partial.values():
+      if id(t) in inner: t.grad = t.grad._all_reduce()
     return self
 
+  def _all_reduce(self) -> Tensor:
+    # sums a partial gradient over its devices
+    return Tensor(MultiLazyBuffer(all_reduce(ReduceOps.SUM, cast(MultiLazyBuffer, self.lazydata).lbs), None), device=self.device, requires_grad=False)
+
+  @staticmethod
+  def checkpoint(fn:Callable[..., Tensor], *args) -> Tensor:
+    """
+    Computes `fn(*args)` without keeping its intermediates for the backward pass, they are recomputed from `args` when the gradient is needed.
+    This trades compute for memory, the kernels of `fn` run twice but only `args` stay alive until the backward pass.
+
+    Tensors that need a gradient and are computed outside of `fn` must be passed in `args`, parameters used by `fn` are found automatically.
+    Arguments that aren't tensors, like a `start_pos`, are passed as they are.
+    ```python exec="true" source="above" session="tensor" result="python"
+    w = Tensor([1.0, 2.0, 3.0], requires_grad=True)
+    Tensor.checkpoint(lambda x: (x * w).relu().sum(), Tensor([3.0, 1.0, 2.0])).backward()
+    print(w.grad.numpy())
+    ```
+    """
+    # fn draws from copies of the rng counters, so a rand in fn doesn't write to a counter and the recompute starts from the same state.
+    # a dropout in fn gets the same mask in both passes
+    def rng_copy(counters:Dict[str, LazyBuffer]) -> Dict[str, Tensor]:
+      with Context(LAZYCACHE=0): return {d:Tensor(lb.alu(MetaOps.CONTIGUOUS), device=d, requires_grad=False) for d,lb in counters.items()}
+    seed, seeds, live = Tensor._seed, dict(Tensor._device_seeds), Tensor._device_rng_counters
+    Tensor._device_rng_counters = rng_copy({d:cast(LazyBuffer, c.lazydata) for d,c in live.items()})
+    rng = {d:cast(LazyBuffer, c.lazydata) for d,c in Tensor._device_rng_counters.items()}
+    first_fn = next(Function._seq)
+    out = fn(*args)
+    if Tensor._device_seeds.keys() == seeds.keys() and all(c.lazydata is rng[d] for d,c in Tensor._device_rng_counters.items()):
+      Tensor._device_rng_counters = live
+    if getattr(out, "_ctx", None) is None: return out
+    tensors = [a for a in args if isinstance(a, Tensor)]
+    # the tensors fn uses but didn't make that need a gradient, like parameters. the graph is walked once here and then dropped with the
+    # intermediates of fn. the gradient of a parameter with a graph of its own flows on from it in the outer backward
+    params: List[Tensor] = []
+    visited, stack = {id(a) for a in tensors}, [out]
+    while stack:
+      if id(t:=stack.pop()) in visited: continue
+      visited.add(id(t))
+      if (ctx:=getattr(t, "_ctx", None)) is not None and ctx.seq > first_fn: stack.extend(ctx.parents)
+      elif t.requires_grad: params.append(t)
+    def recompute(grad:Union[LazyBuffer, MultiLazyBuffer]) -> Tuple[Optional[Union[LazyBuffer, MultiLazyBuffer]], ...]:
+      inputs = [Tensor(a.lazydata, device=a.device, requires_grad=a.requires_grad) for a in tensors]
+      # without the lazycache the forward is rebuilt instead of reusing the lazybuffers of the first pass
+      first_lb, first_fn = next(lb_seq), next(Function._seq)
+      it = iter(inputs)
+      state = Tensor._seed, Tensor._device_seeds, Tensor._device_rng_counters
+      Tensor._seed, Tensor._device_seeds, Tensor._device_rng_counters = seed, dict(seeds), rng_copy(rng)
+      try:
+        with Context(LAZYCACHE=0): ret = fn(*[next(it) if isinstance(a, Tensor) else a for a in args])
+      finally: Tensor._seed, Tensor._device_seeds, Tensor._device_rng_counters = state
+      # the recomputed kernels are scheduled after the gradient flowing into them is realized.
+      # only the lazybuffers fn just made, the ones from before can be used by the rest of the graph and are scheduled as they are
+      grad = grad.contiguous()
+      after = {x.device:x.base for x in grad.lbs}
+      known: Set[LazyBuffer] = set()
+      stack = [x.base for x in ret.lazydata.lbs]
+      while stack:
+        if (lb:=stack.pop()) in known or lb.realized is not None or lb.op is MetaOps.CONST or lb.seq < first_lb: continue
+        known.add(lb)
+        lb.after = after.get(lb.device)
+        stack.extend(x.base for x in lb.srcs)
+      # the tensors fn didn't make are detached while the gradient flows to them, their gradients and graphs stay as they are
+      outside: Dict[int, Tuple[Tensor, Optional[Tensor], Optional[Function]]] = {}
+      nodes, visited = [ret], set()
+      while nodes:
+        if id(t:=nodes.pop()) in visited: continue
+        visited.add(id(t))
+        if (ctx:=getattr(t, "_ctx", None)) is not None and ctx.seq > first_fn: nodes.extend(ctx.parents)
+        else:
+          outside[id(t)] = (t, t.grad, ctx)
+          t.grad, t._ctx = None, None
+      ret.backward(Tensor(grad, device=ret.device, requires_grad=False))
+      grads = tuple(t.grad.lazydata if t.grad is not None else None for t in (*inputs, *params))
+      for t,g,ctx in outside.values(): t.grad, t._ctx = g, ctx
+      return grads
+    return F.Checkpoint.apply(*tensors, *params, ret=out.lazydata, recompute=recompute)
+
   # ***** movement low level ops *****
 
   def view(self, *shape) -> Tensor: